@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import dj_database_url
 import os
+import time
 if os.path.isfile('env.py'): # This file does not exist on the deployed version
     import env
 from django.contrib.messages import constants as messages
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',  # trigram lookups for ride search (no-op on SQLite)
     'allauth',
     'allauth.account',
     'allauth.socialaccount',
@@ -59,9 +61,10 @@ SITE_ID = 1
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
+# Django's and allauth's backends, loading the user's profile with the user
 AUTHENTICATION_BACKENDS = [
-    'django.contrib.auth.backends.ModelBackend',
-    'allauth.account.auth_backends.AuthenticationBackend',
+    'rides.auth.ModelBackend',
+    'rides.auth.AuthenticationBackend',
 ]
 
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
@@ -70,10 +73,11 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'rides.profiling.ProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'rides.auth.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
@@ -91,7 +95,8 @@ MESSAGE_TAGS = {
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing renders for ProfileMiddleware
+        'BACKEND': 'rides.profiling.ProfiledDjangoTemplates',
         'DIRS': [TEMPLATES_DIR],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -118,10 +123,90 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # }
 
 
+# DB_CONN_MODE picks how connections are reused across requests:
+#   "persistent" (default) - keep each worker's connection open for
+#       DB_CONN_MAX_AGE seconds, with a health check before reuse
+#   "pool" - Django's native Postgres connection pool (psycopg 3's psycopg_pool),
+#       sized by DB_POOL_MIN_SIZE and DB_POOL_MAX_SIZE
+#   "none" - open and close a connection on every request
+# Under ASGI (SERVER_MODE=asgi) each request runs its queries on its own
+# thread, so persistent connections can't be reused there: it defaults to
+# "pool" instead.
+
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")
+DB_CONN_MODE = os.environ.get("DB_CONN_MODE", "pool" if SERVER_MODE == 'asgi' else "persistent")
+
 DATABASES = {
-    'default': dj_database_url.parse(os.environ.get("DATABASE_URL"))
+    'default': dj_database_url.parse(
+        os.environ.get("DATABASE_URL"),
+        conn_max_age=int(os.environ.get("DB_CONN_MAX_AGE", "600")) if DB_CONN_MODE == 'persistent' else 0,
+        conn_health_checks=DB_CONN_MODE == 'persistent',
+    )
 }
 
+if DB_CONN_MODE == 'pool' and DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': int(os.environ.get("DB_POOL_MIN_SIZE", "2")),
+        'max_size': int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+        'timeout': int(os.environ.get("DB_POOL_TIMEOUT", "10")),
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Local memory (LRU) by default; set REDIS_URL for a shared Redis cache (use
+# an allkeys-lru maxmemory policy) or CACHE_DIR for a file-based cache.
+
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get("REDIS_URL"),
+        }
+    }
+elif os.environ.get("CACHE_DIR"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get("CACHE_DIR"),
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {'MAX_ENTRIES': 1000},
+        }
+    }
+
+# SESSION_MODE picks where sessions are kept:
+#   "db" - a database row, read on every request
+#   "cached_db" (default with REDIS_URL) - the cache, written through to the
+#       database and read from it on a cache miss. Needs the shared Redis
+#       cache: a per-process cache would keep serving sessions that another
+#       process has logged out
+#   "signed_cookies" - the session cookie itself, signed with SECRET_KEY; no
+#       storage at all, but logging out can't revoke a copy of the cookie
+# ./manage.py clearsessions deletes expired database sessions in batches.
+
+SESSION_MODE = os.environ.get("SESSION_MODE", "cached_db" if os.environ.get("REDIS_URL") else "db")
+SESSION_ENGINE = {
+    'db': 'rides.sessions.db',
+    'cached_db': 'rides.sessions.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}[SESSION_MODE]
+
+# Seconds an anonymous search result page stays cached. Ride changes
+# invalidate the affected searches straight away, this only bounds staleness
+# for rides departing and fuzzy-only matches.
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "60"))
+
+# Seconds a page of a user's My Rides / My Ride Requests stays cached.
+# Bookings and ride changes drop the users' pages straight away; this bounds
+# staleness for changes made elsewhere (e.g. editing rides in the admin).
+RIDES_DASHBOARD_CACHE_TTL = int(os.environ.get("RIDES_DASHBOARD_CACHE_TTL", "300"))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -164,6 +249,102 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static'),]
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# collectstatic gives static files content-hashed names and gzip/brotli
+# copies; WhiteNoise serves the hashed names with a year-long immutable
+# Cache-Control, so a changed file is a new URL rather than a stale cache
+
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    # Brotli copies need the Brotli package
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
+
+# The tests store static files under their own names (see rides.test_runner)
+TEST_RUNNER = 'rides.test_runner.TestRunner'
+
+# What's deployed, part of the ETags of pages so a browser's copy from
+# before a deploy (linking static files by their old hashed names) isn't
+# revalidated. Heroku's dyno metadata gives the commit; failing that each
+# start counts as a release, which only costs a re-render after restarts.
+
+RELEASE = (
+    os.environ.get("RELEASE")
+    or os.environ.get("HEROKU_SLUG_COMMIT")
+    or os.environ.get("HEROKU_RELEASE_VERSION")
+    or str(int(time.time()))
+)
+
+# Ride listings
+# Keyset-paginated page size, and the point at which listing counts stop
+# counting and show "N+" instead
+
+RIDES_PAGE_SIZE = int(os.environ.get("RIDES_PAGE_SIZE", "20"))
+RIDES_COUNT_CAP = int(os.environ.get("RIDES_COUNT_CAP", "100"))
+
+# Ride search by distance
+# Default pick-up/drop-off radius when a searched place is in the gazetteer,
+# and the radii a search can choose from
+
+RIDES_SEARCH_RADIUS_KM = int(os.environ.get("RIDES_SEARCH_RADIUS_KM", "5"))
+RIDES_SEARCH_RADIUS_CHOICES = (2, 5, 10, 25)
+
+# Place suggestions
+# Seconds between rebuilds of each process's place suggestion index (rides
+# created or edited in a process are added to its index straight away)
+
+RIDES_SUGGEST_REFRESH = int(os.environ.get("RIDES_SUGGEST_REFRESH", "300"))
+
+# Live seat updates
+# Pages showing rides subscribe to their seat and status changes as
+# Server-Sent Events (served under SERVER_MODE=asgi only). The default broker
+# reaches subscribers in the publishing process; with more than one worker use
+# rides.events.PostgresBroker, which goes through Postgres LISTEN/NOTIFY.
+# Seconds between keepalive comments on an idle stream, and the most rides
+# one stream may follow.
+
+RIDES_EVENTS_BROKER = os.environ.get("RIDES_EVENTS_BROKER", "rides.events.InProcessBroker")
+RIDES_EVENTS_KEEPALIVE = int(os.environ.get("RIDES_EVENTS_KEEPALIVE", "15"))
+RIDES_EVENTS_MAX_RIDES = int(os.environ.get("RIDES_EVENTS_MAX_RIDES", "50"))
+
+# Profile pictures
+# Avatars come in these widths (1x, 2x and 3x of a 32px avatar), resized by
+# Cloudinary when CLOUDINARY_URL is set (without it avatars are a placeholder).
+# RIDES_IMAGE_SIGN_URLS=True signs the URLs, for Cloudinary accounts that
+# only allow signed transformations.
+
+RIDES_AVATAR_WIDTHS = (32, 64, 96)
+RIDES_IMAGE_BACKEND = os.environ.get(
+    "RIDES_IMAGE_BACKEND",
+    "rides.images.CloudinaryImages" if os.environ.get("CLOUDINARY_URL") else "rides.images.LocalImages",
+)
+RIDES_IMAGE_SIGN_URLS = os.environ.get("RIDES_IMAGE_SIGN_URLS", "False") == "True"
+
+# Background tasks
+# Side effects of bookings and ride changes (search cache invalidation) are
+# queued in the database and run by ./manage.py worker. Set
+# RIDES_TASKS_EAGER=True to run them in-process after commit instead, e.g.
+# in development without a worker. Search invalidation is only queued with
+# a cache the worker shares (REDIS_URL); with a per-process cache it always
+# runs in-process after commit.
+
+RIDES_TASKS_EAGER = os.environ.get("RIDES_TASKS_EAGER", "False") == "True"
+RIDES_TASKS_MAX_ATTEMPTS = int(os.environ.get("RIDES_TASKS_MAX_ATTEMPTS", "5"))
+
+# Profiling
+# ProfileMiddleware times this share of requests (0 to 1; 0 turns it off)
+# and keeps the last RIDES_PROFILE_WINDOW of them per view, per process, for
+# the staff profile report at /staff/profile/
+
+RIDES_PROFILE_SAMPLE_RATE = float(os.environ.get("RIDES_PROFILE_SAMPLE_RATE", "0.1"))
+RIDES_PROFILE_WINDOW = int(os.environ.get("RIDES_PROFILE_WINDOW", "1000"))
+
+# Archival
+# ./manage.py archive_rides (run it daily) moves rides this many days after
+# departure, and requests this long after they were closed, out of the
+# live tables
+
+RIDES_ARCHIVE_AFTER_DAYS = int(os.environ.get("RIDES_ARCHIVE_AFTER_DAYS", "90"))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
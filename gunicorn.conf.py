@@ -0,0 +1,17 @@
+"""
+Gunicorn configuration, read automatically when `gunicorn` starts in the
+project root (see Procfile).
+
+SERVER_MODE=asgi serves config.asgi with uvicorn workers, so the async
+views don't pin a worker while waiting on slow clients or the database.
+Anything else serves config.wsgi with gunicorn's sync workers. The worker
+count comes from WEB_CONCURRENCY (set by Heroku) in both modes.
+"""
+import os
+
+if os.environ.get('SERVER_MODE') == 'asgi':
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'config.wsgi:application'
+    worker_class = 'sync'
@@ -1,23 +1,195 @@
+import json
+
+from django import forms
 from django.contrib import admin
-from .models import Rides, RideRequest, UserProfile
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from .exports import REQUEST_COLUMNS, RIDE_COLUMNS, export_response
+from .models import Place, Rides, RideRequest, Task, UserProfile
+from .queue import requeue_failed
+from .services import lock_seat_counts, reserve_seats, release_seats, update_ride_request
+
+class RideRequestAdminForm(forms.ModelForm):
+    """Reject requests that would book more seats than the ride has left."""
+
+    class Meta:
+        model = RideRequest
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        ride = cleaned_data.get('ride')
+        seats_requested = cleaned_data.get('seats_requested')
+        if not ride or not seats_requested:
+            return cleaned_data
+        # The admin validates and saves in one transaction: with the ride
+        # locked, its seats are still there when save_model books them
+        lock_seat_counts(ride)
+        # Until the form is saved the instance still holds the stored request
+        needed = RideRequest(seats_requested=seats_requested, status=cleaned_data.get('status')).seats_held
+        if self.instance.pk and self.instance.ride_id == ride.pk:
+            needed -= self.instance.seats_held
+        if needed > ride.seats_available:
+            raise ValidationError(f'This ride only has {ride.seats_available} seats left.')
+        return cleaned_data
+
+
+class RidesAdminForm(forms.ModelForm):
+    """Reject offering fewer seats than are booked (see ``Rides.clean``)."""
+
+    class Meta:
+        model = Rides
+        fields = '__all__'
+
+    def clean(self):
+        # Validated and saved in one transaction, with no booking in between
+        lock_seat_counts(self.instance)
+        return super().clean()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for big changelists: on Postgres, lists are counted from the
+    planner's row estimate instead of a ``COUNT(*)`` over every matching
+    row; the table's own estimate when unfiltered, the query plan's when
+    filtered. Small results and other databases are counted exactly.
+    """
+    # Below this many rows an exact count is cheap enough
+    estimate_above = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            estimate = self.estimate(queryset, connection)
+            if estimate > self.estimate_above:
+                return estimate
+        return super().count
+
+    def estimate(self, queryset, connection):
+        with connection.cursor() as cursor:
+            if not queryset.query.where:
+                cursor.execute(
+                    'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                    [queryset.model._meta.db_table],
+                )
+                return cursor.fetchone()[0]  # -1 until the table is analysed
+            sql, params = queryset.order_by().values('pk').query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):  # drivers that don't decode json
+            plan = json.loads(plan)
+        return plan[0]['Plan']['Plan Rows']
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelists that stay fast on big tables: estimated counts, and no
+    second count of the unfiltered table next to a filtered one.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
-class RideRequestAdmin(admin.ModelAdmin):
-    """Admin interface for RideRequest with seat management."""
+
+class ExportMixin:
+    """
+    Actions streaming the selected rows (or, with "select all", the whole
+    filtered changelist) as CSV or NDJSON, ``export_columns`` wide.
+    """
+    export_columns = ()
+    actions = ['export_csv', 'export_ndjson']
+
+    def export(self, queryset, fmt):
+        return export_response(queryset, self.export_columns, fmt, self.model._meta.model_name)
+
+    @admin.action(description='Export selected %(verbose_name_plural)s as CSV')
+    def export_csv(self, request, queryset):
+        return self.export(queryset, 'csv')
+
+    @admin.action(description='Export selected %(verbose_name_plural)s as NDJSON')
+    def export_ndjson(self, request, queryset):
+        return self.export(queryset, 'ndjson')
+
+
+class RidesAdmin(ExportMixin, LargeTableAdmin):
+    """
+    Rides, latest departure first (served by ``rides_date_idx``). Searches
+    on origin and destination use the trigram indexes on Postgres.
+    """
+    form = RidesAdminForm
+    list_display = ('id', 'origin', 'destination', 'date', 'driver', 'seats_offered', 'seats_booked', 'status')
+    list_select_related = ('driver',)
+    list_filter = ('status',)
+    date_hierarchy = 'date'
+    ordering = ('-date', '-id')
+    search_fields = ('origin', 'destination')
+    # UserAdmin's searches can't use an index on auth_user, so drivers and
+    # passengers are picked by id rather than with autocomplete
+    raw_id_fields = ('driver',)
+    export_columns = RIDE_COLUMNS
+
+
+class RideRequestAdmin(ExportMixin, LargeTableAdmin):
+    """
+    Admin interface for RideRequest with seat management. Newest first
+    (served by ``riderequest_created_idx``); search by exact passenger
+    username, which the unique index on it serves.
+    """
+    form = RideRequestAdminForm
+    list_display = ('id', 'passenger', 'ride', 'seats_requested', 'status', 'created_on')
+    list_filter = ('status',)
+    date_hierarchy = 'created_on'
+    ordering = ('-created_on', '-id')
+    search_fields = ('passenger__username__exact',)
+    autocomplete_fields = ('ride',)
+    raw_id_fields = ('passenger',)
+    export_columns = REQUEST_COLUMNS
+
+    def get_queryset(self, request):
+        # __str__ shows the ride and passenger, on every page that lists requests
+        return super().get_queryset(request).select_related('passenger', 'ride')
     
     def save_model(self, request, obj, form, change):
-        """Decrement seats when creating a new ride request."""
-        if not change:  # Only for new requests
-            obj.ride.seats_available -= obj.seats_requested
-            obj.ride.save()
-        super().save_model(request, obj, form, change)
+        """Book seats for a new request, and move them with any change to it."""
+        if change:
+            update_ride_request(obj)
+            return
+        saved, created = reserve_seats(obj)
+        obj.pk = saved.pk
     
     def delete_model(self, request, obj):
         """Restore seats when deleting a ride request."""
-        obj.ride.seats_available += obj.seats_requested
-        obj.ride.save()
-        super().delete_model(request, obj)
+        release_seats(obj)
+
+    def delete_queryset(self, request, queryset):
+        """Restore seats for each request removed by the bulk delete action."""
+        for obj in queryset:
+            release_seats(obj)
+
+class PlaceAdmin(admin.ModelAdmin):
+    """Gazetteer entries; the geohash is derived from the coordinates on save."""
+    list_display = ('search_name', 'name', 'latitude', 'longitude', 'population')
+    search_fields = ('search_name', 'name')
+    readonly_fields = ('geohash',)
+
+class TaskAdmin(admin.ModelAdmin):
+    """Queued and failed background tasks; finished ones are deleted."""
+    list_display = ('name', 'status', 'attempts', 'max_attempts', 'run_after', 'created_on')
+    list_filter = ('status', 'name')
+    readonly_fields = ('locked_by', 'locked_until', 'last_error', 'created_on')
+    actions = ['retry_tasks']
+
+    @admin.action(description='Retry selected failed tasks')
+    def retry_tasks(self, request, queryset):
+        self.message_user(request, f'Queued {requeue_failed(queryset)} task(s) again.')
 
 # Register your models here.
-admin.site.register(Rides)
+
+admin.site.register(Rides, RidesAdmin)
+admin.site.register(Place, PlaceAdmin)
 admin.site.register(RideRequest, RideRequestAdmin)
+admin.site.register(Task, TaskAdmin)
 admin.site.register(UserProfile)
\ No newline at end of file
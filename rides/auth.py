@@ -0,0 +1,69 @@
+"""
+Authentication that loads the signed-in user and their profile in one query.
+
+The backends are Django's and allauth's, with ``get_user`` selecting the
+profile along with the user, so pages showing the user's profile (or
+avatar) don't fetch it separately. The user is loaded once per request
+and kept on it, as Django's ``AuthenticationMiddleware`` does.
+"""
+from functools import partial
+
+from allauth.account import auth_backends
+from django.contrib.auth import BACKEND_SESSION_KEY, backends, get_user_model
+from django.contrib.auth import middleware
+from django.utils.functional import SimpleLazyObject
+
+# What sessions signed in before these backends name instead of them
+REPLACED_BACKENDS = {
+    'django.contrib.auth.backends.ModelBackend': 'rides.auth.ModelBackend',
+    'allauth.account.auth_backends.AuthenticationBackend': 'rides.auth.AuthenticationBackend',
+}
+
+
+def users_with_profile():
+    return get_user_model()._default_manager.select_related('profile')
+
+
+class ProfileUserMixin:
+    def get_user(self, user_id):
+        user = users_with_profile().filter(pk=user_id).first()
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        user = await users_with_profile().filter(pk=user_id).afirst()
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+
+class ModelBackend(ProfileUserMixin, backends.ModelBackend):
+    """Django's ``ModelBackend``, loading the user's profile with the user."""
+
+
+class AuthenticationBackend(ProfileUserMixin, auth_backends.AuthenticationBackend):
+    """allauth's ``AuthenticationBackend``, loading the user's profile with the user."""
+
+
+def get_user(request):
+    backend = request.session.get(BACKEND_SESSION_KEY)
+    if backend in REPLACED_BACKENDS:
+        request.session[BACKEND_SESSION_KEY] = REPLACED_BACKENDS[backend]
+    return middleware.get_user(request)
+
+
+async def auser(request):
+    backend = await request.session.aget(BACKEND_SESSION_KEY)
+    if backend in REPLACED_BACKENDS:
+        await request.session.aset(BACKEND_SESSION_KEY, REPLACED_BACKENDS[backend])
+    return await middleware.auser(request)
+
+
+class AuthenticationMiddleware(middleware.AuthenticationMiddleware):
+    """
+    Django's ``AuthenticationMiddleware``, except that sessions naming a
+    backend these replaced are moved to its replacement when the user is
+    loaded, rather than signed out.
+    """
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+        request.auser = partial(auser, request)
@@ -0,0 +1,132 @@
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .geo import haversine_km
+from .models import Place, normalize_place, place_key
+
+SEARCH_KEY_PREFIX = 'rides:search'
+# How many distinct origin/destination search terms are tracked for
+# invalidation. Terms pushed out of the list just expire with SEARCH_CACHE_TTL.
+MAX_TRACKED_TERMS = 500
+PLACE_SIDES = ('origin', 'destination')
+
+
+def search_params(form, cursor=None):
+    """
+    Normalise the search form inputs into the values that decide the results.
+    An invalid form searches everything, so it shares the blank search's key.
+    """
+    data = form.cleaned_data if form.is_bound and form.is_valid() else {}
+    return {
+        'origin': normalize_place(data.get('origin') or '').lower(),
+        'destination': normalize_place(data.get('destination') or '').lower(),
+        'date': data['date'].isoformat() if data.get('date') else '',
+        'min_passengers': data.get('min_passengers') or '',
+        'origin_radius': data.get('origin_radius') or '',
+        'destination_radius': data.get('destination_radius') or '',
+        'cursor': cursor or '',
+    }
+
+
+def _digest(value):
+    return hashlib.md5(value.encode()).hexdigest()
+
+
+def _generation_key(side, term):
+    return f'{SEARCH_KEY_PREFIX}:gen:{side}:{_digest(term)}'
+
+
+def _terms_key(side):
+    return f'{SEARCH_KEY_PREFIX}:terms:{side}'
+
+
+async def _atrack_term(side, term):
+    """Remember a search term so rides changing under it can invalidate it."""
+    terms = await cache.aget(_terms_key(side), [])
+    if term in terms:
+        return
+    terms = (terms + [term])[-MAX_TRACKED_TERMS:]
+    await cache.aset(_terms_key(side), terms, None)
+
+
+async def asearch_cache_key(params):
+    """
+    Build the cache key for a search. It embeds the current generation of
+    its origin and destination terms, so bumping a term's generation drops
+    every cached page for it without having to find those keys.
+    """
+    generations = [
+        await cache.aget_or_set(_generation_key(side, params[side]), uuid.uuid4().hex, None)
+        for side in PLACE_SIDES
+    ]
+    digest = _digest('|'.join(str(params[k]) for k in sorted(params)))
+    return f'{SEARCH_KEY_PREFIX}:{":".join(generations)}:{digest}'
+
+
+async def aget_or_set_search(params, compute):
+    """Return cached search results for ``params``, awaiting ``compute()`` on a miss."""
+    key = await asearch_cache_key(params)
+    results = await cache.aget(key)
+    if results is None:
+        results = await compute()
+        await cache.aset(key, results, settings.SEARCH_CACHE_TTL)
+        for side in PLACE_SIDES:
+            await _atrack_term(side, params[side])
+    return results
+
+
+def cache_is_shared():
+    """
+    Whether every process sees the same cache, so one of them can drop
+    entries for all. Memory and local file caches are a process's (or a
+    dyno's) own.
+    """
+    return not isinstance(caches['default'], (LocMemCache, FileBasedCache, DummyCache))
+
+
+def invalidate_place_searches(*places):
+    """
+    Drop cached searches that could include a ride at these places.
+
+    ``places`` are ``(origin, destination)`` pairs. A search term is stale
+    when it's a substring of the ride's place (that's how text search
+    matches) or, for places in the gazetteer, when it's within the largest
+    search radius of it. The blank term matches every ride. Fuzzy-only
+    (trigram) matches aren't tracked and expire with SEARCH_CACHE_TTL.
+    """
+    reach = max(settings.RIDES_SEARCH_RADIUS_CHOICES + (settings.RIDES_SEARCH_RADIUS_KM,))
+    tracked = {side: cache.get(_terms_key(side), []) for side in PLACE_SIDES}
+    located = Place.objects.resolve(
+        *(name for pair in places for name in pair if name),
+        *(term for terms in tracked.values() for term in terms),
+    )
+    for index, side in enumerate(PLACE_SIDES):
+        names = {normalize_place(pair[index] or '').lower() for pair in places}
+        points = [located[place_key(name)] for name in names if place_key(name) in located]
+
+        def is_near(term):
+            place = located.get(place_key(term))
+            return place is not None and any(
+                haversine_km(place.latitude, place.longitude, point.latitude, point.longitude) <= reach
+                for point in points
+            )
+
+        # The blank term matches every ride, even if it dropped off the list
+        stale = {_generation_key(side, '')}
+        stale.update(
+            _generation_key(side, term)
+            for term in tracked[side]
+            if any(term in name for name in names) or is_near(term)
+        )
+        cache.delete_many(stale)
+
+
+def invalidate_ride_searches(ride):
+    """Drop cached searches that could include ``ride``."""
+    invalidate_place_searches((ride.origin, ride.destination))
@@ -0,0 +1,118 @@
+"""
+The per-user listings behind My Rides and My Ride Requests, each split into
+upcoming (soonest first) and past (latest first) sections.
+
+A page of a section is built as plain rows from one query, with the ride
+and driver joined in, and cached for the user. Every cached page embeds
+the user's dashboard generation, so bookings and ride changes drop all
+of a user's pages at once by deleting that generation (see
+``invalidate_dashboards``), without having to find the keys.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import REQUEST_STATUS, RIDES_STATUS, Rides, RideRequest
+from .pagination import apaginate_keyset
+
+DASHBOARD_KEY_PREFIX = 'rides:dashboard'
+SECTIONS = ('upcoming', 'past')
+RIDE_STATUSES = dict(RIDES_STATUS)
+REQUEST_STATUSES = dict(REQUEST_STATUS)
+
+
+def _generation_key(user_id):
+    return f'{DASHBOARD_KEY_PREFIX}:gen:{user_id}'
+
+
+def _section(queryset, section, now):
+    """Filter and order rows with a ``date`` for ``section``, with their keyset keys."""
+    if section == 'upcoming':
+        return queryset.filter(date__gt=now), [('date', False), ('id', False)]
+    return queryset.filter(date__lte=now), [('date', True), ('id', True)]
+
+
+def driver_rides(user_id, section, now):
+    """A driver's rides, served by ``rides_driver_date_idx``."""
+    rides = Rides.objects.filter(driver_id=user_id).values(
+        'id', 'origin', 'destination', 'date', 'seats_offered', 'seats_booked',
+        'status', 'pickup_notes', 'updated_on',
+    )
+    return _section(rides, section, now)
+
+
+def passenger_requests(user_id, section, now):
+    """A passenger's requests, with their ride and its driver in the same row."""
+    ride_requests = RideRequest.objects.filter(passenger_id=user_id).values(
+        'id', 'seats_requested', 'status', 'ride_id',
+        origin=F('ride__origin'),
+        destination=F('ride__destination'),
+        date=F('ride__date'),
+        pickup_notes=F('ride__pickup_notes'),
+        driver_username=F('ride__driver__username'),
+        driver_first_name=F('ride__driver__first_name'),
+        driver_last_name=F('ride__driver__last_name'),
+    )
+    return _section(ride_requests, section, now)
+
+
+def _ride_row(row):
+    row['seats_available'] = row['seats_offered'] - row['seats_booked']
+    row['status_display'] = RIDE_STATUSES[row['status']]
+
+
+def _request_row(row):
+    full_name = f"{row.pop('driver_first_name')} {row.pop('driver_last_name')}".strip()
+    row['driver_name'] = full_name or row['driver_username']
+    row['status_display'] = REQUEST_STATUSES[row['status']]
+
+
+LISTINGS = {
+    'rides': (driver_rides, _ride_row),
+    'requests': (passenger_requests, _request_row),
+}
+
+
+async def aget_dashboard_page(listing, user_id, section, cursor=None, now=None):
+    """
+    Return a ``KeysetPage`` of plain rows for a section (``upcoming`` or
+    ``past``) of a user's ``rides`` or ``requests``, from the cache when
+    it holds one for the user's current generation.
+    """
+    generation = await cache.aget_or_set(_generation_key(user_id), uuid.uuid4().hex, None)
+    key = f'{DASHBOARD_KEY_PREFIX}:{user_id}:{generation}:{listing}:{section}:{cursor or ""}'
+    now = now or timezone.now()
+    page = await cache.aget(key)
+    if page is None:
+        rows, build_row = LISTINGS[listing]
+        queryset, keys = rows(user_id, section, now)
+        page = await apaginate_keyset(queryset, keys, cursor)
+        for row in page.items:
+            build_row(row)
+        await cache.aset(key, page, settings.RIDES_DASHBOARD_CACHE_TTL)
+    elif section == 'upcoming':
+        # Rides that left since the page was cached are past now
+        page.items = [row for row in page.items if row['date'] > now]
+    return page
+
+
+def invalidate_dashboards(*user_ids):
+    """Drop every cached dashboard page of these users."""
+    cache.delete_many([_generation_key(user_id) for user_id in set(user_ids)])
+
+
+def invalidate_dashboards_on_commit(*user_ids):
+    """``invalidate_dashboards`` once the current transaction commits."""
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: invalidate_dashboards(*user_ids))
+
+
+def ride_dashboard_users(*ride_ids):
+    """The drivers of these rides and the passengers who requested them."""
+    drivers = Rides.objects.filter(id__in=ride_ids).values_list('driver_id', flat=True)
+    passengers = RideRequest.objects.filter(ride_id__in=ride_ids).values_list('passenger_id', flat=True)
+    return {*drivers, *passengers}
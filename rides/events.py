@@ -0,0 +1,214 @@
+"""
+Seat and status changes of rides, pushed to open pages as Server-Sent Events.
+
+Bookings and ride edits publish the rides they changed once they commit
+(``publish_rides_on_commit``); pages subscribe to the ride IDs they show
+through ``ride_events`` and update their seat counts in place, instead of
+showing counts from when they were loaded.
+
+The broker that carries events from publishers to subscribers is
+``RIDES_EVENTS_BROKER``. ``InProcessBroker`` (the default) only reaches
+subscribers in the process that published, which is all of them with a
+single worker. ``PostgresBroker`` sends events through Postgres
+LISTEN/NOTIFY, so they reach every worker's subscribers.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.utils.module_loading import import_string
+
+from .models import RIDES_STATUS, Rides
+
+logger = logging.getLogger(__name__)
+
+RIDE_STATUSES = dict(RIDES_STATUS)
+# Events waiting for a slow client; a full queue drops new events, the
+# client catches up from the next one about that ride
+QUEUE_SIZE = 100
+
+
+def ride_states(ride_ids):
+    """The current seats and status of these rides, and which of them are gone, in one query."""
+    rides = Rides.objects.filter(id__in=ride_ids).values_list('id', 'seats_offered', 'seats_booked', 'status')
+    events = {
+        ride_id: {
+            'id': ride_id,
+            'seats_available': seats_offered - seats_booked,
+            'status': status,
+            'status_display': RIDE_STATUSES[status],
+        }
+        for ride_id, seats_offered, seats_booked, status in rides
+    }
+    return [events.get(ride_id, {'id': ride_id, 'deleted': True}) for ride_id in sorted(ride_ids)]
+
+
+class InProcessBroker:
+    """Delivers events to the subscribers of the process that published them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(dict)  # ride id -> {queue: its event loop}
+
+    def subscribed(self, ride_ids):
+        """The rides in ``ride_ids`` that may have subscribers, to skip publishing the rest."""
+        with self.lock:
+            return {ride_id for ride_id in ride_ids if ride_id in self.subscribers}
+
+    def publish(self, events):
+        self.deliver(events)
+
+    def deliver(self, events):
+        """Queue each event for this process's subscribers to its ride, from any thread."""
+        for event in events:
+            with self.lock:
+                targets = list(self.subscribers.get(event['id'], {}).items())
+            for queue, loop in targets:
+                with contextlib.suppress(RuntimeError):  # the subscriber's loop has closed
+                    loop.call_soon_threadsafe(_put, queue, event)
+
+    def subscribe(self, ride_ids):
+        """
+        Return an ``asyncio.Queue`` receiving the events of ``ride_ids``
+        until ``unsubscribe``. Call it from the subscriber's event loop.
+        """
+        queue = asyncio.Queue(QUEUE_SIZE)
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            for ride_id in ride_ids:
+                self.subscribers[ride_id][queue] = loop
+        return queue
+
+    def unsubscribe(self, ride_ids, queue):
+        with self.lock:
+            for ride_id in ride_ids:
+                self.subscribers[ride_id].pop(queue, None)
+                if not self.subscribers[ride_id]:
+                    del self.subscribers[ride_id]
+
+
+def _put(queue, event):
+    if not queue.full():
+        queue.put_nowait(event)
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    Publishes with ``pg_notify``. Each process listening (from its first
+    subscriber on) gets every event on a connection of its own and hands
+    it to its subscribers, including the process that published it.
+    """
+    channel = 'rides_events'
+
+    def __init__(self):
+        super().__init__()
+        self.listener = None
+
+    def subscribed(self, ride_ids):
+        # Subscribers in other processes are out of sight
+        return set(ride_ids)
+
+    def publish(self, events):
+        with connection.cursor() as cursor:
+            for event in events:
+                # One notification per ride keeps well under the 8000 byte payload limit
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, json.dumps(event)])
+
+    def subscribe(self, ride_ids):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name='rides-events', daemon=True)
+                self.listener.start()
+        return super().subscribe(ride_ids)
+
+    def listen(self):
+        """Deliver notifications for as long as the process runs, reconnecting after errors."""
+        while True:
+            try:
+                self.listen_once()
+            except Exception:
+                logger.exception('Lost the %s listener connection, reconnecting', self.channel)
+                time.sleep(5)
+
+    def listen_once(self):
+        wrapper = connections['default']
+        conn = wrapper.Database.connect(**wrapper.get_connection_params())
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f'LISTEN {self.channel}')
+            if hasattr(conn, 'poll'):  # psycopg2
+                while True:
+                    if select.select([conn], [], [], 60)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            self.deliver([json.loads(conn.notifies.pop(0).payload)])
+            else:  # psycopg 3
+                for notify in conn.notifies():
+                    self.deliver([json.loads(notify.payload)])
+        finally:
+            conn.close()
+
+
+@functools.cache
+def get_broker():
+    return import_string(settings.RIDES_EVENTS_BROKER)()
+
+
+def publish_rides(*ride_ids):
+    """Publish the current state of these rides to their subscribers."""
+    broker = get_broker()
+    ride_ids = broker.subscribed(set(ride_ids))
+    if ride_ids:
+        broker.publish(ride_states(ride_ids))
+
+
+def publish_rides_on_commit(*ride_ids):
+    """``publish_rides`` once the current transaction commits; failing to publish doesn't fail it."""
+    ride_ids = set(ride_ids)
+    transaction.on_commit(lambda: publish_rides(*ride_ids), robust=True)
+
+
+def _snapshot(ride_ids):
+    try:
+        return ride_states(ride_ids)
+    finally:
+        # A stream lasts as long as its page is open, don't hold a connection for it
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def sse(event):
+    return f'event: ride\ndata: {json.dumps(event)}\n\n'
+
+
+async def ride_event_stream(ride_ids):
+    """
+    The Server-Sent Events of a subscription to ``ride_ids``: the current
+    state of each ride, then every change, with a comment now and then to
+    keep proxies from closing an idle connection.
+    """
+    yield 'retry: 5000\n\n'
+    broker = get_broker()
+    queue = broker.subscribe(ride_ids)
+    try:
+        # Subscribed first, so no change falls between the snapshot and the stream
+        for event in await sync_to_async(_snapshot)(ride_ids):
+            yield sse(event)
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), settings.RIDES_EVENTS_KEEPALIVE)
+            except TimeoutError:
+                yield ': keepalive\n\n'
+            else:
+                yield sse(event)
+    finally:
+        broker.unsubscribe(ride_ids, queue)
@@ -0,0 +1,143 @@
+"""
+Streaming CSV and NDJSON exports of rides and ride requests.
+
+Rows are read with ``values_list(...).iterator(chunk_size=...)`` (a
+server-side cursor on Postgres), with the driver and passenger joined in
+the same query, and written out a chunk at a time, so memory stays flat
+however many rows are exported.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+# (column, lookup) pairs. The ride columns can be read back by import_rides.
+RIDE_COLUMNS = (
+    ('id', 'id'),
+    ('driver', 'driver__username'),
+    ('driver_email', 'driver__email'),
+    ('origin', 'origin'),
+    ('destination', 'destination'),
+    ('date', 'date'),
+    ('seats_offered', 'seats_offered'),
+    ('seats_booked', 'seats_booked'),
+    ('status', 'status'),
+    ('pickup_notes', 'pickup_notes'),
+    ('created_on', 'created_on'),
+    ('updated_on', 'updated_on'),
+)
+REQUEST_COLUMNS = (
+    ('id', 'id'),
+    ('ride', 'ride_id'),
+    ('origin', 'ride__origin'),
+    ('destination', 'ride__destination'),
+    ('date', 'ride__date'),
+    ('driver', 'ride__driver__username'),
+    ('passenger', 'passenger__username'),
+    ('passenger_email', 'passenger__email'),
+    ('seats_requested', 'seats_requested'),
+    ('status', 'status'),
+    ('created_on', 'created_on'),
+    ('updated_on', 'updated_on'),
+)
+# What a driver sees of the requests on their rides
+DRIVER_REQUEST_COLUMNS = tuple(column for column in REQUEST_COLUMNS if column[0] != 'passenger_email')
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+CHUNK_SIZE = 2000
+
+
+class CSVChunk:
+    """Encode rows as CSV text, a chunk of lines at a time."""
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def header(self, names):
+        return self([names])
+
+    def __call__(self, rows):
+        self.writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows
+        )
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+
+class NDJSONChunk:
+    """Encode rows as one JSON object per line, keyed by column name."""
+
+    def header(self, names):
+        self.names = names
+        return ''
+
+    def __call__(self, rows):
+        return ''.join(json.dumps(dict(zip(self.names, row)), cls=DjangoJSONEncoder) + '\n' for row in rows)
+
+
+def _chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_lines(queryset, columns, fmt='csv', chunk_size=CHUNK_SIZE):
+    """
+    Yield ``queryset`` exported as ``fmt`` text, ``chunk_size`` rows per
+    string. Rows come in primary key order, which an index serves.
+    """
+    encode = CSVChunk() if fmt == 'csv' else NDJSONChunk()
+    rows = queryset.order_by('pk').values_list(*[lookup for _, lookup in columns])
+    header = encode.header([name for name, _ in columns])
+    if header:
+        yield header
+    for chunk in _chunked(rows.iterator(chunk_size=chunk_size), chunk_size):
+        yield encode(chunk)
+
+
+async def aexport_lines(queryset, columns, fmt='csv', chunk_size=CHUNK_SIZE):
+    """
+    ``export_lines`` for ASGI, reading each chunk in a thread. (Not
+    ``aiterator()``: for ``values_list`` it runs the query in the event loop.)
+    """
+    lines = export_lines(queryset, columns, fmt, chunk_size)
+    next_chunk = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await next_chunk(lines, None)) is not None:
+        yield chunk
+
+
+def export_response(queryset, columns, fmt, name):
+    """
+    A streaming download of ``queryset`` as ``fmt`` (a key of ``FORMATS``),
+    saved as ``<name>-<date>.<ext>``.
+
+    Django buffers a streamed response whose iterator doesn't match the
+    server (sync under ASGI, async under WSGI), so the content is an async
+    iterator when ``SERVER_MODE`` is asgi and a plain one otherwise.
+    """
+    content_type, extension = FORMATS[fmt]
+    if settings.SERVER_MODE == 'asgi':
+        content = aexport_lines(queryset, columns, fmt)
+    else:
+        content = export_lines(queryset, columns, fmt)
+    response = StreamingHttpResponse(content, content_type=content_type)
+    filename = f'{name}-{timezone.localdate():%Y%m%d}.{extension}'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
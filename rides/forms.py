@@ -1,49 +1,91 @@
 from django import forms
+from django.urls import reverse_lazy
+from django.conf import settings
 from .models import Rides
+from .services import MAX_SERIES_RIDES, schedule_dates
 from crispy_forms.helper import FormHelper
-from crispy_forms.layout import Submit, Row, Column
+from crispy_forms.layout import Submit
+
+def _radius_choices():
+    return [(km, f'Within {km} km') for km in settings.RIDES_SEARCH_RADIUS_CHOICES]
+
+
+def _suggest_attrs(field, placeholder):
+    """Text input attrs suggesting places as the user types (see suggest_places and script.js)."""
+    return {
+        'class': 'textinput form-control',
+        'placeholder': placeholder,
+        'list': f'{field}-suggestions',
+        'autocomplete': 'off',
+        'data-suggest-url': reverse_lazy('suggest_places'),
+    }
+
 
 class RideSearchForm(forms.ModelForm):
-    """Form for searching rides by origin, destination, date, and min passengers."""
+    """
+    Form for searching rides by origin, destination, date, and min passengers.
+
+    It's on every home page hit, so everything about it is set up once, on
+    the class, and it renders through one plain template
+    (rides/includes/search_form.html) in the layout of ``columns``, with the
+    markup crispy forms would give it but without its template per field.
+    """
     
     min_passengers = forms.IntegerField(
         min_value=1,
         max_value=5,
         required=False,
-        label='Passengers',
+        label='',
+        widget=forms.NumberInput(attrs={'class': 'numberinput form-control', 'placeholder': 'Passengers'}),
+    )
+    # How far from the searched places a ride may start or end, when the
+    # places are in the gazetteer (otherwise they're matched by name)
+    origin_radius = forms.TypedChoiceField(
+        coerce=int, empty_value=None, required=False, label='',
+        choices=_radius_choices, initial=lambda: settings.RIDES_SEARCH_RADIUS_KM,
+        widget=forms.Select(attrs={'class': 'select form-select'}),
+    )
+    destination_radius = forms.TypedChoiceField(
+        coerce=int, empty_value=None, required=False, label='',
+        choices=_radius_choices, initial=lambda: settings.RIDES_SEARCH_RADIUS_KM,
+        widget=forms.Select(attrs={'class': 'select form-select'}),
+    )
+    
+    # (field, Bootstrap column classes), in order
+    columns = (
+        ('origin', 'col-12 col-lg-2'),
+        ('origin_radius', 'col-12 col-lg-1'),
+        ('destination', 'col-12 col-lg-2'),
+        ('destination_radius', 'col-12 col-lg-1'),
+        ('date', 'col-12 col-lg-2'),
+        ('min_passengers', 'col-12 col-lg-2'),
     )
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['date'].required = False
-        
-        # Set placeholders and hide labels
-        self.fields['origin'].widget.attrs['placeholder'] = 'Leaving from'
-        self.fields['destination'].widget.attrs['placeholder'] = 'Going to'
-        self.fields['date'].widget.attrs['placeholder'] = 'On'
-        self.fields['min_passengers'].widget.attrs['placeholder'] = 'Passengers'
-        
-        # Hide labels
-        self.fields['origin'].label = ''
-        self.fields['destination'].label = ''
-        self.fields['date'].label = ''
-        self.fields['min_passengers'].label = ''
-        
-        self.helper = FormHelper()
-        self.helper.form_method = 'get'
-        self.helper.layout = Row(
-            Column('origin', css_class='col-12 col-lg-3'),
-            Column('destination', css_class='col-12 col-lg-3'),
-            Column('date', css_class='col-12 col-lg-2'),
-            Column('min_passengers', css_class='col-12 col-lg-2'),
-            Column(Submit('submit', 'Search', css_class='btn-primary w-100'), css_class='col-12 col-lg-2'),
-        )
+    
+    def full_clean(self):
+        super().full_clean()
+        # Bootstrap shows an input's errors when the input is marked invalid
+        for name in self.errors:
+            if name in self.fields:
+                attrs = self.fields[name].widget.attrs
+                attrs['class'] += ' is-invalid'
+                attrs['aria-describedby'] = f'{self[name].auto_id}_error'
+    
+    def layout(self):
+        """The bound fields with their column classes, for the template."""
+        return [(self[name], css_class) for name, css_class in self.columns]
     
     class Meta:
         model = Rides
         fields = ['origin', 'destination', 'date']
+        labels = {'origin': '', 'destination': '', 'date': ''}
         widgets = {
-            'date': forms.DateInput(attrs={'type': 'date'})
+            'origin': forms.TextInput(attrs=_suggest_attrs('origin', 'Leaving from')),
+            'destination': forms.TextInput(attrs=_suggest_attrs('destination', 'Going to')),
+            'date': forms.DateInput(attrs={'type': 'date', 'class': 'dateinput form-control', 'placeholder': 'On'}),
         }
 
 
@@ -61,15 +103,34 @@ class RideCreateForm(forms.ModelForm):
             raise forms.ValidationError('Destination must be at least 3 characters.')
         return destination    
     
-    seats_available = forms.IntegerField(
+    seats_offered = forms.IntegerField(
         min_value=1,
         max_value=4,
         error_messages={'min_value': 'You must offer at least 1 seat.'},
         label='Available Seats'
     )
+    repeat = forms.ChoiceField(
+        choices=[
+            ('', 'Just this once'),
+            ('weekdays', 'Every weekday (Mon-Fri)'),
+            ('daily', 'Every day'),
+            ('weekly', 'Every week'),
+        ],
+        required=False,
+        label='Repeat',
+    )
+    repeat_until = forms.DateField(
+        required=False,
+        widget=forms.DateInput(attrs={'type': 'date'}),
+        label='Repeat until',
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # A schedule only applies when creating, an edit changes one ride
+        if self.instance and self.instance.pk:
+            del self.fields['repeat']
+            del self.fields['repeat_until']
         # Set placeholders
         self.fields['origin'].widget.attrs['placeholder'] = 'e.g. Truro'
         self.fields['destination'].widget.attrs['placeholder'] = 'e.g. Falmouth'
@@ -82,9 +143,50 @@ class RideCreateForm(forms.ModelForm):
         else:
             self.helper.add_input(Submit('submit', 'Create Ride', css_class='btn-primary'))
     
+    def clean(self):
+        cleaned_data = super().clean()
+        repeat = cleaned_data.get('repeat')
+        date = cleaned_data.get('date')
+        if not repeat or not date:
+            return cleaned_data
+        until = cleaned_data.get('repeat_until')
+        if not until:
+            self.add_error('repeat_until', 'Choose the last date this ride repeats on.')
+        elif until < date.date():
+            self.add_error('repeat_until', 'The last date must be on or after the first ride.')
+        else:
+            dates = schedule_dates(date, repeat, until)
+            if not dates:
+                self.add_error('repeat_until', 'No day up to this date matches the schedule.')
+            elif len(dates) > MAX_SERIES_RIDES:
+                self.add_error('repeat_until', f'A schedule can create at most {MAX_SERIES_RIDES} rides.')
+        return cleaned_data
+
+    def build_rides(self, driver):
+        """
+        Unsaved rides for a valid form: one, or one per date of the repeat
+        schedule. Save them together with ``services.create_rides``.
+        """
+        data = self.cleaned_data
+        dates = [data['date']]
+        if data.get('repeat'):
+            dates = schedule_dates(data['date'], data['repeat'], data['repeat_until'])
+        return [
+            Rides(
+                driver=driver,
+                origin=data['origin'],
+                destination=data['destination'],
+                date=date,
+                seats_offered=data['seats_offered'],
+                pickup_notes=data['pickup_notes'],
+                status='1',  # Published
+            )
+            for date in dates
+        ]
+
     class Meta:
         model = Rides
-        fields = ['origin', 'destination', 'date', 'seats_available', 'pickup_notes']
+        fields = ['origin', 'destination', 'date', 'seats_offered', 'pickup_notes']
         widgets = {
             'date': forms.DateTimeInput(attrs={'type': 'datetime-local'}),
             'pickup_notes': forms.Textarea(attrs={'rows': 3}),
@@ -92,6 +194,6 @@ class RideCreateForm(forms.ModelForm):
         labels = {
             'origin': 'Pick Up',
             'destination': 'Drop Off',
-            'seats_available': 'Available Seats',
+            'seats_offered': 'Available Seats',
             'pickup_notes': 'Pickup Notes',
         }
\ No newline at end of file
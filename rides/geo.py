@@ -0,0 +1,147 @@
+import math
+from functools import lru_cache, reduce
+from operator import or_
+
+from django.db.models import F, Q, Value
+
+# Geohash base32, which is also its sort order
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Precision stored on rides and places: cells of about 1.2 x 0.6 km
+GEOHASH_PRECISION = 6
+# The most prefix ranges a proximity filter may OR together; larger radii
+# use shorter (coarser) prefixes instead.
+MAX_COVERING_CELLS = 16
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Geohash of a point: nearby points share a prefix, and so sort together."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        coordinate, interval = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision):
+    """Height and width of a geohash cell in degrees, as ``(lat, lng)``."""
+    lng_bits = math.ceil(5 * precision / 2)
+    lat_bits = 5 * precision - lng_bits
+    return 180 / 2 ** lat_bits, 360 / 2 ** lng_bits
+
+
+def _steps(start, stop, step):
+    values = []
+    while start < stop:
+        values.append(start)
+        start += step
+    return values + [stop]
+
+
+@lru_cache(maxsize=1024)
+def covering_cells(latitude, longitude, radius_km):
+    """
+    Geohash prefixes whose cells together cover every point within
+    ``radius_km`` of a point, using the finest precision that needs at most
+    ``MAX_COVERING_CELLS`` cells. Searches start from gazetteer places, so
+    the same few points come up again and again and are cached.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    dlng = radius_km / (KM_PER_DEGREE_LNG * max(math.cos(math.radians(latitude)), 0.01))
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = cell_size(precision)
+        # A box this size spans at most this many cells: skip precisions
+        # that can't fit without encoding anything
+        if (math.ceil(2 * dlat / height) + 1) * (math.ceil(2 * dlng / width) + 1) > MAX_COVERING_CELLS * 4:
+            continue
+        # Sampling no further apart than a cell hits every cell in the box
+        cells = {
+            encode_geohash(min(lat, 90.0), (lng + 180) % 360 - 180, precision)
+            for lat in _steps(latitude - dlat, latitude + dlat, height)
+            for lng in _steps(longitude - dlng, longitude + dlng, width)
+        }
+        if len(cells) <= MAX_COVERING_CELLS:
+            return tuple(sorted(cells))
+    return ('',)
+
+
+def _next_prefix(prefix):
+    """The smallest geohash prefix sorting after every hash starting with ``prefix``."""
+    while prefix:
+        index = GEOHASH_ALPHABET.index(prefix[-1])
+        if index + 1 < len(GEOHASH_ALPHABET):
+            return prefix[:-1] + GEOHASH_ALPHABET[index + 1]
+        prefix = prefix[:-1]
+    return None
+
+
+def prefix_ranges(prefixes):
+    """
+    ``(lower, upper)`` key ranges covering every hash starting with one of
+    ``prefixes``; ``upper`` is exclusive, or ``None`` for no bound. Cells
+    that sort next to each other share a single range.
+    """
+    ranges = []
+    for prefix in sorted(prefixes):
+        upper = _next_prefix(prefix)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1] = (ranges[-1][0], upper)
+        else:
+            ranges.append((prefix, upper))
+    return ranges
+
+
+def geohash_prefix_filter(field, prefixes):
+    """
+    Match ``field`` starting with any of ``prefixes``, as plain ranges
+    (``>= prefix AND < next prefix``) so a B-tree index serves each one on
+    every backend. Empty geohashes (places that couldn't be located) never
+    match.
+    """
+    conditions = []
+    for lower, upper in prefix_ranges(prefixes):
+        condition = Q(**{f'{field}__gte': lower}) if lower else Q(**{f'{field}__gt': ''})
+        if upper:
+            condition &= Q(**{f'{field}__lt': upper})
+        conditions.append(condition)
+    return reduce(or_, conditions)
+
+
+def squared_distance_km(latitude_field, longitude_field, latitude, longitude):
+    """
+    Database expression for the squared distance in km between the point in
+    ``latitude_field``/``longitude_field`` and a fixed point. An
+    equirectangular approximation: well within 1% at the scale of a lift.
+    Squared, so radius checks are plain arithmetic (no square root per row;
+    on SQLite that's a Python function call).
+    """
+    lng_scale = KM_PER_DEGREE_LNG * math.cos(math.radians(latitude))
+    dy = (F(latitude_field) - Value(latitude)) * Value(KM_PER_DEGREE_LAT)
+    dx = (F(longitude_field) - Value(longitude)) * Value(lng_scale)
+    return dy * dy + dx * dx
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in km between two points."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    )
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
@@ -0,0 +1,73 @@
+"""
+Profile pictures as small avatars, in a few fixed widths for ``srcset``.
+
+Each upload has a variant per ``RIDES_AVATAR_WIDTHS``, cropped to the face
+and resized by the image service, so pages never load a full-size
+picture. The variant URLs of an upload (signed, when signing is on) are
+built once per process and memoized by its public id and version, which
+change with every upload, so a list of drivers builds no URLs per row.
+Users without a picture get a static placeholder and no remote request.
+
+``RIDES_IMAGE_BACKEND`` builds the URLs: ``CloudinaryImages``, or
+``LocalImages`` for development and tests without a Cloudinary account,
+where every avatar is the placeholder.
+"""
+import functools
+
+import cloudinary
+from django.conf import settings
+from django.templatetags.static import static
+from django.utils.module_loading import import_string
+
+PLACEHOLDER = 'placeholder'  # UserProfile.profile_picture's default
+
+
+class CloudinaryImages:
+    """Variants resized and cropped by Cloudinary's URL transformations."""
+
+    def url(self, public_id, version, fmt, width):
+        return cloudinary.CloudinaryImage(public_id, version=version, format=fmt).build_url(
+            width=width, height=width, crop='thumb', gravity='face',
+            fetch_format='auto', quality='auto', secure=True,
+            sign_url=settings.RIDES_IMAGE_SIGN_URLS,
+        )
+
+
+class LocalImages:
+    """
+    No variants: uploads live in Cloudinary, and without an account there's
+    nothing to fetch or resize them from, so avatars show the placeholder.
+    """
+
+    def url(self, public_id, version, fmt, width):
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def variants(public_id, version=None, fmt=None):
+    """
+    ``(width, url)`` of each avatar width of an upload, narrowest first, or
+    nothing when the backend has no variants of it.
+    """
+    backend = import_string(settings.RIDES_IMAGE_BACKEND)()
+    sources = tuple(
+        (width, backend.url(public_id, version, fmt, width))
+        for width in sorted(settings.RIDES_AVATAR_WIDTHS)
+    )
+    return sources if all(url for width, url in sources) else ()
+
+
+def avatar_sources(picture, size):
+    """
+    ``src`` and ``srcset`` for showing ``picture`` (a ``CloudinaryField``
+    value, or None) ``size`` pixels wide: ``src`` is the narrowest variant
+    at least that wide, ``srcset`` lists them all for high density screens.
+    """
+    public_id = getattr(picture, 'public_id', picture)
+    sources = None
+    if public_id and public_id != PLACEHOLDER:
+        sources = variants(public_id, getattr(picture, 'version', None), getattr(picture, 'format', None))
+    if not sources:
+        return {'src': static('images/avatar-placeholder.svg'), 'srcset': ''}
+    src = next((url for width, url in sources if width >= size), sources[-1][1])
+    return {'src': src, 'srcset': ', '.join(f'{url} {width}w' for width, url in sources)}
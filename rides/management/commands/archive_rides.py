@@ -0,0 +1,130 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from rides.dashboard import invalidate_dashboards_on_commit, ride_dashboard_users
+from rides.models import (
+    SEAT_HOLDING_STATUSES, ArchivedRide, ArchivedRideRequest, Rides, RideRequest,
+)
+
+EXPIRED = '5'
+# Requests that are over for good, and can be archived before their ride
+CLOSED_STATUSES = ('2', '3', EXPIRED)
+# Columns copied to the archive tables, e.g. driver_id
+RIDE_FIELDS = [field.attname for field in ArchivedRide._meta.concrete_fields if field.name != 'archived_on']
+REQUEST_FIELDS = [field.attname for field in ArchivedRideRequest._meta.concrete_fields if field.name != 'archived_on']
+
+
+def _chunks(queryset, batch_size):
+    """
+    Yield the ids of ``queryset`` in ascending chunks, continuing after the
+    last id seen, so rows already handled (or skipped) aren't scanned again.
+    """
+    last_id = 0
+    while True:
+        ids = list(queryset.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def expire_requests(now=None, batch_size=1000):
+    """
+    Move requests still pending on departed rides to Expired, a chunk of
+    rides per UPDATE, and give their seats back. Returns how many expired.
+    """
+    now = now or timezone.now()
+    expired = 0
+    for ride_ids in _chunks(Rides.objects.filter(date__lte=now), batch_size):
+        with transaction.atomic():
+            changed = RideRequest.objects.filter(ride_id__in=ride_ids, status='0').update(
+                status=EXPIRED, updated_on=now,
+            )
+            if changed:
+                invalidate_dashboards_on_commit(*ride_dashboard_users(*ride_ids))
+                held = RideRequest.objects.filter(
+                    ride=OuterRef('pk'), status__in=SEAT_HOLDING_STATUSES,
+                ).order_by().values('ride').annotate(total=Sum('seats_requested')).values('total')
+                Rides.objects.filter(id__in=ride_ids).update(seats_booked=Coalesce(Subquery(held), 0))
+        expired += changed
+    return expired
+
+
+@transaction.atomic
+def _move(ride_ids=(), request_ids=()):
+    """Copy rides (with all their requests) and requests to the archive, then delete them."""
+    if ride_ids:
+        requests = RideRequest.objects.filter(ride_id__in=ride_ids)
+        invalidate_dashboards_on_commit(*ride_dashboard_users(*ride_ids))
+        ArchivedRide.objects.bulk_create(
+            ArchivedRide(**values) for values in Rides.objects.filter(id__in=ride_ids).values(*RIDE_FIELDS)
+        )
+    else:
+        requests = RideRequest.objects.filter(id__in=request_ids)
+        invalidate_dashboards_on_commit(*requests.values_list('passenger_id', flat=True))
+    archived = ArchivedRideRequest.objects.bulk_create(
+        ArchivedRideRequest(**values) for values in requests.values(*REQUEST_FIELDS)
+    )
+    if ride_ids:
+        Rides.objects.filter(id__in=ride_ids).delete()  # and their requests
+    else:
+        requests.delete()
+    return len(archived)
+
+
+def archive_rides(cutoff, batch_size=1000):
+    """
+    Move rides that departed before ``cutoff`` and their requests to the
+    archive tables, a chunk of rides per transaction. Returns
+    ``(rides, requests)`` moved.
+    """
+    rides = requests = 0
+    for ride_ids in _chunks(Rides.objects.filter(date__lt=cutoff), batch_size):
+        requests += _move(ride_ids=ride_ids)
+        rides += len(ride_ids)
+    return rides, requests
+
+
+def archive_closed_requests(cutoff, batch_size=1000):
+    """Move requests closed (rejected, cancelled or expired) before ``cutoff`` to the archive."""
+    moved = 0
+    closed = RideRequest.objects.filter(status__in=CLOSED_STATUSES, updated_on__lt=cutoff)
+    for request_ids in _chunks(closed, batch_size):
+        moved += _move(request_ids=request_ids)
+    return moved
+
+
+class Command(BaseCommand):
+    help = (
+        'Expire requests still pending on departed rides, then move rides that '
+        'departed more than RIDES_ARCHIVE_AFTER_DAYS ago, with their requests, '
+        'and requests closed that long ago into the archive tables. Run it daily. '
+        'Work is committed a chunk at a time, so an interrupted run loses '
+        'nothing and the next run carries on where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive after this many days (default: RIDES_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rides or requests per transaction')
+        parser.add_argument('--expire-only', action='store_true', help="Expire pending requests, don't archive")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = expire_requests(now, options['batch_size'])
+        self.stdout.write(f'Expired {expired} pending request(s) on departed rides')
+        if options['expire_only']:
+            return
+
+        days = settings.RIDES_ARCHIVE_AFTER_DAYS if options['days'] is None else options['days']
+        cutoff = now - timedelta(days=days)
+        rides, requests = archive_rides(cutoff, options['batch_size'])
+        closed = archive_closed_requests(cutoff, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {rides} ride(s) with {requests} request(s), and {closed} closed request(s)'
+        ))
@@ -0,0 +1,325 @@
+import json
+import statistics
+import time
+import tracemalloc
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Count
+from django.core.wsgi import get_wsgi_application
+from django.template.loader import get_template
+from django.test import Client, RequestFactory
+from django.urls import reverse
+from django.utils import timezone
+
+from rides.forms import RideSearchForm
+from rides.models import Rides, RideRequest
+from rides.pagination import KeysetPage
+from rides.stats import percentile
+from .seed_data import USERNAME_PREFIX
+
+# Metrics compared against the baseline, with the absolute change that counts
+# as noise. Timings and memory may also drift by --threshold; query counts
+# are exact, so any increase is flagged.
+COMPARED_METRICS = {'p50_ms': 1, 'p99_ms': 5, 'peak_kb': 16, 'queries': None}
+
+
+def wsgi_get(application, path):
+    """
+    GET ``path`` through the WSGI handler, the way gunicorn would. Unlike the
+    test Client this fires request_started/finished, so connections are
+    opened and closed according to the configured DB_CONN_MODE.
+    """
+    path, _, query = path.partition('?')
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'REQUEST_METHOD': 'GET'}
+    setup_testing_defaults(environ)
+    statuses = []
+    body = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        b''.join(body)
+    finally:
+        body.close()
+    return int(statuses[0].split()[0])
+
+
+def popular_searches(limit=20):
+    """The most common (origin, destination) pairs among bookable rides."""
+    return list(
+        Rides.objects.filter(status='1', date__gt=timezone.now()).with_seats_left()
+        .values_list('origin', 'destination')
+        .annotate(rides=Count('id'))
+        .order_by('-rides', 'origin', 'destination')[:limit]
+    ) or [('', '', 0)]
+
+
+def bench_apply_search_filters(options):
+    """Build the search queryset from a bound form and fetch the first page."""
+    searches = popular_searches()
+
+    def run(n):
+        origin, destination, _ = searches[n % len(searches)]
+        form = RideSearchForm({'origin': origin, 'destination': destination})
+        rides = Rides.objects.with_driver().filter(
+            date__gt=timezone.now(), status='1',
+        ).with_seats_left().apply_search_filters(form)
+        order = [f'-{f}' if desc else f for f, desc in rides.search_order_keys()]
+        list(rides.order_by(*order)[:settings.RIDES_PAGE_SIZE])
+    return run
+
+
+def bench_search_rides(options):
+    """Anonymous search through the WSGI handler, including connection handling."""
+    application = get_wsgi_application()
+    searches = popular_searches()
+
+    def run(n):
+        origin, destination, _ = searches[n % len(searches)]
+        if not options['warm_cache']:
+            cache.clear()
+        query = urlencode({'origin': origin, 'destination': destination})
+        return wsgi_get(application, f"{reverse('search_rides')}?{query}")
+    return run
+
+
+def bench_request_ride(options):
+    """
+    A logged-in passenger books a seat. Each booking is rolled back, so the
+    data set (and the next run) is unchanged.
+    """
+    passenger, _ = User.objects.get_or_create(username=f'{USERNAME_PREFIX}booker')
+    ride_ids = list(
+        Rides.objects.filter(status='1', date__gt=timezone.now()).with_seats_left()
+        .exclude(driver=passenger).order_by('date', 'id').values_list('id', flat=True)[:200]
+    )
+    if not ride_ids:
+        raise CommandError('No bookable rides; run ./manage.py seed_data first')
+    client = Client(HTTP_HOST='localhost')  # testserver isn't in ALLOWED_HOSTS
+    client.force_login(passenger)
+
+    def run(n):
+        with transaction.atomic():
+            response = client.post(
+                reverse('request_ride', args=[ride_ids[n % len(ride_ids)]]), {'seats_requested': 1},
+            )
+            transaction.set_rollback(True)
+        return response.status_code
+    return run
+
+
+def bench_my_ride_requests(options):
+    """The bookings page for the passenger with the most requests."""
+    busiest = (
+        RideRequest.objects.values_list('passenger', flat=True)
+        .annotate(requests=Count('id')).order_by('-requests').first()
+    )
+    if busiest is None:
+        raise CommandError('No ride requests; run ./manage.py seed_data first')
+    client = Client(HTTP_HOST='localhost')  # testserver isn't in ALLOWED_HOSTS
+    client.force_login(User.objects.get(pk=busiest))
+    url = reverse('my_ride_requests')
+    return lambda n: client.get(url).status_code
+
+
+def bench_render_search_form(options):
+    """Render the search form bound to a search, on its own."""
+    template = get_template('rides/includes/search_form.html')
+    searches = popular_searches()
+
+    def run(n):
+        origin, destination, _ = searches[n % len(searches)]
+        template.render({'form': RideSearchForm({'origin': origin, 'destination': destination})})
+    return run
+
+
+def bench_render_search_page(options):
+    """
+    Render search_rides.html for an anonymous visitor with 50 result cards,
+    from rides loaded beforehand, so it times the template alone. The card
+    fragment cache is cleared every run unless --warm-cache; the page
+    less render_search_form is the cost of the card markup.
+    """
+    template = get_template('rides/search_rides.html')
+    rides = list(
+        Rides.objects.with_driver().filter(status='1', date__gt=timezone.now())
+        .with_seats_left().order_by('date', 'id')[:50]
+    )
+    request = RequestFactory().get(reverse('search_rides'), HTTP_HOST='localhost')
+    request.user = AnonymousUser()
+    page = KeysetPage(rides, None, len(rides), False)
+
+    def run(n):
+        if not options['warm_cache']:
+            cache.clear()
+        context = {'form': RideSearchForm(), 'rides': rides, 'page': page, 'user_request_ids': set()}
+        template.render(context, request)
+    return run
+
+
+SCENARIOS = {
+    'apply_search_filters': bench_apply_search_filters,
+    'search_rides': bench_search_rides,
+    'request_ride': bench_request_ride,
+    'my_ride_requests': bench_my_ride_requests,
+    'render_search_form': bench_render_search_form,
+    'render_search_page': bench_render_search_page,
+}
+
+
+def measure(run, requests, warmup, memory_samples):
+    """
+    Call ``run(n)`` ``warmup + requests`` times and return latency
+    percentiles, queries per call and the peak Python memory allocated
+    during a call (traced separately, as tracing slows everything down).
+    """
+    queries = []
+    samples = []
+
+    def count_query(execute, sql, params, many, context):
+        queries[-1] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_query):
+        for n in range(warmup + requests):
+            queries.append(0)
+            start = time.perf_counter()
+            status = run(n)
+            elapsed = time.perf_counter() - start
+            if status not in (None, 200, 302):
+                raise CommandError(f'Request returned {status}')
+            if n >= warmup:
+                samples.append(elapsed * 1000)
+
+    peak_kb = 0
+    tracemalloc.start()
+    try:
+        for n in range(memory_samples):
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            run(n)
+            peak_kb = max(peak_kb, (tracemalloc.get_traced_memory()[1] - baseline) / 1024)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'p50_ms': round(percentile(samples, 50), 2),
+        'p95_ms': round(percentile(samples, 95), 2),
+        'p99_ms': round(percentile(samples, 99), 2),
+        'mean_ms': round(statistics.mean(samples), 2),
+        'queries': max(queries[warmup:]),
+        'peak_kb': round(peak_kb),
+        'samples': len(samples),
+    }
+
+
+def compare_results(baseline, current, threshold):
+    """
+    List the metrics in ``current`` that regressed against ``baseline``:
+    timings and memory more than ``threshold`` (a fraction) and more than
+    the noise allowance above the baseline, query counts above it at all.
+    """
+    regressions = []
+    for name, metrics in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if not base:
+            continue
+        for metric, noise in COMPARED_METRICS.items():
+            if metric not in base:
+                continue
+            limit = base[metric]
+            if noise is not None:
+                limit = max(base[metric] * (1 + threshold), base[metric] + noise)
+            if metrics[metric] > limit:
+                change = (metrics[metric] / base[metric] - 1) * 100 if base[metric] else float('inf')
+                regressions.append(f'{name} {metric}: {base[metric]} -> {metrics[metric]} (+{change:.0f}%)')
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the search and booking hot paths against the current database '
+        '(seed it with ./manage.py seed_data) and report latency percentiles, '
+        'queries per request and peak memory. Save a baseline with --save and '
+        'check a later run against it with --compare; regressions beyond '
+        '--threshold make the command fail. Timings only compare meaningfully '
+        'on the same machine and data set. Run it once per DB_CONN_MODE to '
+        'compare connection handling, e.g. DB_CONN_MODE=none ./manage.py benchmark. '
+        'The page scenarios link static files through the manifest, so run '
+        'collectstatic first'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                            help=f"One or more of {', '.join(SCENARIOS)} (default: all)")
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--memory-samples', type=int, default=5)
+        parser.add_argument(
+            '--warm-cache', action='store_true',
+            help='Keep the search cache between requests (default: clear it so every request hits the database)',
+        )
+        parser.add_argument('--save', metavar='PATH', help='Write the results to PATH as a JSON baseline')
+        parser.add_argument('--compare', metavar='PATH', help='Compare the results with a JSON baseline')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed slowdown as a fraction of the baseline (default: 0.2)')
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+        connections_opened = []
+        connection_created.connect(lambda **kwargs: connections_opened.append(1), weak=False)
+        db = settings.DATABASES['default']
+        results = {
+            'meta': {
+                'engine': db['ENGINE'].rsplit('.', 1)[-1],
+                'conn_mode': settings.DB_CONN_MODE,
+                'rides': Rides.objects.count(),
+                'ride_requests': RideRequest.objects.count(),
+                'users': User.objects.count(),
+            },
+            'scenarios': {},
+        }
+        self.stdout.write(
+            f"engine={results['meta']['engine']} conn_mode={settings.DB_CONN_MODE} "
+            f"rides={results['meta']['rides']} ride_requests={results['meta']['ride_requests']}"
+        )
+
+        for name in options['scenarios'] or SCENARIOS:
+            run = SCENARIOS[name](options)
+            connections_opened.clear()
+            metrics = measure(run, options['requests'], options['warmup'], options['memory_samples'])
+            metrics['connections_opened'] = len(connections_opened)
+            results['scenarios'][name] = metrics
+            self.stdout.write(
+                f"{name:<22} p50={metrics['p50_ms']:.2f}ms p95={metrics['p95_ms']:.2f}ms "
+                f"p99={metrics['p99_ms']:.2f}ms mean={metrics['mean_ms']:.2f}ms "
+                f"queries={metrics['queries']} peak={metrics['peak_kb']}KB "
+                f"connections_opened={metrics['connections_opened']}"
+            )
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+            self.stdout.write(f"Saved baseline to {options['save']}")
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            for key in ('engine', 'rides', 'ride_requests'):
+                if baseline['meta'].get(key) != results['meta'][key]:
+                    self.stderr.write(
+                        f"Warning: baseline {key}={baseline['meta'].get(key)}, now {results['meta'][key]}"
+                    )
+            regressions = compare_results(baseline, results, options['threshold'])
+            if regressions:
+                for line in regressions:
+                    self.stderr.write(f'REGRESSION {line}')
+                raise CommandError(f'{len(regressions)} regression(s) against {options["compare"]}')
+            self.stdout.write(self.style.SUCCESS(f"No regressions against {options['compare']}"))
@@ -0,0 +1,143 @@
+import csv
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from rides.geo import encode_geohash
+from rides.models import Place, Rides, geocode_rides, place_key
+
+BUNDLED_GAZETTEER = Path(__file__).resolve().parents[2] / 'data' / 'cornwall_places.csv'
+# Columns of a GeoNames dump (e.g. GB.txt from download.geonames.org/export/dump/)
+GEONAMES_COLUMNS = (
+    'geonameid', 'name', 'asciiname', 'alternatenames', 'latitude', 'longitude',
+    'feature_class', 'feature_code', 'country_code', 'cc2', 'admin1', 'admin2',
+    'admin3', 'admin4', 'population', 'elevation', 'dem', 'timezone', 'modified',
+)
+
+
+def _geonames_names(row):
+    return [row['name'], row['asciiname'], *row['alternatenames'].split(',')]
+
+
+def _csv_names(row):
+    return [row['name'], *(row.get('alternate_names') or '').split('|')]
+
+
+def read_gazetteer(path, feature_classes=('P',), min_population=0, bbox=None):
+    """
+    Yield ``(names, latitude, longitude, population)`` for each place in an
+    offline gazetteer: a GeoNames dump (tab-separated, no header) or a CSV
+    with ``name,latitude,longitude[,population][,alternate_names]`` columns,
+    alternate names separated by ``|``. GeoNames rows are kept if their
+    feature class is in ``feature_classes`` (P = towns and villages);
+    ``bbox`` is ``(south, west, north, east)``.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        first = f.readline()
+        f.seek(0)
+        if '\t' in first:
+            rows = (
+                dict(zip(GEONAMES_COLUMNS, line))
+                for line in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            )
+            rows = (row for row in rows if row['feature_class'] in feature_classes)
+            names_of = _geonames_names
+        else:
+            rows = csv.DictReader(f)
+            names_of = _csv_names
+
+        for row in rows:
+            latitude, longitude = float(row['latitude']), float(row['longitude'])
+            population = int(row.get('population') or 0)
+            if population < min_population:
+                continue
+            if bbox and not (bbox[0] <= latitude <= bbox[2] and bbox[1] <= longitude <= bbox[3]):
+                continue
+            names = [name.strip() for name in names_of(row) if name.strip()]
+            yield names, latitude, longitude, population
+
+
+def import_gazetteer(entries, batch_size=1000):
+    """
+    Save gazetteer ``entries`` (from ``read_gazetteer``) as one ``Place`` per
+    name. Where two places share a name the bigger one wins, as it's the
+    one people mean. Existing places are updated. Returns the number saved.
+    """
+    places = {}
+    for names, latitude, longitude, population in entries:
+        for name in names:
+            key = place_key(name)
+            if key not in places or population > places[key].population:
+                places[key] = Place(
+                    name=names[0], search_name=key, latitude=latitude, longitude=longitude,
+                    geohash=encode_geohash(latitude, longitude), population=population,
+                )
+    Place.objects.bulk_create(
+        places.values(),
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['search_name'],
+        update_fields=['name', 'latitude', 'longitude', 'geohash', 'population'],
+    )
+    return len(places)
+
+
+def relocate_rides(batch_size=2000):
+    """Re-geocode every ride against the current gazetteer. Returns how many moved."""
+    moved = 0
+    rides = Rides.objects.only('id', 'origin', 'destination', *Rides.LOCATION_FIELDS).order_by('id')
+    last_id = 0
+    while True:
+        batch = list(rides.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return moved
+        changed = geocode_rides(batch)
+        Rides.objects.bulk_update(changed, Rides.LOCATION_FIELDS)
+        moved += len(changed)
+        last_id = batch[-1].id
+
+
+class Command(BaseCommand):
+    help = (
+        'Load places into the gazetteer used for ride search by distance, from '
+        'a GeoNames dump or a name,latitude,longitude CSV (default: the bundled '
+        'Cornwall places), then re-locate existing rides against it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', default=[str(BUNDLED_GAZETTEER)])
+        parser.add_argument('--feature-class', action='append', dest='feature_classes',
+                            help='GeoNames feature classes to import (default: P)')
+        parser.add_argument('--min-population', type=int, default=0)
+        parser.add_argument('--bbox', help='Only import places within SOUTH,WEST,NORTH,EAST')
+        parser.add_argument('--no-relocate', action='store_true',
+                            help="Don't re-locate existing rides afterwards")
+
+    def handle(self, *args, **options):
+        bbox = None
+        if options['bbox']:
+            try:
+                bbox = tuple(float(value) for value in options['bbox'].split(','))
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4:
+                raise CommandError('--bbox needs four numbers: SOUTH,WEST,NORTH,EAST')
+
+        with transaction.atomic():
+            for path in options['paths']:
+                try:
+                    entries = read_gazetteer(
+                        path,
+                        feature_classes=tuple(options['feature_classes'] or ('P',)),
+                        min_population=options['min_population'],
+                        bbox=bbox,
+                    )
+                    saved = import_gazetteer(entries)
+                except (OSError, KeyError, ValueError) as error:
+                    raise CommandError(f'Could not import {path}: {error}')
+                self.stdout.write(f'Imported {saved} place names from {path}')
+
+        if not options['no_relocate']:
+            self.stdout.write(f'Re-located {relocate_rides()} rides')
+        self.stdout.write(self.style.SUCCESS(f'Gazetteer has {Place.objects.count()} place names'))
@@ -0,0 +1,119 @@
+import csv
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from rides.models import RIDES_STATUS, Rides
+from rides.services import create_rides, validate_ride_batch
+from rides.tasks import queue_search_invalidation
+
+REQUIRED_COLUMNS = ('driver', 'origin', 'destination', 'date', 'seats_offered')
+STATUSES = dict(RIDES_STATUS)
+
+
+def parse_date(value):
+    """An ISO 8601 departure time; naive times are in the site's time zone."""
+    date = datetime.fromisoformat(value.strip())
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def read_rides(f, drivers):
+    """
+    Build unsaved rides from CSV rows with ``driver`` (username), ``origin``,
+    ``destination``, ``date`` and ``seats_offered`` columns, and optionally
+    ``pickup_notes`` and ``status`` (0 draft, 1 published, the default, or 2
+    cancelled). ``drivers`` maps usernames to users.
+
+    Returns ``(rides, errors)``: the rides that parsed, each with its CSV line
+    number as ``line``, and ``(line, message)`` for the rows that didn't.
+    """
+    rows = csv.DictReader(f)
+    missing = [column for column in REQUIRED_COLUMNS if column not in (rows.fieldnames or ())]
+    if missing:
+        raise CommandError(f"Missing column(s): {', '.join(missing)}")
+    max_place = Rides._meta.get_field('origin').max_length
+    rides, errors = [], []
+    for row in rows:
+        line = rows.line_num
+        try:
+            username = (row['driver'] or '').strip()
+            driver = drivers.get(username)
+            if driver is None:
+                raise ValueError(f'unknown driver {username!r}')
+            origin, destination = (row['origin'] or '').strip(), (row['destination'] or '').strip()
+            for place in (origin, destination):
+                if not 3 <= len(place) <= max_place:
+                    raise ValueError(f'places must be 3 to {max_place} characters')
+            seats = int(row['seats_offered'])
+            if not 1 <= seats <= 4:
+                raise ValueError('seats_offered must be between 1 and 4')
+            status = (row.get('status') or '1').strip()
+            if status not in STATUSES:
+                raise ValueError(f'unknown status {status!r}')
+            ride = Rides(
+                driver=driver, origin=origin, destination=destination,
+                date=parse_date(row['date']), seats_offered=seats,
+                pickup_notes=(row.get('pickup_notes') or '').strip(), status=status,
+            )
+        except (TypeError, ValueError) as error:
+            errors.append((line, str(error)))
+            continue
+        ride.line = line
+        rides.append(ride)
+    return rides, errors
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk-import rides from CSV files for fleet operators. Columns: driver '
+        '(username), origin, destination, date (ISO 8601), seats_offered and '
+        'optionally pickup_notes and status. By default nothing is imported if '
+        'any row is invalid; --skip-invalid imports the valid rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--skip-invalid', action='store_true', help='Import the valid rows, report the rest')
+        parser.add_argument('--dry-run', action='store_true', help='Check the files without importing anything')
+
+    def handle(self, *args, **options):
+        rides, errors = [], []
+        for path in options['paths']:
+            try:
+                with open(path, newline='', encoding='utf-8') as f:
+                    usernames = {(row.get('driver') or '').strip() for row in csv.DictReader(f)}
+                    drivers = User.objects.in_bulk(usernames, field_name='username')
+                    f.seek(0)
+                    parsed, invalid = read_rides(f, drivers)
+            except (OSError, csv.Error) as error:
+                raise CommandError(f'Could not read {path}: {error}')
+            for ride in parsed:
+                ride.path = path
+            rides += parsed
+            errors += [(path, line, message) for line, message in invalid]
+
+        for index, messages in validate_ride_batch(rides).items():
+            errors += [(rides[index].path, rides[index].line, message) for message in messages]
+            rides[index] = None
+        rides = [ride for ride in rides if ride is not None]
+
+        for path, line, message in sorted(errors):
+            self.stderr.write(f'{path}:{line}: {message}')
+        if errors and not options['skip_invalid']:
+            raise CommandError(f'{len(errors)} invalid row(s), nothing imported (see --skip-invalid)')
+        if options['dry_run']:
+            self.stdout.write(f'{len(rides)} ride(s) would be imported')
+            return
+
+        try:
+            rides = create_rides(rides, batch_size=options['batch_size'])
+        except ValidationError as error:
+            raise CommandError('; '.join(error.messages))
+        queue_search_invalidation(*{(ride.origin, ride.destination) for ride in rides})
+        self.stdout.write(self.style.SUCCESS(f'Imported {len(rides)} ride(s)'))
@@ -0,0 +1,78 @@
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from rides.stats import percentile
+
+
+def server_rss_mb(pid):
+    """Resident memory of a process plus its direct children (e.g. gunicorn workers), in MB. Linux only."""
+    total_kb = 0
+    for status in Path('/proc').glob('[0-9]*/status'):
+        try:
+            fields = dict(line.split(':', 1) for line in status.read_text().splitlines())
+        except OSError:
+            continue  # the process exited while we were looking
+        if pid in (int(fields['Pid']), int(fields['PPid'])):
+            total_kb += int(fields.get('VmRSS', '0 kB').split()[0])
+    return total_kb / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test a running server: CONCURRENCY clients request URL for DURATION '
+        'seconds and the requests/second and latency percentiles are reported. '
+        'Pass --server-pid (the gunicorn master) to also report its peak memory, '
+        'e.g. to compare SERVER_MODE=wsgi and SERVER_MODE=asgi at the same worker count.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='?', default='http://127.0.0.1:8000/')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--duration', type=float, default=20)
+        parser.add_argument('--server-pid', type=int)
+
+    def handle(self, *args, **options):
+        deadline = time.monotonic() + options['duration']
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def client():
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(options['url'], timeout=30) as response:
+                        response.read()
+                except (urllib.error.URLError, OSError) as error:
+                    with lock:
+                        errors.append(error)
+                    continue
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+        peak_rss = 0
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            for _ in range(options['concurrency']):
+                pool.submit(client)
+            while options['server_pid'] and time.monotonic() < deadline:
+                peak_rss = max(peak_rss, server_rss_mb(options['server_pid']))
+                time.sleep(0.5)
+
+        if not latencies:
+            self.stderr.write(f'No successful requests ({len(errors)} errors)')
+            return
+        self.stdout.write(
+            f"{options['url']}  concurrency={options['concurrency']}  "
+            f"rps={len(latencies) / options['duration']:.1f}  errors={len(errors)}"
+        )
+        self.stdout.write(
+            f'  p50={percentile(latencies, 50):.1f}ms  p99={percentile(latencies, 99):.1f}ms  '
+            f'mean={statistics.mean(latencies):.1f}ms'
+            + (f'  server_peak_rss={peak_rss:.0f}MB' if peak_rss else '')
+        )
@@ -0,0 +1,77 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Value
+from django.db.models.functions import Greatest
+
+from rides.models import SEAT_HOLDING_STATUSES, Rides, RideRequest
+from rides.tasks import queue_search_invalidation
+
+
+def reconcile_seats(batch_size=5000, repair=True):
+    """
+    Recompute every ride's ``seats_booked`` from its requests and repair the
+    rides whose counter drifted. Returns ``[(ride_id, counter, counted)]``
+    for the drifted rides.
+
+    One pass over the rides in id order, in batches: each batch locks its
+    rides (bookings update the ride row before their request, so none can
+    be half done inside the batch) and sums their requests with a single
+    ``GROUP BY`` over the ride id range, served by the ride foreign key
+    index.
+    """
+    drifted = []
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                Rides.objects.select_for_update().filter(id__gt=last_id)
+                .order_by('id').only('id', 'origin', 'destination', 'seats_booked')[:batch_size]
+            )
+            if not batch:
+                return drifted
+            counted = dict(
+                RideRequest.objects.filter(
+                    ride_id__gte=batch[0].id, ride_id__lte=batch[-1].id, status__in=SEAT_HOLDING_STATUSES,
+                ).order_by().values_list('ride_id').annotate(Sum('seats_requested'))
+            )
+            changed = []
+            places = set()
+            by_count = defaultdict(list)
+            for ride in batch:
+                seats = counted.get(ride.id, 0)
+                if ride.seats_booked != seats:
+                    changed.append((ride.id, ride.seats_booked, seats))
+                    places.add((ride.origin, ride.destination))
+                    by_count[seats].append(ride.id)
+            if repair and changed:
+                # A counter only takes a few values: one UPDATE per value
+                # is much cheaper than bulk_update's CASE over every row. A
+                # ride booked beyond its seats offers as many as are booked
+                for seats, ids in by_count.items():
+                    Rides.objects.filter(id__in=ids).update(
+                        seats_booked=seats, seats_offered=Greatest('seats_offered', Value(seats)),
+                    )
+                queue_search_invalidation(*places)
+        drifted += changed
+        last_id = batch[-1].id
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the rides' booked-seat counters from their pending, accepted "
+        'and completed requests and repair any that drifted. Safe to run while '
+        'the site takes bookings.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without repairing it')
+
+    def handle(self, *args, **options):
+        drifted = reconcile_seats(batch_size=options['batch_size'], repair=not options['dry_run'])
+        for ride_id, counter, counted in drifted:
+            self.stdout.write(f'Ride {ride_id}: seats_booked {counter} -> {counted}')
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(drifted)} drifted ride(s)'))
@@ -0,0 +1,129 @@
+import random
+from datetime import datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from rides.models import SEAT_HOLDING_STATUSES, Rides, RideRequest, geocode_rides
+
+# Generated users are named bench_<n>, so they (and, by cascade, their rides
+# and requests) can be told apart from real accounts and flushed.
+USERNAME_PREFIX = 'bench_'
+
+# Places rides run between, weighted roughly by population and by how often
+# people need to get there (Truro and Plymouth have the hospitals).
+PLACES = [
+    ('Truro', 30), ('Plymouth', 25), ('Falmouth', 22), ('Penzance', 21),
+    ('Camborne', 20), ('Newquay', 20), ('St Austell', 20), ('Redruth', 15),
+    ('Bodmin', 15), ('Saltash', 15), ('Helston', 12), ('St Ives', 11),
+    ('Liskeard', 10), ('Launceston', 9), ('Bude', 9), ('Hayle', 8),
+    ('Torpoint', 8), ('Penryn', 7), ('Wadebridge', 6), ('Callington', 5),
+    ('Looe', 5), ('Perranporth', 4), ('Padstow', 3), ('Fowey', 2),
+    ('Mevagissey', 2), ('St Just', 2), ('Porthleven', 2), ('Mousehole', 1),
+]
+PLACE_NAMES = [name for name, _ in PLACES]
+PLACE_WEIGHTS = [weight for _, weight in PLACES]
+
+# Departure hours, peaking for the morning appointments and the trip home
+DEPARTURE_HOURS = list(range(6, 22))
+DEPARTURE_WEIGHTS = [2, 6, 10, 12, 8, 6, 5, 5, 5, 6, 8, 10, 7, 4, 3, 2]
+
+RIDE_STATUS_WEIGHTS = {'1': 80, '0': 15, '2': 5}
+REQUEST_STATUS_WEIGHTS = {'0': 45, '1': 40, '2': 10, '3': 5}
+
+
+@transaction.atomic
+def generate_data(users, rides, requests, seed=0, days=60, batch_size=1000):
+    """
+    Create ``users`` users, ``rides`` rides and up to ``requests`` ride
+    requests with a realistic spread of places, departure times and statuses.
+
+    The same ``seed`` always produces the same data relative to today, so
+    benchmark runs on different days still compare like with like. About a
+    tenth of the rides are in the past. Seat counts stay consistent: pending
+    and accepted requests count towards the ride's booked seats.
+
+    Returns ``(users, rides, ride_requests)`` as created.
+    """
+    rng = random.Random(seed)
+    today = timezone.make_aware(datetime.combine(timezone.localdate(), time()))
+    first = User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+    user_objs = User.objects.bulk_create(
+        [User(username=f'{USERNAME_PREFIX}{n}', password='!') for n in range(first, first + users)],
+        batch_size=batch_size,
+    )
+
+    ride_objs = []
+    for _ in range(rides):
+        origin = rng.choices(PLACE_NAMES, PLACE_WEIGHTS)[0]
+        destination = origin
+        while destination == origin:
+            destination = rng.choices(PLACE_NAMES, PLACE_WEIGHTS)[0]
+        hour = rng.choices(DEPARTURE_HOURS, DEPARTURE_WEIGHTS)[0]
+        ride_objs.append(Rides(
+            driver=rng.choice(user_objs),
+            origin=origin,
+            destination=destination,
+            date=today + timedelta(
+                days=rng.randint(-days // 10, days), hours=hour, minutes=rng.choice((0, 15, 30, 45)),
+            ),
+            seats_offered=rng.randint(1, 4),
+            pickup_notes='',
+            status=rng.choices(list(RIDE_STATUS_WEIGHTS), list(RIDE_STATUS_WEIGHTS.values()))[0],
+        ))
+
+    geocode_rides(ride_objs)  # bulk_create skips Rides.save()
+    ride_objs = Rides.objects.bulk_create(ride_objs, batch_size=batch_size)
+    bookable = [ride for ride in ride_objs if ride.status == '1']
+    request_objs = []
+    booked = set()
+    changed = {}
+    for _ in range(requests * 3 if bookable else 0):
+        if len(request_objs) >= requests:
+            break
+        ride = rng.choice(bookable)
+        passenger = rng.choice(user_objs)
+        if passenger.pk == ride.driver_id or (passenger.pk, ride.pk) in booked or not ride.seats_available:
+            continue
+        status = rng.choices(list(REQUEST_STATUS_WEIGHTS), list(REQUEST_STATUS_WEIGHTS.values()))[0]
+        seats = rng.randint(1, min(2, ride.seats_available))
+        if status in SEAT_HOLDING_STATUSES:
+            ride.seats_booked += seats
+            changed[ride.pk] = ride
+        booked.add((passenger.pk, ride.pk))
+        request_objs.append(RideRequest(
+            passenger=passenger, ride=ride, seats_requested=seats, status=status,
+        ))
+    request_objs = RideRequest.objects.bulk_create(request_objs, batch_size=batch_size)
+    Rides.objects.bulk_update(changed.values(), ['seats_booked'], batch_size=batch_size)
+    return user_objs, ride_objs, request_objs
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed users, rides and ride requests for benchmarking and load testing, '
+        'e.g. ./manage.py seed_data --users 2000 --rides 20000 --requests 30000. '
+        'Generated users are prefixed bench_; --flush removes them and their data first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rides', type=int, default=5000)
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--days', type=int, default=60, help='Spread ride dates over this many days')
+        parser.add_argument('--flush', action='store_true', help='Delete previously generated data first')
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            deleted, _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+            self.stdout.write(f'Deleted {deleted} generated rows')
+        users, rides, ride_requests = generate_data(
+            options['users'], options['rides'], options['requests'],
+            seed=options['seed'], days=options['days'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(users)} users, {len(rides)} rides and {len(ride_requests)} ride requests'
+        ))
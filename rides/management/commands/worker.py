@@ -0,0 +1,64 @@
+import signal
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils.module_loading import autodiscover_modules
+
+from rides.models import Task
+from rides.queue import claim_tasks, requeue_failed, run_task
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background tasks. Start as many worker processes as the '
+        'load needs (e.g. scale the Procfile worker); they share the queue '
+        'safely. --once runs whatever is due and exits, e.g. from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due tasks, then exit')
+        parser.add_argument('--batch-size', type=int, default=10, help='Tasks claimed at a time')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--lease', type=int, default=300,
+                            help='Seconds a claimed task is held before another worker may retry it')
+        parser.add_argument('--max-tasks', type=int, help='Exit after running this many tasks')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Queue failed tasks again with fresh attempts, then exit')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            self.stdout.write(f'Queued {requeue_failed(Task.objects.all())} failed task(s) again')
+            return
+
+        autodiscover_modules('tasks')
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        lease = timedelta(seconds=options['lease'])
+        succeeded = failed = 0
+        while not self.stopping:
+            # Long-lived process: drop connections past CONN_MAX_AGE or broken
+            close_old_connections()
+            limit = options['max_tasks']
+            size = options['batch_size'] if limit is None else min(options['batch_size'], limit - succeeded - failed)
+            tasks = claim_tasks(size, lease) if size > 0 else []
+            for claimed in tasks:
+                # Finish the batch when stopping: its tasks are claimed
+                if run_task(claimed):
+                    succeeded += 1
+                else:
+                    failed += 1
+                    self.stderr.write(f'Task {claimed.pk} ({claimed.name}) failed, attempt {claimed.attempts}')
+            if limit is not None and succeeded + failed >= limit:
+                break
+            if not tasks:
+                if options['once']:
+                    break
+                time.sleep(options['poll'])
+        close_old_connections()
+        self.stdout.write(f'Ran {succeeded + failed} task(s): {succeeded} succeeded, {failed} failed')
+
+    def stop(self, signum, frame):
+        self.stopping = True
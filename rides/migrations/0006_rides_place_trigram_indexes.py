@@ -0,0 +1,41 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Trigram GIN indexes for ride search. The UPPER(...) indexes serve the
+# `icontains` filter (Django renders it as UPPER(col::text) LIKE UPPER(%s)),
+# the plain ones serve the `trigram_word_similar` fuzzy match.
+PLACE_FIELDS = ('origin', 'destination')
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for field in PLACE_FIELDS:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS rides_rides_{field}_trgm '
+            f'ON rides_rides USING gin ({field} gin_trgm_ops)'
+        )
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS rides_rides_{field}_upper_trgm '
+            f'ON rides_rides USING gin ((UPPER({field}::text)) gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for field in PLACE_FIELDS:
+        schema_editor.execute(f'DROP INDEX IF EXISTS rides_rides_{field}_trgm')
+        schema_editor.execute(f'DROP INDEX IF EXISTS rides_rides_{field}_upper_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0005_alter_riderequest_seats_requested_and_more'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
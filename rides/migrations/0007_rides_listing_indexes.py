@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-18 20:26
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0006_rides_place_trigram_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(condition=models.Q(('seats_available__gt', 0), ('status', '1')), fields=['date', 'id'], name='rides_bookable_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(fields=['driver', '-date'], name='rides_driver_date_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.11 on 2026-10-18 20:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0007_rides_listing_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('search_name', models.CharField(max_length=100, unique=True)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('geohash', models.CharField(max_length=12)),
+                ('population', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='destination_geohash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='destination_latitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='destination_longitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='origin_geohash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='origin_latitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='origin_longitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(condition=models.Q(('seats_available__gt', 0), ('status', '1')), fields=['origin_geohash'], name='rides_bookable_origin_geo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(condition=models.Q(('seats_available__gt', 0), ('status', '1')), fields=['destination_geohash'], name='rides_bookable_dest_geo_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+import csv
+from pathlib import Path
+
+from django.db import migrations
+
+# Frozen copies of the bundled gazetteer's format and of rides.geo's
+# geohash, so later changes to the import command or the models can't
+# change what this migration does
+GAZETTEER = Path(__file__).resolve().parents[1] / 'data' / 'cornwall_places.csv'
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 6
+
+
+def encode_geohash(latitude, longitude):
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < GEOHASH_PRECISION:
+        coordinate, interval = (longitude, lng_range) if even else (latitude, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+def read_places():
+    """``(names, latitude, longitude, population)`` for each row of the bundled CSV."""
+    with open(GAZETTEER, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            names = [row['name'], *(row.get('alternate_names') or '').split('|')]
+            names = [name.strip() for name in names if name.strip()]
+            if names:
+                yield names, float(row['latitude']), float(row['longitude']), int(row.get('population') or 0)
+
+
+def load_places(apps, schema_editor):
+    """Seed the gazetteer with the bundled Cornwall places, one row per name."""
+    Place = apps.get_model('rides', 'Place')
+    places = {}
+    for names, latitude, longitude, population in read_places():
+        for name in names:
+            key = ' '.join(name.split()).casefold()
+            if key not in places or population > places[key].population:
+                places[key] = Place(
+                    name=names[0], search_name=key, latitude=latitude, longitude=longitude,
+                    geohash=encode_geohash(latitude, longitude), population=population,
+                )
+    Place.objects.bulk_create(places.values(), ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0008_rides_locations_place'),
+    ]
+
+    operations = [
+        migrations.RunPython(load_places, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest, Least
+
+# Statuses whose requests hold seats (models.SEAT_HOLDING_STATUSES)
+SEAT_HOLDING_STATUSES = ('0', '1', '4')
+MAX_SEATS = 4
+BOOKABLE_INDEXES = (
+    ('rides_bookable_date_idx', ['date', 'id']),
+    ('rides_bookable_origin_geo_idx', ['origin_geohash']),
+    ('rides_bookable_dest_geo_idx', ['destination_geohash']),
+)
+
+
+def seats_of(RideRequest, **filters):
+    return Coalesce(Subquery(
+        RideRequest.objects.filter(ride=OuterRef('pk'), **filters)
+        .order_by().values('ride').annotate(total=Sum('seats_requested')).values('total')
+    ), 0)
+
+
+def split_seat_counts(apps, schema_editor):
+    """
+    Recover each ride's capacity from its remaining seats. Every request
+    took its seats when made, and only deleting it gave them back, so the
+    capacity is what's left plus all requests' seats. Booked seats are now
+    only those of pending, accepted and completed requests: rejected and
+    cancelled requests give theirs back.
+    """
+    Rides = apps.get_model('rides', 'Rides')
+    RideRequest = apps.get_model('rides', 'RideRequest')
+    Rides.objects.update(
+        seats_offered=F('seats_offered') + seats_of(RideRequest),
+        seats_booked=seats_of(RideRequest, status__in=SEAT_HOLDING_STATUSES),
+    )
+    Rides.objects.update(seats_offered=Greatest(Least(F('seats_offered'), MAX_SEATS), F('seats_booked')))
+
+
+def merge_seat_counts(apps, schema_editor):
+    Rides = apps.get_model('rides', 'Rides')
+    Rides.objects.update(seats_offered=F('seats_offered') - F('seats_booked'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0009_load_cornwall_places'),
+    ]
+
+    operations = [
+        *[
+            migrations.RemoveIndex(model_name='rides', name=name)
+            for name, _ in BOOKABLE_INDEXES
+        ],
+        migrations.RenameField(
+            model_name='rides',
+            old_name='seats_available',
+            new_name='seats_offered',
+        ),
+        migrations.AddField(
+            model_name='rides',
+            name='seats_booked',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        # Indexes before the data: Postgres won't build an index on a table
+        # with pending foreign key checks from an UPDATE in the same transaction
+        *[
+            migrations.AddIndex(
+                model_name='rides',
+                index=models.Index(
+                    condition=models.Q(('seats_booked__lt', F('seats_offered')), ('status', '1')),
+                    fields=fields,
+                    name=name,
+                ),
+            )
+            for name, fields in BOOKABLE_INDEXES
+        ],
+        migrations.RunPython(split_seat_counts, merge_seat_counts),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.11 on 2026-10-18 21:14
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0010_rides_seat_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('payload', models.JSONField(default=dict)),
+                ('dedupe_key', models.CharField(blank=True, max_length=100, null=True)),
+                ('status', models.CharField(choices=[('0', 'Pending'), ('1', 'Running'), ('2', 'Failed')], default='0', max_length=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, max_length=32)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['run_after'],
+                'indexes': [models.Index(condition=models.Q(('status', '0')), fields=['run_after'], name='task_due_idx'), models.Index(condition=models.Q(('status', '1')), fields=['locked_until'], name='task_lease_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', '0')), fields=('dedupe_key',), name='task_pending_dedupe_key')],
+            },
+        ),
+    ]
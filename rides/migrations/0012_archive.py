@@ -0,0 +1,57 @@
+# Generated by Django 5.2.11 on 2026-10-18 21:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0011_task'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='riderequest',
+            name='status',
+            field=models.CharField(choices=[('0', 'Pending'), ('1', 'Accepted'), ('2', 'Rejected'), ('3', 'Cancelled'), ('4', 'Completed'), ('5', 'Expired')], default='0', max_length=1),
+        ),
+        migrations.CreateModel(
+            name='ArchivedRide',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('origin', models.CharField(max_length=100)),
+                ('destination', models.CharField(max_length=100)),
+                ('date', models.DateTimeField()),
+                ('seats_offered', models.IntegerField()),
+                ('seats_booked', models.IntegerField()),
+                ('pickup_notes', models.TextField()),
+                ('status', models.CharField(choices=[('0', 'Draft'), ('1', 'Published'), ('2', 'Cancelled')], max_length=1)),
+                ('created_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField()),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_rides', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedRideRequest',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('ride_id', models.BigIntegerField(db_index=True)),
+                ('seats_requested', models.IntegerField()),
+                ('status', models.CharField(choices=[('0', 'Pending'), ('1', 'Accepted'), ('2', 'Rejected'), ('3', 'Cancelled'), ('4', 'Completed'), ('5', 'Expired')], max_length=1)),
+                ('created_on', models.DateTimeField()),
+                ('updated_on', models.DateTimeField()),
+                ('archived_on', models.DateTimeField(auto_now_add=True)),
+                ('passenger', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_ride_requests', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_on'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-18 21:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0012_archive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='riderequest',
+            index=models.Index(fields=['created_on', 'id'], name='riderequest_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(fields=['date', 'id'], name='rides_date_idx'),
+        ),
+    ]
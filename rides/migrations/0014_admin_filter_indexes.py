@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-18 22:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0013_admin_list_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='riderequest',
+            index=models.Index(fields=['status', 'created_on', 'id'], name='riderequest_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rides',
+            index=models.Index(fields=['status', 'date', 'id'], name='rides_status_date_idx'),
+        ),
+    ]
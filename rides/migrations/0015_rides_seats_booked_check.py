@@ -0,0 +1,30 @@
+# Generated by Django 5.2.11 on 2026-10-18 22:08
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+def fit_seats_offered(apps, schema_editor):
+    """Offer at least as many seats as are booked on rides edited below that."""
+    Rides = apps.get_model('rides', 'Rides')
+    Rides.objects.filter(seats_booked__gt=F('seats_offered')).update(
+        seats_offered=Greatest(F('seats_offered'), F('seats_booked')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rides', '0014_admin_filter_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(fit_seats_offered, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='rides',
+            constraint=models.CheckConstraint(condition=models.Q(('seats_booked__lte', models.F('seats_offered'))), name='rides_seats_booked_lte_offered'),
+        ),
+    ]
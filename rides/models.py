@@ -1,10 +1,17 @@
-from django.db import models
+import hashlib
+
+from django.db import models, connection
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce, Sqrt
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from cloudinary.models import CloudinaryField
 
+from .geo import covering_cells, encode_geohash, geohash_prefix_filter, squared_distance_km
+
 SEATS_AVAILABLE = (
     (1, '1 seat'),
     (2, '2 seats'),
@@ -18,34 +25,247 @@ REQUEST_STATUS = (('0', 'Pending'),
                   ('1', 'Accepted'),
                   ('2', 'Rejected'),
                   ('3', 'Cancelled'),
-                  ('4', 'Completed'),)
+                  ('4', 'Completed'),
+                  ('5', 'Expired'),)  # still pending when the ride left
+# Requests whose seats count as booked on the ride
+SEAT_HOLDING_STATUSES = ('0', '1', '4')
+
+TASK_STATUS = (('0', 'Pending'), ('1', 'Running'), ('2', 'Failed'))
+
+FUTURE_DATE_ERROR = 'Ride date must be in the future.'
+SAME_PLACE_ERROR = 'Origin (pick up) and destination (drop off) must be different.'
 
 def validate_future_date(value):
     """Ensure ride date is in the future."""
     if value < timezone.now():
-        raise ValidationError('Ride date must be in the future.')
+        raise ValidationError(FUTURE_DATE_ERROR)
+
+def is_same_place(origin, destination):
+    """True if a ride would start and end at the same place."""
+    return bool(origin and destination and origin.lower() == destination.lower())
+
+def normalize_place(value):
+    """Collapse whitespace in a place name so search terms compare consistently."""
+    return ' '.join(value.split())
+
+def place_key(value):
+    """Gazetteer lookup key for a place name: normalised and case-folded."""
+    return normalize_place(value).casefold()
 
 class RidesQuerySet(models.QuerySet):
     """Custom QuerySet for Rides."""
     
-    def apply_search_filters(self, form):
-        """Apply search filters from form to queryset."""
+    def apply_search_filters(self, form, places=None):
+        """
+        Apply search filters from form to queryset.
+
+        Origins and destinations found in the gazetteer are matched by
+        distance (see ``near_place``), others by their text. ``places`` maps
+        search terms to ``Place`` objects; pass it from async code, where
+        the lookup can't run here (see ``PlaceQuerySet.aresolve``).
+        """
         if not form.is_valid():
             return self
-        
+
+        terms = {
+            field: normalize_place(form.cleaned_data.get(field) or '')
+            for field in ('origin', 'destination')
+        }
+        if places is None:
+            places = Place.objects.resolve(*terms.values())
+
         queryset = self
-        
-        if form.cleaned_data.get('origin'):
-            queryset = queryset.filter(origin__icontains=form.cleaned_data['origin'])
-        if form.cleaned_data.get('destination'):
-            queryset = queryset.filter(destination__icontains=form.cleaned_data['destination'])
+        detours = []
+        for field, term in terms.items():
+            place = places.get(place_key(term))
+            if place:
+                radius = form.cleaned_data.get(f'{field}_radius') or settings.RIDES_SEARCH_RADIUS_KM
+                queryset = queryset.near_place(field, term, place, radius)
+                detours.append(Sqrt(f'{field}_km2'))
+                terms[field] = None
+        queryset = queryset.search_places(**terms)
+        if detours:
+            # How far off the passenger's own route the pick-up and drop-off are
+            queryset = queryset.annotate(detour_km=sum(detours[1:], detours[0]))
+
         if form.cleaned_data.get('date'):
             queryset = queryset.filter(date__date=form.cleaned_data['date'])
         if form.cleaned_data.get('min_passengers'):
-            queryset = queryset.filter(seats_available__gte=form.cleaned_data['min_passengers'])
-        
+            queryset = queryset.with_seats_left(form.cleaned_data['min_passengers'])
+
+        return queryset
+
+    def near_place(self, field, term, place, radius_km):
+        """
+        Keep rides whose ``field`` (origin or destination) is within
+        ``radius_km`` of ``place``, with the squared distance as ``<field>_km2``.
+
+        The geohash prefix ranges are served by the ``*_geohash`` indexes and
+        cut the candidates down to a few cells around the place; the exact
+        distance check then runs on those alone. Rides whose place couldn't
+        be located (empty geohash) still match on the text of ``term``.
+        """
+        distance = f'{field}_km2'
+        queryset = self.alias(**{
+            distance: Coalesce(
+                squared_distance_km(f'{field}_latitude', f'{field}_longitude', place.latitude, place.longitude),
+                Value(0.0),
+            ),
+        })
+        nearby = geohash_prefix_filter(
+            f'{field}_geohash', covering_cells(place.latitude, place.longitude, radius_km),
+        ) & Q(**{f'{distance}__lte': radius_km ** 2})
+        unlocated = Q(**{f'{field}_geohash': '', f'{field}__icontains': term})
+        return queryset.filter(nearby | unlocated)
+
+    def search_places(self, origin=None, destination=None):
+        """
+        Match origin and destination by substring, prefix or (on Postgres)
+        trigram similarity, and annotate ``search_rank`` with the match quality
+        when either term is given.
+
+        On Postgres both lookups are served by the trigram GIN indexes from
+        migration 0006. Other backends (SQLite in dev) fall back to plain
+        case-insensitive substring matching with the same ranking.
+        """
+        queryset = self
+        ranks = []
+        for field, term in (('origin', origin), ('destination', destination)):
+            term = normalize_place(term or '')
+            if not term:
+                continue
+            match = Q(**{f'{field}__icontains': term})
+            if connection.vendor == 'postgresql':
+                match |= Q(**{f'{field}__trigram_word_similar': term})
+            queryset = queryset.filter(match)
+            ranks.append(place_match_rank(field, term))
+
+        if not ranks:
+            return queryset
+        return queryset.annotate(search_rank=sum(ranks[1:], ranks[0]))
+
+    def with_seats_left(self, seats=1):
+        """
+        Keep rides with at least ``seats`` seats not yet booked. The first
+        condition is the one the ``rides_bookable_*`` partial indexes are
+        built on, so it's always applied as is.
+        """
+        queryset = self.filter(seats_booked__lt=F('seats_offered'))
+        if seats > 1:
+            queryset = queryset.filter(seats_booked__lte=F('seats_offered') - seats)
         return queryset
 
+    def with_driver(self):
+        """Load each ride's driver and driver profile in the same query."""
+        return self.select_related('driver', 'driver__profile')
+
+    def search_order_keys(self):
+        """
+        Keyset ordering for search results as ``(field, descending)`` pairs:
+        shortest detour first when a proximity search ran, then best text
+        match when a text search ran, then soonest first. Unranked listings
+        order by ``(date, id)`` alone so the bookable-rides index can serve
+        the ordering without a sort.
+        """
+        keys = [('date', False), ('id', False)]
+        if 'search_rank' in self.query.annotations:
+            keys.insert(0, ('search_rank', True))
+        if 'detour_km' in self.query.annotations:
+            keys.insert(0, ('detour_km', False))
+        return keys
+
+
+def place_match_rank(field, term):
+    """
+    Score how well ``field`` matches ``term``:
+    3 = exact, 2 = prefix, 1 = substring, 0 = fuzzy (trigram only).
+    """
+    return Case(
+        When(**{f'{field}__iexact': term}, then=Value(3)),
+        When(**{f'{field}__istartswith': term}, then=Value(2)),
+        When(**{f'{field}__icontains': term}, then=Value(1)),
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+class PlaceQuerySet(models.QuerySet):
+    """Custom QuerySet for Place."""
+
+    def resolve(self, *names):
+        """Look up place names in one query, returning ``{place_key: Place}``."""
+        keys = {place_key(name) for name in names if name and name.strip()}
+        if not keys:
+            return {}
+        return {place.search_name: place for place in self.filter(search_name__in=keys)}
+
+    async def aresolve(self, *names):
+        """Async ``resolve``, for the async views."""
+        keys = {place_key(name) for name in names if name and name.strip()}
+        if not keys:
+            return {}
+        return {place.search_name: place async for place in self.filter(search_name__in=keys)}
+
+
+class Place(models.Model):
+    """
+    A gazetteer entry: a place name (or one of its alternate names) and
+    its coordinates. Loaded with the import_places command, and used to
+    locate rides and searches so they can be matched by distance.
+    """
+    name = models.CharField(max_length=100)
+    search_name = models.CharField(max_length=100, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    geohash = models.CharField(max_length=12)
+    population = models.PositiveIntegerField(default=0)
+
+    objects = PlaceQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['name']
+
+    def save(self, *args, **kwargs):
+        self.search_name = place_key(self.search_name or self.name)
+        self.geohash = encode_geohash(self.latitude, self.longitude)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.name} ({self.latitude:.4f}, {self.longitude:.4f})"
+
+
+def geocode_rides(rides, places=None):
+    """
+    Set the coordinates and geohash of each ride's origin and destination
+    from the gazetteer, in one lookup for all of them. Places not in the
+    gazetteer are cleared, so those rides fall back to text matching.
+    Returns the rides whose location changed.
+    """
+    if places is None:
+        places = Place.objects.resolve(*{name for ride in rides for name in (ride.origin, ride.destination)})
+    changed = []
+    for ride in rides:
+        before = ride.location_values()
+        for field in ('origin', 'destination'):
+            place = places.get(place_key(getattr(ride, field) or ''))
+            setattr(ride, f'{field}_latitude', place.latitude if place else None)
+            setattr(ride, f'{field}_longitude', place.longitude if place else None)
+            setattr(ride, f'{field}_geohash', place.geohash if place else '')
+        if ride.location_values() != before:
+            changed.append(ride)
+    return changed
+
+def driver_version(username, first_name, last_name, picture):
+    """
+    A short digest of what a ride shows of its driver: their name and the
+    upload behind their avatar (``picture`` is a ``CloudinaryField`` value,
+    or None), for keying the cached ride cards and ride_detail's ETag.
+    """
+    public_id = getattr(picture, 'public_id', picture)
+    version = getattr(picture, 'version', None)
+    parts = (username, first_name, last_name, public_id, version)
+    return hashlib.md5('\0'.join(str(part) for part in parts).encode()).hexdigest()[:12]
+
 # Create your models here.
 class Rides(models.Model):
     """
@@ -55,28 +275,124 @@ class Rides(models.Model):
     origin = models.CharField(max_length=100)
     destination = models.CharField(max_length=100)
     date = models.DateTimeField(validators=[validate_future_date])
-    seats_available = models.IntegerField(choices=SEATS_AVAILABLE, default=1)
+    # Seats the driver offers, and how many of them pending, accepted and
+    # completed requests hold. The counter is kept in step with the requests
+    # by the functions in services.py; reconcile_seats repairs any drift.
+    seats_offered = models.IntegerField(choices=SEATS_AVAILABLE, default=1)
+    seats_booked = models.IntegerField(default=0, editable=False)
     pickup_notes = models.TextField()
     status = models.CharField(max_length=1, choices=RIDES_STATUS, default='0')
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
+    # Located from the gazetteer on save (see geocode_rides); empty geohash
+    # and no coordinates when the place isn't in it
+    origin_latitude = models.FloatField(null=True, blank=True, editable=False)
+    origin_longitude = models.FloatField(null=True, blank=True, editable=False)
+    origin_geohash = models.CharField(max_length=12, blank=True, default='', editable=False)
+    destination_latitude = models.FloatField(null=True, blank=True, editable=False)
+    destination_longitude = models.FloatField(null=True, blank=True, editable=False)
+    destination_geohash = models.CharField(max_length=12, blank=True, default='', editable=False)
     
     objects = RidesQuerySet.as_manager()
+
+    LOCATION_FIELDS = (
+        'origin_latitude', 'origin_longitude', 'origin_geohash',
+        'destination_latitude', 'destination_longitude', 'destination_geohash',
+    )
+    # driver_version's arguments, as lookups from a ride
+    DRIVER_VERSION_FIELDS = (
+        'driver__username', 'driver__first_name', 'driver__last_name', 'driver__profile__profile_picture',
+    )
+
+    @property
+    def seats_available(self):
+        """Seats still free to book."""
+        return self.seats_offered - self.seats_booked
+
+    @property
+    def driver_version(self):
+        """``driver_version`` of this ride's driver; load them ``with_driver()``."""
+        driver = self.driver
+        profile = getattr(driver, 'profile', None)
+        return driver_version(driver.username, driver.first_name, driver.last_name, profile and profile.profile_picture)
+
+    def location_values(self):
+        return tuple(getattr(self, field) for field in self.LOCATION_FIELDS)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'origin', 'destination'} & set(update_fields):
+            geocode_rides([self])
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *self.LOCATION_FIELDS}
+        if update_fields is None and not self._state.adding:
+            # Never write back a counter that was read before a booking
+            # changed it; only the services adjust seats_booked, in place
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'seats_booked'
+            ]
+        super().save(*args, **kwargs)
     
     def clean(self):
         """Model-level validation."""
         super().clean()
-        if self.origin and self.destination and self.origin.lower() == self.destination.lower():
-            raise ValidationError('Origin (pick up) and destination (drop off) must be different.')
+        if is_same_place(self.origin, self.destination):
+            raise ValidationError(SAME_PLACE_ERROR)
+        # Against the counter as loaded; forms that save the ride refresh
+        # it under a lock first (see services.lock_seat_counts)
+        if self.seats_offered is not None and self.seats_offered < self.seats_booked:
+            raise ValidationError({
+                'seats_offered': f'{self.seats_booked} seats are already booked on this ride.',
+            })
         
     class Meta:
         ordering = ['-created_on']
         verbose_name_plural = 'Rides' # ensures the plural form is correct in the admin interface
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(seats_booked__lte=F('seats_offered')), name='rides_seats_booked_lte_offered',
+            ),
+        ]
+        indexes = [
+            # search_rides: published rides with seats left, soonest first
+            models.Index(
+                fields=['date', 'id'],
+                condition=Q(status='1', seats_booked__lt=F('seats_offered')),
+                name='rides_bookable_date_idx',
+            ),
+            # my_rides: a driver's rides, latest first
+            models.Index(fields=['driver', '-date'], name='rides_driver_date_idx'),
+            # admin changelist and date hierarchy, archive_rides
+            models.Index(fields=['date', 'id'], name='rides_date_idx'),
+            # admin changelist filtered by status, latest first
+            models.Index(fields=['status', 'date', 'id'], name='rides_status_date_idx'),
+            # search_rides by distance: geohash prefix ranges around the
+            # searched origin/destination, bookable rides only
+            models.Index(
+                fields=['origin_geohash'],
+                condition=Q(status='1', seats_booked__lt=F('seats_offered')),
+                name='rides_bookable_origin_geo_idx',
+            ),
+            models.Index(
+                fields=['destination_geohash'],
+                condition=Q(status='1', seats_booked__lt=F('seats_offered')),
+                name='rides_bookable_dest_geo_idx',
+            ),
+        ]
 
     def __str__(self):
         date_str = self.date.strftime('%Y-%m-%d %H:%M') if self.date else 'TBD'
         return f"{self.origin} to {self.destination} on {date_str} - {self.seats_available} seats"
     
+class RideRequestQuerySet(models.QuerySet):
+    """Custom QuerySet for RideRequest."""
+
+    def with_ride(self):
+        """Load the passenger, ride, driver and driver profile in the same query."""
+        return self.select_related('passenger', 'ride__driver__profile')
+
+
 class RideRequest(models.Model):
     """
     Stores a ride request entry related to :model:'auth.User' and :model:'Rides'.
@@ -88,13 +404,75 @@ class RideRequest(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
 
+    objects = RideRequestQuerySet.as_manager()
+
+    @property
+    def seats_held(self):
+        """Seats this request counts towards the ride's ``seats_booked``."""
+        return self.seats_requested if self.status in SEAT_HOLDING_STATUSES else 0
+
     class Meta:
+        # Also the composite index behind my_ride_requests (passenger, then ride for the join)
         unique_together = ('passenger', 'ride')
         ordering = ['-created_on']
+        indexes = [
+            # admin changelist and date hierarchy, newest first
+            models.Index(fields=['created_on', 'id'], name='riderequest_created_idx'),
+            # admin changelist filtered by status, newest first
+            models.Index(fields=['status', 'created_on', 'id'], name='riderequest_status_idx'),
+        ]
 
     def __str__(self):
         return f"Ride ID:{self.ride.id} | RideRequest by {self.passenger.username} for ride from {self.ride.origin} to {self.ride.destination} - Status: {self.get_status_display()}"
     
+class ArchivedRide(models.Model):
+    """
+    A ride moved out of :model:`rides.Rides` some time after it departed
+    (see the ``archive_rides`` command), keeping its original id.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    driver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_rides')
+    origin = models.CharField(max_length=100)
+    destination = models.CharField(max_length=100)
+    date = models.DateTimeField()
+    seats_offered = models.IntegerField()
+    seats_booked = models.IntegerField()
+    pickup_notes = models.TextField()
+    status = models.CharField(max_length=1, choices=RIDES_STATUS)
+    created_on = models.DateTimeField()
+    updated_on = models.DateTimeField()
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"{self.origin} to {self.destination} on {self.date:%Y-%m-%d %H:%M} (archived)"
+
+
+class ArchivedRideRequest(models.Model):
+    """
+    A ride request moved out of :model:`rides.RideRequest`, with its ride
+    or once it was closed (rejected, cancelled or expired) long enough ago.
+    ``ride_id`` points at an :model:`rides.ArchivedRide` or, for a closed
+    request, possibly a ride still in :model:`rides.Rides`.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    passenger = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_ride_requests')
+    ride_id = models.BigIntegerField(db_index=True)
+    seats_requested = models.IntegerField()
+    status = models.CharField(max_length=1, choices=REQUEST_STATUS)
+    created_on = models.DateTimeField()
+    updated_on = models.DateTimeField()
+    archived_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_on']
+
+    def __str__(self):
+        return f"Archived request {self.id} for ride {self.ride_id} - Status: {self.get_status_display()}"
+
+
 class UserProfile(models.Model):
     """
     Stores additional user information related to :model:'auth.User'.
@@ -110,4 +488,43 @@ class UserProfile(models.Model):
         ordering = ['user__last_name', 'user__first_name']  # Last name, then first name
 
     def __str__(self):
-        return f"Profile of {self.user.first_name} {self.user.last_name}"
\ No newline at end of file
+        return f"Profile of {self.user.first_name} {self.user.last_name}"
+
+
+class Task(models.Model):
+    """
+    A queued call to a background task (see ``rides.queue``), run by
+    ``./manage.py worker``. Finished tasks are deleted; failed ones stay
+    for inspection.
+    """
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # At most one pending task per key: queueing the same work again while
+    # it waits is a no-op
+    dedupe_key = models.CharField(max_length=100, null=True, blank=True)
+    status = models.CharField(max_length=1, choices=TASK_STATUS, default='0')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    # A running task whose lease ran out (its worker died) is claimed again
+    locked_by = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['run_after']
+        indexes = [
+            # Workers claim pending tasks that are due, oldest first...
+            models.Index(fields=['run_after'], condition=Q(status='0'), name='task_due_idx'),
+            # ...and running tasks whose lease expired
+            models.Index(fields=['locked_until'], condition=Q(status='1'), name='task_lease_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'], condition=Q(status='0'), name='task_pending_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()}, {self.attempts}/{self.max_attempts} attempts)"
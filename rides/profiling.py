@@ -0,0 +1,223 @@
+"""
+Per-request timing of views, database queries and template rendering.
+
+``ProfileMiddleware`` times a sample of requests (``RIDES_PROFILE_SAMPLE_RATE``)
+and for each one records the view name, total time, query count and time,
+template render time and repeated queries. It adds a ``Server-Timing``
+header, so the numbers show in the browser's network panel, and keeps the
+last ``RIDES_PROFILE_WINDOW`` samples per view in memory, which the
+staff-only profile report summarises as percentiles.
+
+Queries are timed by an execute wrapper installed on every database
+connection. It finds the request being profiled through a context
+variable, which follows the request into ``sync_to_async`` threads under
+ASGI; for requests that aren't sampled it only does that lookup.
+"""
+import logging
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.utils import timezone
+
+from .stats import percentile
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('rides_request_profile', default=None)
+
+
+class RequestProfile:
+    """What one request spent its time on, in seconds."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total = 0.0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.queries = Counter()  # (sql, params) -> times run
+        self.rendering = 0  # nested template renders, only the outer one is timed
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicates(self):
+        """Queries that repeated an earlier one of the same request exactly."""
+        return self.query_count - len(self.queries)
+
+    def server_timing(self):
+        return ', '.join([
+            f'total;dur={self.total * 1000:.1f}',
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.query_count} queries"',
+            f'dupes;desc="{self.duplicates} repeated queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+        ])
+
+
+def time_query(execute, sql, params, many, context):
+    """Execute wrapper adding each query's time to the current request's profile."""
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - started
+        profile.queries[sql, repr(params)] += 1
+
+
+def install_query_timer(connection, **kwargs):
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(install_query_timer)
+
+
+class ProfiledTemplate(Template):
+    """A template whose renders count towards the current request's template time."""
+
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return super().render(context, request)
+        # Templates loaded while rendering (e.g. by crispy forms) are part of the outer render
+        profile.rendering += 1
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            profile.rendering -= 1
+            if not profile.rendering:
+                profile.template_time += time.perf_counter() - started
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with render times recorded by ``ProfileMiddleware``."""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return ProfiledTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class ViewStats:
+    """Rolling samples of the requests served by each view, for the report."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = defaultdict(lambda: deque(maxlen=settings.RIDES_PROFILE_WINDOW))
+            self.since = timezone.now()
+
+    def record(self, view, profile):
+        sample = (profile.total, profile.db_time, profile.query_count, profile.template_time, profile.duplicates)
+        with self.lock:
+            self.samples[view].append(sample)
+
+    def report(self):
+        """
+        Per view, sorted by p95 total time: sample count, p50/p95/p99 total
+        time in ms, p95 database and template time in ms, mean queries and
+        how many samples repeated a query.
+        """
+        with self.lock:
+            snapshot = {view: list(samples) for view, samples in self.samples.items()}
+        rows = []
+        for view, samples in snapshot.items():
+            totals = [sample[0] for sample in samples]
+            rows.append({
+                'view': view,
+                'samples': len(samples),
+                'p50': percentile(totals, 50) * 1000,
+                'p95': percentile(totals, 95) * 1000,
+                'p99': percentile(totals, 99) * 1000,
+                'db_p95': percentile([sample[1] for sample in samples], 95) * 1000,
+                'template_p95': percentile([sample[3] for sample in samples], 95) * 1000,
+                'queries': sum(sample[2] for sample in samples) / len(samples),
+                'with_repeats': sum(1 for sample in samples if sample[4]),
+            })
+        return sorted(rows, key=lambda row: row['p95'], reverse=True)
+
+
+view_stats = ViewStats()
+
+
+class ProfileMiddleware:
+    """
+    Profile a ``RIDES_PROFILE_SAMPLE_RATE`` share of requests (see the
+    module docstring). Put it near the top of ``MIDDLEWARE`` to include
+    the other middleware in the total, below WhiteNoise to leave out
+    static files.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        # Connections opened before this was loaded didn't get the timer
+        for connection in connections.all(initialized_only=True):
+            install_query_timer(connection)
+
+    def sampled(self):
+        rate = settings.RIDES_PROFILE_SAMPLE_RATE
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, profile)
+
+    def finish(self, request, response, profile):
+        profile.total = time.perf_counter() - profile.started
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        view_stats.record(view, profile)
+        response.headers['Server-Timing'] = profile.server_timing()
+        if profile.duplicates:
+            (sql, _), times = profile.queries.most_common(1)[0]
+            logger.info(
+                '%s ran %s repeated queries; most repeated (%s times): %s',
+                view, profile.duplicates, times, sql,
+            )
+        return response
@@ -0,0 +1,181 @@
+"""
+A small task queue kept in the database, so side effects of a request can
+run after it without an external broker.
+
+Decorate a function with ``@task`` and call ``func.enqueue(*args)`` instead
+of ``func(*args)``: the call is saved as a ``Task`` row in the current
+transaction, so it's only queued if the change that caused it commits, and
+``./manage.py worker`` runs it after. Arguments must be JSON-serialisable.
+
+Tasks are retried with exponential backoff when they raise, and may run
+more than once (a worker can die after the work but before deleting the
+task), so they must be idempotent.
+"""
+import logging
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, FAILED = '0', '1', '2'
+# How long a worker may hold a task before another one may take it over
+DEFAULT_LEASE = timedelta(minutes=5)
+# Retry delays double from RETRY_DELAY up to MAX_RETRY_DELAY
+RETRY_DELAY = timedelta(seconds=10)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+TASKS = {}
+
+
+def task(func=None, *, name=None, max_attempts=None):
+    """
+    Register ``func`` as a background task and give it an ``enqueue``
+    method. ``name`` defaults to the function's dotted path.
+    """
+    def register(func):
+        task_name = name or f'{func.__module__}.{func.__qualname__}'
+        TASKS[task_name] = func
+
+        def enqueue(*args, dedupe_key=None, delay=None, **kwargs):
+            return enqueue_task(
+                task_name, args, kwargs,
+                dedupe_key=dedupe_key, delay=delay, max_attempts=max_attempts,
+            )
+        func.enqueue = enqueue
+        func.task_name = task_name
+        return func
+    return register(func) if func else register
+
+
+def enqueue_task(name, args=(), kwargs=None, dedupe_key=None, delay=None, max_attempts=None):
+    """
+    Queue a call to the task ``name``. If a pending task with the same
+    ``dedupe_key`` is already queued nothing is added. With
+    ``RIDES_TASKS_EAGER`` the task runs in-process once the current
+    transaction commits instead.
+    """
+    kwargs = kwargs or {}
+    if settings.RIDES_TASKS_EAGER:
+        func = TASKS[name]
+        transaction.on_commit(lambda: func(*args, **kwargs))
+        return
+    Task.objects.bulk_create([Task(
+        name=name,
+        payload={'args': list(args), 'kwargs': kwargs},
+        dedupe_key=dedupe_key,
+        max_attempts=max_attempts or settings.RIDES_TASKS_MAX_ATTEMPTS,
+        run_after=timezone.now() + (delay or timedelta()),
+    )], ignore_conflicts=dedupe_key is not None)
+
+
+def _due(now):
+    return Q(status=PENDING, run_after__lte=now) | Q(status=RUNNING, locked_until__lt=now)
+
+
+def claim_tasks(limit=10, lease=DEFAULT_LEASE):
+    """
+    Take up to ``limit`` due tasks (and tasks whose worker's lease ran out)
+    for this worker, oldest first, and return them.
+
+    Where the database supports it (Postgres) the candidates are locked with
+    SKIP LOCKED, so concurrent workers take different tasks instead of
+    queueing behind each other. Either way the claiming UPDATE repeats the
+    due check, so a task is never claimed twice; the claim token then finds
+    the ones this worker won.
+    """
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    with transaction.atomic():
+        candidates = Task.objects.filter(_due(now)).order_by('run_after')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        candidates = list(candidates.values_list('pk', flat=True)[:limit])
+        if not candidates:
+            return []
+        Task.objects.filter(_due(now), pk__in=candidates).update(
+            status=RUNNING, locked_by=token, locked_until=now + lease, attempts=F('attempts') + 1,
+        )
+    return list(Task.objects.filter(locked_by=token, status=RUNNING).order_by('run_after'))
+
+
+def retry_delay(attempts):
+    """Backoff before retrying a task that has failed ``attempts`` times."""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def run_task(task):
+    """
+    Run a claimed task. On success it's deleted; on failure it's queued
+    again after a backoff, or marked failed once it's out of attempts.
+    Returns True if it succeeded.
+    """
+    mine = Task.objects.filter(pk=task.pk, locked_by=task.locked_by)
+    try:
+        func = TASKS.get(task.name)
+        if func is None:
+            raise LookupError(f'Unknown task {task.name!r}')
+        func(*task.payload.get('args', []), **task.payload.get('kwargs', {}))
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Task %s (%s) failed, attempt %s of %s', task.pk, task.name, task.attempts, task.max_attempts)
+        if task.attempts >= task.max_attempts:
+            mine.update(status=FAILED, last_error=error, locked_until=None)
+            return False
+        try:
+            with transaction.atomic():
+                mine.update(
+                    status=PENDING, last_error=error, locked_by='', locked_until=None,
+                    run_after=timezone.now() + retry_delay(task.attempts),
+                )
+        except IntegrityError:
+            # The same work was queued again meanwhile; that task will do it
+            mine.delete()
+        return False
+    mine.delete()
+    return True
+
+
+def run_pending(limit=None, batch_size=10, lease=DEFAULT_LEASE):
+    """
+    Run due tasks until none are left (or ``limit`` have run). Returns
+    ``(succeeded, failed)``.
+    """
+    succeeded = failed = 0
+    while limit is None or succeeded + failed < limit:
+        size = batch_size if limit is None else min(batch_size, limit - succeeded - failed)
+        tasks = claim_tasks(size, lease)
+        if not tasks:
+            break
+        for claimed in tasks:
+            if run_task(claimed):
+                succeeded += 1
+            else:
+                failed += 1
+    return succeeded, failed
+
+
+def requeue_failed(tasks):
+    """
+    Queue the failed tasks among ``tasks`` again with fresh attempts. One
+    whose work is already queued again (a pending task with its dedupe key)
+    is deleted instead. Returns how many were queued.
+    """
+    queued = 0
+    for failed in tasks.filter(status=FAILED):
+        try:
+            with transaction.atomic():
+                Task.objects.filter(pk=failed.pk).update(
+                    status=PENDING, attempts=0, locked_by='', run_after=timezone.now(),
+                )
+            queued += 1
+        except IntegrityError:
+            failed.delete()
+    return queued
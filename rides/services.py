@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import (
+    FUTURE_DATE_ERROR, SAME_PLACE_ERROR, Rides, RideRequest, geocode_rides, is_same_place,
+)
+from .dashboard import invalidate_dashboards_on_commit
+from .events import publish_rides_on_commit
+from .suggest import add_ride_places_on_commit
+from .tasks import queue_ride_search_invalidation
+
+# How a recurring ride repeats: the weekdays (Monday = 0) it runs on
+REPEAT_RULES = {
+    'daily': range(7),
+    'weekdays': range(5),
+    'weekly': None,  # the first ride's weekday
+}
+# Most rides one schedule may create, about three months of daily rides
+MAX_SERIES_RIDES = 92
+
+
+class SeatsUnavailable(Exception):
+    """Raised when a ride no longer has enough seats for a booking."""
+
+
+def _book_seats(ride_id, seats):
+    """
+    Add ``seats`` to a ride's ``seats_booked`` counter (a negative number
+    gives them back) with a single UPDATE, which also locks the ride row
+    until commit. Taking seats is conditional on the ride having that many
+    left; returns False if it hasn't.
+    """
+    if not seats:
+        return True
+    rides = Rides.objects.filter(pk=ride_id)
+    if seats > 0:
+        rides = rides.filter(seats_booked__lte=F('seats_offered') - seats)
+    # updated_on keeps ride_detail's Last-Modified/ETag honest
+    return bool(rides.update(seats_booked=F('seats_booked') + seats, updated_on=timezone.now()))
+
+
+def lock_seat_counts(ride):
+    """
+    Lock a saved ride's row until the current transaction commits and
+    refresh its seat counts, so checking seats against them (``Rides.clean``,
+    the admin's request form) still holds when the change is saved.
+    """
+    if ride.pk:
+        ride.seats_offered, ride.seats_booked = Rides.objects.select_for_update().values_list(
+            'seats_offered', 'seats_booked',
+        ).get(pk=ride.pk)
+
+
+def reserve_seats(ride_request):
+    """
+    Save a new, unsaved RideRequest and book its seats on the ride.
+
+    The counter is incremented with a single conditional UPDATE
+    (``seats_booked + seats_requested <= seats_offered``) in the same
+    transaction as the insert, so concurrent bookings can never oversell a
+    ride or lose an update.
+
+    Retrying is safe: if the passenger already has a request for this ride
+    (double click, resubmitted form, racing request) no seats are taken and
+    the existing request is returned.
+
+    Returns ``(ride_request, created)``. Raises ``SeatsUnavailable`` if the
+    ride doesn't have enough seats left.
+    """
+    lookup = {'ride_id': ride_request.ride_id, 'passenger_id': ride_request.passenger_id}
+    try:
+        with transaction.atomic():
+            # Write first, so the ride row stays locked until commit
+            taken = _book_seats(ride_request.ride_id, ride_request.seats_held)
+            existing = RideRequest.objects.filter(**lookup).first()
+            if existing:
+                # Already booked: undo the increment and hand back the booking
+                transaction.set_rollback(True)
+                return existing, False
+            if not taken:
+                raise SeatsUnavailable()
+            ride_request.save()
+            # Seat counts show in search results; queued with the booking
+            queue_ride_search_invalidation(ride_request.ride)
+            invalidate_dashboards_on_commit(ride_request.passenger_id, ride_request.ride.driver_id)
+            publish_rides_on_commit(ride_request.ride_id)
+    except IntegrityError:
+        # Lost an insert race for the same (passenger, ride) pair
+        existing = RideRequest.objects.filter(**lookup).first()
+        if existing is None:
+            raise
+        return existing, False
+    return ride_request, True
+
+
+def update_ride_request(ride_request):
+    """
+    Save changes to an existing RideRequest (its status, seats or ride) and
+    move its booked seats with it, atomically. Pending, accepted and
+    completed requests hold seats; rejecting or cancelling one gives them
+    back, reinstating it takes them again.
+
+    The stored request is locked and compared with ``ride_request``, so two
+    transitions of the same request can't both apply their change.
+
+    Raises ``SeatsUnavailable`` if the change needs more seats than the ride
+    has left.
+    """
+    with transaction.atomic():
+        stored = RideRequest.objects.select_for_update().get(pk=ride_request.pk)
+        if stored.ride_id == ride_request.ride_id:
+            taken = _book_seats(ride_request.ride_id, ride_request.seats_held - stored.seats_held)
+        else:
+            _book_seats(stored.ride_id, -stored.seats_held)
+            taken = _book_seats(ride_request.ride_id, ride_request.seats_held)
+        if not taken:
+            raise SeatsUnavailable()
+        ride_request.save()
+        # Seat counts show in search results
+        moved = stored.ride_id != ride_request.ride_id
+        if moved or stored.seats_held != ride_request.seats_held:
+            queue_ride_search_invalidation(ride_request.ride)
+        if moved and stored.seats_held:
+            queue_ride_search_invalidation(stored.ride)
+        drivers = Rides.objects.filter(id__in={stored.ride_id, ride_request.ride_id}).values_list('driver_id', flat=True)
+        invalidate_dashboards_on_commit(stored.passenger_id, ride_request.passenger_id, *drivers)
+        publish_rides_on_commit(stored.ride_id, ride_request.ride_id)
+
+
+def set_request_status(ride_request, status):
+    """Move a RideRequest to ``status``, booking or giving back its seats."""
+    ride_request.status = status
+    update_ride_request(ride_request)
+
+
+def release_seats(ride_request):
+    """Delete a RideRequest and give the seats it held back to the ride, atomically."""
+    with transaction.atomic():
+        stored = RideRequest.objects.select_for_update().filter(pk=ride_request.pk).first()
+        if stored is None:
+            return
+        stored.delete()
+        if _book_seats(stored.ride_id, -stored.seats_held) and stored.seats_held:
+            queue_ride_search_invalidation(stored.ride)
+        invalidate_dashboards_on_commit(stored.passenger_id, stored.ride.driver_id)
+        publish_rides_on_commit(stored.ride_id)
+
+
+def schedule_dates(first, repeat, until):
+    """
+    Departure times for a ride that first leaves at ``first`` and repeats by
+    the ``repeat`` rule (see ``REPEAT_RULES``) up to and including the date
+    ``until``. The local time of day is kept across clock changes.
+    """
+    first = timezone.localtime(first)
+    weekdays = REPEAT_RULES[repeat]
+    if weekdays is None:
+        weekdays = [first.weekday()]
+    dates = []
+    day = first.date()
+    while day <= until:
+        if day.weekday() in weekdays:
+            dates.append(timezone.make_aware(datetime.combine(day, first.time())))
+        day += timedelta(days=1)
+    return dates
+
+
+def validate_ride_batch(rides, now=None):
+    """
+    Check a batch of unsaved rides the way ``validate_future_date`` and
+    ``Rides.clean`` check one, but over the whole batch at once: a single
+    clock read, the earliest date first (when it's in the future none of
+    the others need looking at) and one origin/destination comparison per
+    distinct pair. Returns ``{index: [messages]}`` for the invalid rides.
+    """
+    now = now or timezone.now()
+    errors = {}
+    if rides and min(ride.date for ride in rides) < now:
+        for index, ride in enumerate(rides):
+            if ride.date < now:
+                errors.setdefault(index, []).append(FUTURE_DATE_ERROR)
+    same_place = {}
+    for index, ride in enumerate(rides):
+        pair = (ride.origin, ride.destination)
+        if pair not in same_place:
+            same_place[pair] = is_same_place(*pair)
+        if same_place[pair]:
+            errors.setdefault(index, []).append(SAME_PLACE_ERROR)
+    return errors
+
+
+def create_rides(rides, batch_size=500):
+    """
+    Validate, locate and insert a batch of unsaved rides with
+    ``bulk_create``, all or nothing. Raises ``ValidationError`` listing the
+    problems by position (1-based) if any ride is invalid.
+
+    ``bulk_create`` skips ``Rides.save()``, so the rides are located here,
+    with one gazetteer lookup for the whole batch. Callers invalidate the
+    cached searches for the places involved.
+    """
+    errors = validate_ride_batch(rides)
+    if errors:
+        raise ValidationError([
+            f'Ride {index + 1}: {message}'
+            for index, messages in sorted(errors.items())
+            for message in messages
+        ])
+    geocode_rides(rides)
+    with transaction.atomic():
+        invalidate_dashboards_on_commit(*{ride.driver_id for ride in rides})
+        add_ride_places_on_commit(*rides)
+        return Rides.objects.bulk_create(rides, batch_size=batch_size)
@@ -0,0 +1,39 @@
+"""
+Django's database-backed session engines, with ``./manage.py clearsessions``
+deleting expired sessions a batch at a time.
+
+Django's engines delete every expired session in one statement, which on
+a big table is one long transaction holding locks on all of those rows
+(and the index pages they share with live sessions). Here each batch of
+the oldest expired sessions is its own short DELETE.
+"""
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from django.utils import timezone
+
+
+class BatchedClearExpired:
+    clear_batch_size = 1000
+
+    @classmethod
+    def clear_expired(cls):
+        model = cls.get_model_class()
+        now = timezone.now()
+        expired = model.objects.filter(expire_date__lt=now)
+        batch = expired.order_by('expire_date', 'session_key')
+        while True:
+            rows = list(batch.values_list('expire_date', 'session_key')[:cls.clear_batch_size])
+            if not rows:
+                return
+            # Sessions used since they were read here have a new expiry and stay
+            expired.filter(session_key__in=[key for _, key in rows]).delete()
+            # Carry on after the last one, rather than scanning past the
+            # index entries of the rows just deleted again
+            last_date, last_key = rows[-1]
+            batch = expired.filter(
+                Q(expire_date__gt=last_date) | Q(expire_date=last_date, session_key__gt=last_key)
+            ).order_by('expire_date', 'session_key')
+
+    @classmethod
+    async def aclear_expired(cls):
+        await sync_to_async(cls.clear_expired)()
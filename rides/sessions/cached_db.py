@@ -0,0 +1,7 @@
+from django.contrib.sessions.backends import cached_db
+
+from . import BatchedClearExpired
+
+
+class SessionStore(BatchedClearExpired, cached_db.SessionStore):
+    """Cached database sessions, cleared of expired ones in batches."""
@@ -0,0 +1,7 @@
+from django.contrib.sessions.backends import db
+
+from . import BatchedClearExpired
+
+
+class SessionStore(BatchedClearExpired, db.SessionStore):
+    """Database sessions, cleared of expired ones in batches."""
@@ -0,0 +1,11 @@
+"""Summary statistics shared by the profiling report and the benchmark commands."""
+import math
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples`` (any order), or 0.0 for no samples."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(len(ordered) * pct / 100))
+    return ordered[rank - 1]
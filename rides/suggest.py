@@ -0,0 +1,101 @@
+"""
+Place name suggestions for the search form, from an in-process prefix index.
+
+``place_index`` holds the distinct origins and destinations of upcoming
+rides as a sorted list of lookup keys (see ``place_key``), so a prefix
+lookup is a binary search plus a short scan, with no database query.
+Rides created or edited in this process are added as soon as they're
+committed; the whole index is rebuilt every ``RIDES_SUGGEST_REFRESH``
+seconds, which picks up other processes' rides and drops places no
+upcoming ride uses any more.
+"""
+import bisect
+import heapq
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Rides, normalize_place, place_key
+
+
+class PlaceIndex:
+    """Sorted place keys, each with a display name and how many rides use it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (sorted place keys, {key: [display name, rides]}), swapped as one
+        # on rebuild so lookups never see the keys of one and places of another
+        self.data = ([], {})
+        self.built = None  # time.monotonic() of the last rebuild
+
+    def is_stale(self):
+        return self.built is None or time.monotonic() - self.built > settings.RIDES_SUGGEST_REFRESH
+
+    def rebuild(self):
+        """Reload every place of upcoming rides, in one grouped query per side."""
+        names = Counter()
+        upcoming = Rides.objects.filter(date__gt=timezone.now()).order_by()
+        for side in ('origin', 'destination'):
+            for name, rides in upcoming.values_list(side).annotate(rides=Count('id')):
+                names[normalize_place(name)] += rides
+        places = {}
+        # Most used first, so each place shows its most used spelling
+        for name, rides in names.most_common():
+            places.setdefault(place_key(name), [name, 0])[1] += rides
+        with self.lock:
+            self.data = (sorted(places), places)
+            self.built = time.monotonic()
+
+    def add(self, *names):
+        """Count a ride at each of ``names``, adding places the index hasn't got."""
+        with self.lock:
+            keys, places = self.data
+            for name in names:
+                name = normalize_place(name or '')
+                key = place_key(name)
+                if not key:
+                    continue
+                if key in places:
+                    places[key][1] += 1
+                else:
+                    places[key] = [name, 1]
+                    bisect.insort(keys, key)
+
+    def suggest(self, prefix, limit=8):
+        """
+        Display names of up to ``limit`` places starting with ``prefix``
+        (compared the way searches are), most used first.
+        """
+        prefix = place_key(prefix)
+        if not prefix:
+            return []
+        keys, places = self.data
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + '\U0010ffff', start)
+        best = heapq.nsmallest(limit, keys[start:end], key=lambda key: (-places[key][1], key))
+        return [places[key][0] for key in best]
+
+
+place_index = PlaceIndex()
+_refreshing = threading.Lock()
+
+
+def refresh_place_index():
+    """Rebuild the index if it's stale, unless another thread already is."""
+    if place_index.is_stale() and _refreshing.acquire(blocking=False):
+        try:
+            if place_index.is_stale():
+                place_index.rebuild()
+        finally:
+            _refreshing.release()
+
+
+def add_ride_places_on_commit(*rides):
+    """Add these rides' places to the index once the current transaction commits."""
+    names = [name for ride in rides for name in (ride.origin, ride.destination)]
+    transaction.on_commit(lambda: place_index.add(*names))
@@ -0,0 +1,38 @@
+"""Background tasks for the side effects of bookings and ride changes."""
+import functools
+import hashlib
+
+from django.db import transaction
+
+from .cache import cache_is_shared, invalidate_place_searches
+from .models import place_key
+from .queue import task
+
+
+@task
+def invalidate_searches(places):
+    """Drop cached searches that could include rides at these ``[origin, destination]`` pairs."""
+    invalidate_place_searches(*places)
+
+
+def queue_search_invalidation(*places):
+    """
+    Queue ``invalidate_searches`` for ``(origin, destination)`` pairs. While
+    one is waiting for a worker, queueing it again for the same places (a
+    burst of bookings on one ride) adds nothing.
+
+    The worker can only reach a cache it shares with the web processes.
+    Without one (see ``cache_is_shared``) the searches are invalidated
+    in-process once the current transaction commits instead.
+    """
+    pairs = sorted({(place_key(origin or ''), place_key(destination or '')) for origin, destination in places})
+    if not cache_is_shared():
+        transaction.on_commit(functools.partial(invalidate_place_searches, *pairs))
+        return
+    key = hashlib.sha1(repr(pairs).encode()).hexdigest()
+    invalidate_searches.enqueue([list(pair) for pair in pairs], dedupe_key=f'searches:{key}')
+
+
+def queue_ride_search_invalidation(ride):
+    """Queue the invalidation of cached searches that could include ``ride``."""
+    queue_search_invalidation((ride.origin, ride.destination))
@@ -0,0 +1,28 @@
+from django import template
+from django.utils.html import format_html
+
+from ..images import avatar_sources
+
+register = template.Library()
+
+
+@register.simple_tag
+def avatar(user, size=32):
+    """
+    A lazy-loading, responsive avatar of ``user``'s profile picture.
+    Select ``profile`` with the user (``Rides.objects.with_driver()``
+    does for drivers), or it costs a query per avatar.
+
+    Built with ``format_html`` rather than an inclusion template: it's in
+    every result card, and a template render per card adds up.
+    """
+    profile = getattr(user, 'profile', None)
+    sources = avatar_sources(profile and profile.profile_picture, size)
+    srcset = ''
+    if sources['srcset']:
+        srcset = format_html(' srcset="{}" sizes="{}px"', sources['srcset'], size)
+    return format_html(
+        '<img src="{}"{} width="{}" height="{}" loading="lazy" decoding="async" '
+        'class="rounded-circle align-middle" alt="">',
+        sources['src'], srcset, size, size,
+    )
@@ -0,0 +1,23 @@
+"""
+The test runner (``TEST_RUNNER``): Django's, with static files stored under
+their own names, since the tests don't run ``collectstatic`` to build the
+manifest that production's hashed names come from. ``StaticAssetTests``
+builds and checks the real thing.
+"""
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.static_storage = override_settings(STORAGES={
+            **settings.STORAGES,
+            'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        })
+        self.static_storage.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.static_storage.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,1483 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import math
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from importlib import import_module
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .dashboard import aget_dashboard_page
+from .events import get_broker, publish_rides, ride_event_stream
+from .images import avatar_sources, variants
+from .auth import ModelBackend
+from .sessions.db import SessionStore
+from .exports import RIDE_COLUMNS, export_lines
+from .stats import percentile
+from .suggest import PlaceIndex, place_index
+from .profiling import RequestProfile, _current, view_stats
+from .geo import covering_cells, encode_geohash, haversine_km
+from .management.commands.archive_rides import archive_closed_requests, archive_rides, expire_requests
+from .management.commands.benchmark import compare_results
+from .management.commands.import_places import import_gazetteer, read_gazetteer
+from .management.commands.seed_data import generate_data
+from .models import (
+    FUTURE_DATE_ERROR, SAME_PLACE_ERROR, ArchivedRide, ArchivedRideRequest, Place, Rides, RideRequest, Task,
+    UserProfile,
+)
+from .queue import claim_tasks, run_pending, task
+from .management.commands.reconcile_seats import reconcile_seats
+from .services import (
+    SeatsUnavailable, create_rides, release_seats, reserve_seats, schedule_dates, set_request_status,
+    validate_ride_batch,
+)
+
+# Tables whose listing queries must always be served by an index
+INDEXED_TABLES = ('rides_rides', 'rides_riderequest')
+
+
+def seed_rides(drivers=20, rides_per_driver=50, passengers=20):
+    """Create a mix of future/past, published/draft rides with some bookings."""
+    now = timezone.now()
+    users = User.objects.bulk_create(
+        [User(username=f'driver{i}') for i in range(drivers)]
+        + [User(username=f'passenger{i}') for i in range(passengers)]
+    )
+    driver_users, passenger_users = users[:drivers], users[drivers:]
+    rides = Rides.objects.bulk_create([
+        Rides(
+            driver=driver,
+            origin=f'Town {n % 30}',
+            destination=f'Town {(n + 7) % 30}',
+            date=now + timedelta(days=n % 60 - 10, hours=n % 24),
+            seats_offered=n % 5,
+            pickup_notes='',
+            status='1' if n % 4 else '0',
+        )
+        for i, driver in enumerate(driver_users)
+        for n in range(i * rides_per_driver, (i + 1) * rides_per_driver)
+    ])
+    RideRequest.objects.bulk_create([
+        RideRequest(passenger=passenger_users[n % passengers], ride=ride, status=str(n % 5))
+        for n, ride in enumerate(rides[::10])
+    ])
+    return driver_users, passenger_users
+
+
+def make_ride(driver, origin='Truro', destination='Falmouth', days=1, **fields):
+    """A published ride ``days`` from now with four seats, unless ``fields`` say otherwise."""
+    fields = {'seats_offered': 4, 'pickup_notes': '', 'status': '1', **fields}
+    return Rides.objects.create(
+        driver=driver, origin=origin, destination=destination,
+        date=timezone.now() + timedelta(days=days), **fields,
+    )
+
+
+def book(ride, passenger, seats=1):
+    """Book ``seats`` on ``ride`` for ``passenger`` the way the site does, returning the request."""
+    ride_request, _ = reserve_seats(RideRequest(passenger=passenger, ride=ride, seats_requested=seats))
+    return ride_request
+
+
+class RidesTestCase(TestCase):
+    """Starts every test with an empty cache, so no cached search or page outlives its test."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class ListingQueryPlanTests(RidesTestCase):
+    """The listing views must never fall back to full table scans."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drivers, cls.passengers = seed_rides()
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor == 'postgresql':
+            # Small test tables would otherwise make a seq scan the cheapest plan
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                return [row[-1] for row in cursor.fetchall()]
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0] for row in cursor.fetchall()]
+
+    def is_full_scan(self, line):
+        if connection.vendor == 'sqlite':
+            return line.startswith('SCAN ') and ' USING ' not in line
+        return 'Seq Scan' in line
+
+    def assertNoFullScans(self, url, user=None):
+        if user:
+            self.client.force_login(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or not any(t in sql for t in INDEXED_TABLES):
+                continue
+            for line in self.explain(sql):
+                if any(t in line for t in INDEXED_TABLES):
+                    self.assertFalse(self.is_full_scan(line), f'{line}\n  in: {sql}')
+
+    def test_search_rides_anonymous(self):
+        self.assertNoFullScans(reverse('search_rides'))
+
+    def test_search_rides_authenticated(self):
+        self.assertNoFullScans(reverse('search_rides'), self.passengers[0])
+
+    def test_search_rides_by_distance(self):
+        self.assertNoFullScans(f"{reverse('search_rides')}?origin=Truro&destination=Falmouth")
+
+    def test_my_rides(self):
+        self.assertNoFullScans(reverse('my_rides'), self.drivers[0])
+
+    def test_my_ride_requests(self):
+        self.assertNoFullScans(reverse('my_ride_requests'), self.passengers[0])
+
+    def test_past_sections(self):
+        self.assertNoFullScans(f"{reverse('my_rides')}?section=past", self.drivers[0])
+        self.assertNoFullScans(f"{reverse('my_ride_requests')}?section=past", self.passengers[0])
+
+    def test_admin_changelists(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.assertNoFullScans(reverse('admin:rides_rides_changelist'), admin)
+        self.assertNoFullScans(reverse('admin:rides_riderequest_changelist'))
+        self.assertNoFullScans(f"{reverse('admin:rides_rides_changelist')}?status__exact=1")
+        self.assertNoFullScans(f"{reverse('admin:rides_riderequest_changelist')}?status__exact=0")
+
+
+class PlaceSearchTests(RidesTestCase):
+    """Text searches rank exact place matches first, then prefixes, substrings and (on Postgres) typos."""
+
+    @classmethod
+    def setUpTestData(cls):
+        driver = User.objects.create(username='driver')
+        # Made-up places, so the search is by text rather than by distance
+        cls.rides = {
+            origin: make_ride(driver, origin, 'Polwithen', days=days)
+            for days, origin in enumerate(['Lower Trevanion', 'Trevanion Cross', 'Trevanion', 'Penwartha'], 1)
+        }
+
+    def search(self, origin):
+        response = self.client.get(reverse('search_rides'), {'origin': origin, 'destination': 'Polwithen'})
+        return [ride.origin for ride in response.context['rides']]
+
+    def test_exact_then_prefix_then_substring(self):
+        # The rank comes before the date: the exact match leaves last
+        self.assertEqual(self.search('trevanion'), ['Trevanion', 'Trevanion Cross', 'Lower Trevanion'])
+
+    def test_ranks(self):
+        ranks = Rides.objects.search_places(origin='TREVANION ', destination='polwithen').values_list(
+            'origin', 'search_rank',
+        )
+        self.assertEqual(dict(ranks), {'Trevanion': 6, 'Trevanion Cross': 5, 'Lower Trevanion': 4})
+
+    @skipUnless(connection.vendor == 'postgresql', 'trigram matching needs pg_trgm')
+    def test_typo_matches_fuzzily_after_exact_matches(self):
+        ranks = Rides.objects.search_places(origin='Trevanon').values_list('origin', 'search_rank')
+        self.assertEqual(dict(ranks)['Trevanion'], 0)
+        self.assertEqual(self.search('Trevanon')[0], 'Trevanion')
+        self.assertNotIn('Penwartha', self.search('Trevanon'))
+
+    @skipUnless(connection.vendor == 'sqlite', 'the fallback for backends without pg_trgm')
+    def test_substring_fallback_without_trigrams(self):
+        with CaptureQueriesContext(connection) as ctx:
+            # Equally ranked substrings, soonest first
+            self.assertEqual(self.search('vanion'), ['Lower Trevanion', 'Trevanion Cross', 'Trevanion'])
+        self.assertNotIn('%>', ' '.join(query['sql'] for query in ctx.captured_queries))
+        self.assertEqual(self.search('Trevanon'), [])
+
+
+class KeysetPaginationTests(RidesTestCase):
+    """Following next-page cursors walks every row exactly once, in order."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drivers, cls.passengers = seed_rides(drivers=2, rides_per_driver=30)
+
+    def walk(self, url, context_key, **params):
+        seen, cursor = [], None
+        while True:
+            response = self.client.get(url, {**params, 'cursor': cursor} if cursor else params)
+            page = response.context['page']
+            seen.extend(obj['id'] if isinstance(obj, dict) else obj.id for obj in response.context[context_key])
+            if not page.has_next:
+                return seen
+            cursor = page.next_cursor
+
+    @override_settings(RIDES_PAGE_SIZE=7)
+    def test_search_rides_pages(self):
+        expected = list(Rides.objects.filter(
+            date__gt=timezone.now(), status='1'
+        ).with_seats_left().order_by('date', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk(reverse('search_rides'), 'rides'), expected)
+
+    @override_settings(RIDES_PAGE_SIZE=7)
+    def test_my_rides_pages(self):
+        driver = self.drivers[0]
+        self.client.force_login(driver)
+        now = timezone.now()
+        upcoming = list(driver.rides.filter(date__gt=now).order_by('date', 'id').values_list('id', flat=True))
+        past = list(driver.rides.filter(date__lte=now).order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(self.walk(reverse('my_rides'), 'rides'), upcoming)
+        self.assertEqual(self.walk(reverse('my_rides'), 'rides', section='past'), past)
+
+    @override_settings(RIDES_PAGE_SIZE=7, RIDES_COUNT_CAP=10)
+    def test_count_is_capped(self):
+        response = self.client.get(reverse('search_rides'))
+        self.assertEqual(response.context['page'].count_display, '10+')
+
+    def test_forged_cursor_falls_back_to_first_page(self):
+        response = self.client.get(reverse('search_rides'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].is_bound)
+
+
+@override_settings(RIDES_PAGE_SIZE=500)
+class QueryBudgetTests(RidesTestCase):
+    """
+    Each view runs a fixed number of queries however many rides it shows.
+    All 500 seeded rides fit on one page, so any per-row lazy lookup
+    (e.g. ``ride.driver`` in a card) blows the budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drivers, cls.passengers = seed_rides(drivers=10, rides_per_driver=50)
+        cls.ride = Rides.objects.filter(
+            date__gt=timezone.now(), status='1'
+        ).with_seats_left().first()
+        cls.ride_request = RideRequest.objects.filter(passenger=cls.passengers[0]).first()
+
+    def assertMaxQueries(self, budget, url, user=None):
+        if user:
+            self.client.force_login(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(ctx), budget,
+            '\n'.join(query['sql'] for query in ctx.captured_queries),
+        )
+
+    def test_search_rides_anonymous(self):
+        self.assertMaxQueries(2, reverse('search_rides'))
+
+    def test_search_rides_authenticated(self):
+        self.assertMaxQueries(5, reverse('search_rides'), self.passengers[0])
+
+    def test_ride_detail(self):
+        self.assertMaxQueries(2, reverse('ride_detail', args=[self.ride.id]))
+
+    def test_request_ride(self):
+        self.assertMaxQueries(3, reverse('request_ride', args=[self.ride.id]), self.passengers[0])
+
+    def test_ride_request_confirmation(self):
+        self.assertMaxQueries(
+            3,
+            reverse('ride_request_confirmation', args=[self.ride_request.id]),
+            self.passengers[0],
+        )
+
+    def test_my_rides(self):
+        self.assertMaxQueries(3, reverse('my_rides'), self.drivers[0])
+
+    def test_my_ride_requests(self):
+        self.assertMaxQueries(3, reverse('my_ride_requests'), self.passengers[0])
+
+
+class SeatReservationStressTests(TransactionTestCase):
+    """Parallel bookings never oversell a ride and never leak seats."""
+
+    PASSENGERS = 200
+    MAX_RETRIES = 1000
+
+    def setUp(self):
+        driver = User.objects.create(username='driver')
+        self.passengers = User.objects.bulk_create(
+            [User(username=f'passenger{i}') for i in range(self.PASSENGERS)]
+        )
+        self.ride = make_ride(driver)
+
+    def book_with_retries(self, passenger, seats):
+        """Book like a client would: retry while the database is busy."""
+        try:
+            for attempt in range(self.MAX_RETRIES):
+                try:
+                    return reserve_seats(
+                        RideRequest(passenger=passenger, ride=self.ride, seats_requested=seats)
+                    )
+                except SeatsUnavailable:
+                    return None
+                except OperationalError:
+                    # SQLite reports write contention instead of waiting on a row lock
+                    continue
+            raise AssertionError(f'Booking still failing after {self.MAX_RETRIES} retries')
+        finally:
+            connection.close()
+
+    def run_parallel(self, bookings):
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            return list(pool.map(lambda args: self.book_with_retries(*args), bookings))
+
+    def assertSeatsBalance(self):
+        self.ride.refresh_from_db()
+        booked = RideRequest.objects.filter(ride=self.ride).aggregate(
+            total=Sum('seats_requested')
+        )['total'] or 0
+        self.assertGreaterEqual(self.ride.seats_available, 0)
+        self.assertEqual(self.ride.seats_available + booked, 4)
+
+    def test_parallel_bookings_never_oversell(self):
+        results = self.run_parallel([(p, 1 + i % 2) for i, p in enumerate(self.passengers)])
+        self.assertSeatsBalance()
+        self.assertEqual(self.ride.seats_available, 0)
+        self.assertLessEqual(sum(1 for result in results if result), 4)
+
+    def test_parallel_retries_are_idempotent(self):
+        passengers = self.passengers[:2]
+        results = self.run_parallel([(p, 1) for p in passengers] * 100)
+        self.assertSeatsBalance()
+        self.assertEqual(RideRequest.objects.filter(ride=self.ride).count(), 2)
+        self.assertEqual(sum(1 for _, created in results if created), 2)
+
+    def test_release_returns_seats(self):
+        ride_request = book(self.ride, self.passengers[0], 3)
+        release_seats(ride_request)
+        release_seats(ride_request)  # a second release is a no-op
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.seats_available, 4)
+
+
+class SeatCounterTests(RidesTestCase):
+    """seats_booked follows every request status change and can be reconciled."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        cls.passengers = User.objects.bulk_create([User(username=f'passenger{i}') for i in range(3)])
+
+    def setUp(self):
+        super().setUp()
+        self.ride = make_ride(self.driver)
+
+    def assertBooked(self, seats):
+        self.ride.refresh_from_db()
+        self.assertEqual((self.ride.seats_booked, self.ride.seats_available), (seats, 4 - seats))
+
+    def test_status_changes_move_seats(self):
+        first, second = book(self.ride, self.passengers[0], 3), book(self.ride, self.passengers[1], 1)
+        self.assertBooked(4)
+        set_request_status(first, '1')  # accepted: still holds its seats
+        self.assertBooked(4)
+        set_request_status(first, '2')  # rejected: gives them back
+        self.assertBooked(1)
+        third = book(self.ride, self.passengers[2], 3)
+        with self.assertRaises(SeatsUnavailable):
+            set_request_status(first, '0')  # reinstated, but the seats are gone
+        first.refresh_from_db()
+        self.assertEqual(first.status, '2')
+        release_seats(third)
+        set_request_status(first, '0')
+        release_seats(second)
+        self.assertBooked(3)
+
+    def test_saving_a_stale_ride_keeps_the_counter(self):
+        stale = Rides.objects.get(pk=self.ride.pk)
+        book(self.ride, self.passengers[0], 2)
+        stale.pickup_notes = 'By the bus stop'
+        stale.save()
+        self.assertBooked(2)
+
+    def test_edit_cannot_offer_fewer_seats_than_booked(self):
+        book(self.ride, self.passengers[0], 3)
+        self.client.force_login(self.driver)
+        response = self.client.post(reverse('edit_ride', args=[self.ride.id]), {
+            'origin': 'Truro', 'destination': 'Falmouth',
+            'date': timezone.localtime(self.ride.date).strftime('%Y-%m-%dT%H:%M'),
+            'seats_offered': 2, 'pickup_notes': 'Car park',
+        })
+        self.assertIn('seats_offered', response.context['form'].errors)
+        self.assertBooked(3)
+
+    def test_seats_offered_never_below_booked(self):
+        book(self.ride, self.passengers[0], 3)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Rides.objects.filter(pk=self.ride.pk).update(seats_offered=2)
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin)
+        response = self.client.post(reverse('admin:rides_rides_change', args=[self.ride.id]), {
+            'driver': self.driver.id, 'origin': 'Truro', 'destination': 'Falmouth',
+            'date_0': timezone.localtime(self.ride.date).strftime('%Y-%m-%d'),
+            'date_1': timezone.localtime(self.ride.date).strftime('%H:%M:%S'),
+            'seats_offered': 2, 'pickup_notes': 'Car park', 'status': '1',
+        })
+        self.assertIn('seats_offered', response.context['adminform'].form.errors)
+        self.assertBooked(3)
+
+    def test_reconcile_raises_seats_offered_to_fit_bookings(self):
+        book(self.ride, self.passengers[0], 3)
+        book(self.ride, self.passengers[1], 1)
+        Rides.objects.filter(pk=self.ride.pk).update(seats_booked=1)
+        RideRequest.objects.filter(ride=self.ride).update(seats_requested=3)
+        self.assertEqual(reconcile_seats(), [(self.ride.id, 1, 6)])
+        self.ride.refresh_from_db()
+        self.assertEqual((self.ride.seats_offered, self.ride.seats_booked), (6, 6))
+
+    def test_reconcile_invalidates_each_batchs_searches(self):
+        other = make_ride(self.driver, 'Penzance', 'Newquay')
+        Rides.objects.filter(pk__in=[self.ride.pk, other.pk]).update(seats_booked=1)
+        searches = [{'origin': 'Truro', 'destination': 'Falmouth'}, {'origin': 'Penzance', 'destination': 'Newquay'}]
+        for params in searches:
+            self.client.get(reverse('search_rides'), params)  # cached with the drifted counts
+        with self.captureOnCommitCallbacks(execute=True):
+            reconcile_seats(batch_size=1)
+        for params in searches:
+            rides = self.client.get(reverse('search_rides'), params).context['rides']
+            self.assertEqual([ride.seats_available for ride in rides], [4])
+
+    def test_reconcile_repairs_drift(self):
+        book(self.ride, self.passengers[0], 2)
+        cancelled = book(self.ride, self.passengers[1], 1)
+        RideRequest.objects.filter(pk=cancelled.pk).update(status='3')  # bypassing the services
+        Rides.objects.filter(pk=self.ride.pk).update(seats_booked=0)
+        self.assertEqual(reconcile_seats(repair=False), [(self.ride.id, 0, 2)])
+        self.assertBooked(0)
+        self.assertEqual(reconcile_seats(batch_size=1), [(self.ride.id, 0, 2)])
+        self.assertBooked(2)
+        self.assertEqual(reconcile_seats(), [])
+
+
+class SearchCacheTests(RidesTestCase):
+    """Anonymous searches are cached until a matching ride changes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        cls.passenger = User.objects.create(username='passenger')
+
+    def setUp(self):
+        super().setUp()
+        self.ride = make_ride(self.driver, 'Truro Station', 'Falmouth')
+
+    def search(self, origin='', destination=''):
+        params = {'origin': origin, 'destination': destination} if origin or destination else {}
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('search_rides'), params)
+        rides = {ride.id: ride.seats_available for ride in response.context['rides']}
+        return rides, len(ctx)
+
+    def test_repeat_search_is_served_from_cache(self):
+        self.search('truro', 'falmouth')
+        rides, queries = self.search('Truro ', 'FALMOUTH')
+        self.assertEqual(rides, {self.ride.id: 4})
+        self.assertEqual(queries, 0)
+
+    def test_new_ride_invalidates_matching_searches_only(self):
+        self.search('truro', 'falmouth')
+        self.search('penzance', 'newquay')
+        self.search()
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_ride'), {
+                'origin': 'Truro', 'destination': 'Falmouth Docks',
+                'date': (timezone.now() + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M'),
+                'seats_offered': 2, 'pickup_notes': 'Car park',
+            })
+        self.client.logout()
+        self.assertEqual(len(self.search('truro', 'falmouth')[0]), 2)
+        self.assertEqual(len(self.search()[0]), 2)
+        self.assertEqual(self.search('penzance', 'newquay')[1], 0)
+
+    def test_booking_invalidates_seat_counts(self):
+        self.search('truro', 'falmouth')
+        self.client.force_login(self.passenger)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('request_ride', args=[self.ride.id]), {'seats_requested': 3})
+        self.client.logout()
+        # Fresh as soon as the booking commits, with no worker involved
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(self.search('truro', 'falmouth')[0], {self.ride.id: 1})
+
+    def test_edit_invalidates_old_and_new_places(self):
+        self.search('truro', 'falmouth')
+        self.search('penzance', 'falmouth')
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_ride', args=[self.ride.id]), {
+                'origin': 'Penzance', 'destination': 'Falmouth',
+                'date': self.ride.date.strftime('%Y-%m-%dT%H:%M'),
+                'seats_offered': 4, 'pickup_notes': 'Car park',
+            })
+        self.client.logout()
+        self.assertEqual(self.search('truro', 'falmouth')[0], {})
+        self.assertEqual(self.search('penzance', 'falmouth')[0], {self.ride.id: 4})
+
+
+class ProximitySearchTests(RidesTestCase):
+    """Searched places in the gazetteer match nearby rides, closest first."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+
+    def search(self, origin, destination='Truro', **params):
+        response = self.client.get(reverse('search_rides'), {'origin': origin, 'destination': destination, **params})
+        return [ride.id for ride in response.context['rides']]
+
+    def test_rides_are_located_from_the_gazetteer(self):
+        ride = make_ride(self.driver, 'Aberfala', 'Somewhere Else')
+        falmouth = Place.objects.get(search_name='falmouth')
+        self.assertEqual(
+            (ride.origin_latitude, ride.origin_longitude, ride.origin_geohash),
+            (falmouth.latitude, falmouth.longitude, falmouth.geohash),
+        )
+        self.assertEqual((ride.destination_latitude, ride.destination_geohash), (None, ''))
+
+    def test_nearby_rides_match_ranked_by_detour(self):
+        penryn = make_ride(self.driver, 'Penryn', 'Truro', days=1)
+        falmouth = make_ride(self.driver, 'Falmouth', 'Truro', days=2)
+        make_ride(self.driver, 'Penzance', 'Truro')
+        self.assertEqual(self.search('Falmouth'), [falmouth.id, penryn.id])
+
+    def test_radius_widens_the_search(self):
+        truro = make_ride(self.driver, 'Truro', 'Plymouth')
+        self.assertEqual(self.search('Falmouth', 'Plymouth'), [])
+        self.assertEqual(self.search('Falmouth', 'Plymouth', origin_radius=25), [truro.id])
+
+    def test_unlocated_rides_still_match_by_name(self):
+        docks = make_ride(self.driver, 'Falmouth Docks', 'Truro')
+        self.assertEqual(self.search('falmouth'), [docks.id])
+
+    def test_new_nearby_ride_invalidates_cached_search(self):
+        self.assertEqual(self.search('Falmouth'), [])
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('create_ride'), {
+                'origin': 'Penryn', 'destination': 'Truro',
+                'date': (timezone.now() + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M'),
+                'seats_offered': 2, 'pickup_notes': 'Car park',
+            })
+        self.client.logout()
+        self.assertEqual(len(self.search('Falmouth')), 1)
+
+    def test_covering_cells_contain_every_point_in_radius(self):
+        latitude, longitude = 50.1526, -5.0663
+        for radius in (2, 5, 10, 25):
+            cells = covering_cells(latitude, longitude, radius)
+            for step in range(72):
+                # Points on the edge of the circle, every 5 degrees
+                bearing = step * 5
+                lat = latitude + radius / 110.574 * 0.999 * math.cos(math.radians(bearing))
+                lng = longitude + radius / (111.320 * math.cos(math.radians(lat))) * 0.999 * math.sin(math.radians(bearing))
+                self.assertLessEqual(haversine_km(latitude, longitude, lat, lng), radius * 1.01)
+                self.assertTrue(encode_geohash(lat, lng).startswith(tuple(cells)), (radius, bearing))
+
+    def test_import_geonames_dump(self):
+        rows = [
+            ['1', 'Penryn', 'Penryn', 'Pennrynn', '50.169', '-5.107', 'P', 'PPL', 'GB'] + [''] * 5 + ['7200'] + [''] * 4,
+            ['2', 'Penryn', 'Penryn', '', '51.0', '-1.0', 'P', 'PPL', 'GB'] + [''] * 5 + ['10'] + [''] * 4,
+            ['3', 'Carrick Roads', 'Carrick Roads', '', '50.2', '-5.03', 'H', 'ESTY', 'GB'] + [''] * 10,
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'GB.txt'
+            path.write_text('\n'.join('\t'.join(row) for row in rows) + '\n')
+            import_gazetteer(read_gazetteer(path))
+        penryn = Place.objects.get(search_name='pennrynn')
+        self.assertEqual((penryn.name, penryn.latitude, penryn.population), ('Penryn', 50.169, 7200))
+        self.assertFalse(Place.objects.filter(search_name='carrick roads').exists())
+
+
+class RideBatchTests(RidesTestCase):
+    """Repeat schedules and CSV imports create many rides in one insert."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+
+    @override_settings(TIME_ZONE='Europe/London')
+    def test_schedule_keeps_local_time_across_clock_change(self):
+        # Clocks go back on 25 October 2026
+        first = timezone.make_aware(datetime(2026, 10, 22, 8, 30))
+        dates = schedule_dates(first, 'weekdays', date(2026, 10, 28))
+        self.assertEqual(
+            [timezone.localtime(d).strftime('%a %d %H:%M') for d in dates],
+            ['Thu 22 08:30', 'Fri 23 08:30', 'Mon 26 08:30', 'Tue 27 08:30', 'Wed 28 08:30'],
+        )
+        self.assertEqual(
+            [d.utcoffset() for d in (dates[0], dates[-1])], [timedelta(hours=1), timedelta(0)],
+        )
+
+    def test_validate_ride_batch(self):
+        now = timezone.now()
+        rides = [
+            Rides(origin='Truro', destination='Falmouth', date=now + timedelta(days=1)),
+            Rides(origin='Truro', destination='TRURO', date=now - timedelta(days=1)),
+            Rides(origin='Truro', destination='Falmouth', date=now - timedelta(hours=1)),
+        ]
+        self.assertEqual(validate_ride_batch(rides, now=now), {
+            1: [FUTURE_DATE_ERROR, SAME_PLACE_ERROR],
+            2: [FUTURE_DATE_ERROR],
+        })
+
+    def test_create_ride_series(self):
+        self.client.force_login(self.driver)
+        first = timezone.localtime() + timedelta(days=1)
+        response = self.client.post(reverse('create_ride'), {
+            'origin': 'Penryn', 'destination': 'Truro',
+            'date': first.strftime('%Y-%m-%dT%H:%M'),
+            'seats_offered': 2, 'pickup_notes': 'By the bus stop',
+            'repeat': 'daily', 'repeat_until': (first + timedelta(days=4)).date().isoformat(),
+        })
+        self.assertRedirects(response, reverse('my_rides'))
+        rides = Rides.objects.filter(driver=self.driver).order_by('date')
+        self.assertEqual(len(rides), 5)
+        self.assertEqual({(r.status, r.origin_geohash != '') for r in rides}, {('1', True)})
+
+    def test_create_ride_series_needs_an_end(self):
+        self.client.force_login(self.driver)
+        first = timezone.localtime() + timedelta(days=1)
+        data = {
+            'origin': 'Penryn', 'destination': 'Truro',
+            'date': first.strftime('%Y-%m-%dT%H:%M'), 'seats_offered': 2,
+            'pickup_notes': 'By the bus stop', 'repeat': 'daily',
+        }
+        response = self.client.post(reverse('create_ride'), data)
+        self.assertIn('repeat_until', response.context['form'].errors)
+        data['repeat_until'] = (first + timedelta(days=365)).date().isoformat()
+        response = self.client.post(reverse('create_ride'), data)
+        self.assertIn('repeat_until', response.context['form'].errors)
+        self.assertFalse(Rides.objects.exists())
+
+    def test_create_ride_series_without_dates(self):
+        self.client.force_login(self.driver)
+        first = timezone.localtime() + timedelta(days=1)
+        first += timedelta(days=(5 - first.weekday()) % 7)  # a Saturday
+        response = self.client.post(reverse('create_ride'), {
+            'origin': 'Penryn', 'destination': 'Truro',
+            'date': first.strftime('%Y-%m-%dT%H:%M'), 'seats_offered': 2,
+            'pickup_notes': 'By the bus stop', 'repeat': 'weekdays',
+            'repeat_until': (first + timedelta(days=1)).date().isoformat(),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('repeat_until', response.context['form'].errors)
+        self.assertFalse(Rides.objects.exists())
+
+    def import_rides(self, rows, *args):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'rides.csv'
+            path.write_text('driver,origin,destination,date,seats_offered,pickup_notes\n' + '\n'.join(rows) + '\n')
+            call_command('import_rides', str(path), *args, stdout=StringIO(), stderr=StringIO())
+
+    def test_import_rides_csv(self):
+        tomorrow = (timezone.localdate() + timedelta(days=1)).isoformat()
+        yesterday = (timezone.localdate() - timedelta(days=1)).isoformat()
+        rows = [
+            f'driver,Penryn,Truro,{tomorrow}T08:00,3,Outside the station',
+            f'driver,Truro,Penryn,{tomorrow}T17:30,3,',
+            f'driver,Truro,Penryn,{yesterday}T17:30,3,',
+            f'nobody,Truro,Penryn,{tomorrow}T17:30,3,',
+        ]
+        with self.assertRaisesMessage(CommandError, '2 invalid row(s)'):
+            self.import_rides(rows)
+        self.assertFalse(Rides.objects.exists())
+
+        self.import_rides(rows, '--skip-invalid')
+        rides = Rides.objects.order_by('date')
+        self.assertEqual([(r.origin, r.status, r.pickup_notes) for r in rides], [
+            ('Penryn', '1', 'Outside the station'), ('Truro', '1', ''),
+        ])
+        self.assertNotEqual(rides[0].origin_geohash, '')
+
+
+CALLS = []
+
+
+@task(name='tests.record')
+def record(value, fail=False):
+    CALLS.append(value)
+    if fail:
+        raise RuntimeError('try again')
+
+
+class TaskQueueTests(RidesTestCase):
+    """Side effects are queued in the database and run by the worker."""
+
+    def setUp(self):
+        super().setUp()
+        CALLS.clear()
+
+    def test_pending_tasks_are_deduplicated(self):
+        record.enqueue(1, dedupe_key='k')
+        record.enqueue(2, dedupe_key='k')
+        record.enqueue(3)
+        self.assertEqual(run_pending(), (2, 0))
+        self.assertEqual(CALLS, [1, 3])
+        record.enqueue(4, dedupe_key='k')  # the first one has run
+        self.assertEqual(run_pending(), (1, 0))
+        self.assertFalse(Task.objects.exists())
+
+    def test_failures_are_retried_with_backoff_then_kept(self):
+        record.enqueue('x', fail=True, dedupe_key='k')
+        with self.assertLogs('rides.queue', 'WARNING') as logs:
+            self.assertEqual(run_pending(), (0, 1))
+            queued = Task.objects.get()
+            self.assertEqual((queued.status, queued.attempts), ('0', 1))
+            self.assertGreater(queued.run_after, timezone.now())
+            self.assertEqual(run_pending(), (0, 0))  # not due yet
+            for _ in range(4):
+                Task.objects.update(run_after=timezone.now())
+                run_pending()
+        self.assertEqual(len(logs.output), 5)
+        failed = Task.objects.get()
+        self.assertEqual((failed.status, failed.attempts, len(CALLS)), ('2', 5, 5))
+        self.assertIn('RuntimeError: try again', failed.last_error)
+        record.enqueue('y', dedupe_key='k')  # failed tasks don't block new work
+        self.assertEqual(Task.objects.count(), 2)
+
+    def test_expired_lease_is_claimed_again(self):
+        record.enqueue(1)
+        first = claim_tasks()
+        self.assertEqual(claim_tasks(), [])
+        Task.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        second = claim_tasks()
+        self.assertEqual([t.pk for t in second], [t.pk for t in first])
+        self.assertEqual(second[0].attempts, 2)
+
+    @override_settings(RIDES_TASKS_EAGER=True)
+    def test_eager_mode_runs_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            record.enqueue(1)
+            self.assertEqual(CALLS, [])
+        self.assertEqual(CALLS, [1])
+        self.assertFalse(Task.objects.exists())
+
+    def test_worker_command(self):
+        record.enqueue(1)
+        record.enqueue(2, fail=True)
+        out, err = StringIO(), StringIO()
+        with self.assertLogs('rides.queue', 'WARNING'):
+            call_command('worker', '--once', stdout=out, stderr=err)
+        self.assertIn('Ran 2 task(s): 1 succeeded, 1 failed', out.getvalue())
+        Task.objects.update(status='2')
+        call_command('worker', '--retry-failed', stdout=out)
+        self.assertEqual(Task.objects.get().status, '0')
+
+    # Only a cache the worker shares can be invalidated from it
+    @mock.patch('rides.tasks.cache_is_shared', return_value=True)
+    def test_bookings_queue_one_search_invalidation(self, cache_is_shared):
+        driver = User.objects.create(username='driver')
+        ride = make_ride(driver)
+        for i in range(3):
+            book(ride, User.objects.create(username=f'p{i}'))
+        queued = Task.objects.get()
+        self.assertEqual(queued.payload, {'args': [[['truro', 'falmouth']]], 'kwargs': {}})
+
+
+class ArchiveTests(RidesTestCase):
+    """Departed rides expire their pending requests and are archived later, in chunks."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        cls.passengers = User.objects.bulk_create([User(username=f'passenger{i}') for i in range(3)])
+
+    def setUp(self):
+        super().setUp()
+        self.now = timezone.now()
+
+    def ride(self, days, requests=()):
+        ride = make_ride(self.driver, days=days)
+        for passenger, status in zip(self.passengers, requests):
+            RideRequest.objects.create(passenger=passenger, ride=ride, status=status)
+        Rides.objects.filter(pk=ride.pk).update(seats_booked=sum(s in ('0', '1', '4') for s in requests))
+        return ride
+
+    def test_expire_pending_requests_on_departed_rides(self):
+        departed = [self.ride(-1, ['0', '1', '0']) for _ in range(3)]
+        upcoming = self.ride(1, ['0'])
+        self.assertEqual(expire_requests(self.now, batch_size=2), 6)
+        self.assertEqual(
+            sorted(RideRequest.objects.filter(ride__in=departed).values_list('status', flat=True)),
+            ['1', '1', '1', '5', '5', '5', '5', '5', '5'],
+        )
+        self.assertEqual(set(Rides.objects.filter(pk__in=[r.pk for r in departed]).values_list('seats_booked', flat=True)), {1})
+        self.assertEqual(upcoming.ride_requests.get().status, '0')
+        self.assertEqual(expire_requests(self.now), 0)
+
+    def test_old_rides_move_to_the_archive_with_their_requests(self):
+        old = [self.ride(-100, ['1', '3']) for _ in range(3)]
+        recent = self.ride(-10, ['1'])
+        self.assertEqual(archive_rides(self.now - timedelta(days=90), batch_size=2), (3, 6))
+        self.assertEqual(list(Rides.objects.values_list('pk', flat=True)), [recent.pk])
+        self.assertEqual(RideRequest.objects.count(), 1)
+        archived = ArchivedRide.objects.get(pk=old[0].pk)
+        self.assertEqual((archived.driver, archived.seats_booked, archived.date), (self.driver, 1, old[0].date))
+        self.assertEqual(
+            sorted(ArchivedRideRequest.objects.filter(ride_id=old[0].pk).values_list('status', flat=True)), ['1', '3'],
+        )
+
+    def test_old_closed_requests_are_archived_from_live_rides(self):
+        ride = self.ride(5, ['1', '2', '3'])
+        RideRequest.objects.filter(ride=ride).update(updated_on=self.now - timedelta(days=100))
+        self.assertEqual(archive_closed_requests(self.now - timedelta(days=90), batch_size=1), 2)
+        self.assertEqual(ride.ride_requests.get().status, '1')
+        self.assertEqual(set(ArchivedRideRequest.objects.values_list('ride_id', flat=True)), {ride.pk})
+
+    def test_command_expires_and_archives(self):
+        self.ride(-200, ['0'])
+        recent = self.ride(-1, ['0'])
+        out = StringIO()
+        call_command('archive_rides', '--days=90', stdout=out)
+        self.assertIn('Expired 2 pending', out.getvalue())
+        self.assertIn('Archived 1 ride(s) with 1 request(s)', out.getvalue())
+        self.assertEqual(ArchivedRideRequest.objects.get().status, '5')
+        self.assertEqual(recent.ride_requests.get().status, '5')
+
+
+class AdminChangelistTests(RidesTestCase):
+    """The ride and request changelists cost the same few queries at any size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drivers, cls.passengers = seed_rides(drivers=5, rides_per_driver=20, passengers=5)
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.admin)
+
+    def changelist_queries(self, name, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(f'admin:{name}_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        for name in ('rides_rides', 'rides_riderequest'):
+            before = self.changelist_queries(name)
+            rides = Rides.objects.bulk_create([
+                Rides(driver=driver, origin='Truro', destination='Falmouth', date=timezone.now(), pickup_notes='')
+                for driver in self.drivers for _ in range(20)
+            ])
+            RideRequest.objects.bulk_create([
+                RideRequest(passenger=passenger, ride=ride) for ride in rides for passenger in self.passengers
+            ])
+            self.assertEqual(self.changelist_queries(name), before, name)
+
+    def test_search_by_passenger_username(self):
+        passenger = self.passengers[0]
+        response = self.client.get(reverse('admin:rides_riderequest_changelist'), {'q': passenger.username})
+        self.assertEqual(
+            {request.passenger for request in response.context['cl'].result_list}, {passenger},
+        )
+
+    def test_request_form_does_not_list_users_or_rides(self):
+        response = self.client.get(reverse('admin:rides_riderequest_add'))
+        self.assertNotContains(response, f'>{self.passengers[0].username}</option>')
+        self.assertNotContains(response, f'<option value="{Rides.objects.first().pk}"')
+
+    def test_ride_autocomplete(self):
+        response = self.client.get(reverse('admin:autocomplete'), {
+            'term': '"Town 12"', 'app_label': 'rides', 'model_name': 'riderequest', 'field_name': 'ride',
+        })
+        results = response.json()['results']
+        self.assertTrue(results)
+        self.assertTrue(all('Town 12' in result['text'] for result in results))
+
+
+@override_settings(RIDES_PROFILE_SAMPLE_RATE=1)
+class ProfileMiddlewareTests(RidesTestCase):
+    """Sampled requests report their timings and feed the per-view percentiles."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        cls.ride = make_ride(cls.driver, seats_offered=3)
+
+    def setUp(self):
+        super().setUp()
+        view_stats.reset()
+
+    def timings(self, response):
+        timings = {}
+        for metric in response.headers['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            timings[name] = dict(param.split('=', 1) for param in params)
+        return timings
+
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('ride_detail', args=[self.ride.pk]))
+        timings = self.timings(response)
+        self.assertEqual(timings['db']['desc'], f'"{len(queries)} queries"')
+        self.assertEqual(timings['dupes']['desc'], '"0 repeated queries"')
+        self.assertGreater(float(timings['tpl']['dur']), 0)
+        self.assertGreaterEqual(float(timings['total']['dur']), float(timings['tpl']['dur']))
+
+    async def test_async_stack(self):
+        response = await self.async_client.get(reverse('search_rides'))
+        self.assertIn('queries', self.timings(response)['db']['desc'])
+        self.assertEqual(view_stats.report()[0]['view'], 'search_rides')
+
+    @override_settings(RIDES_PROFILE_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_left_alone(self):
+        response = self.client.get(reverse('search_rides'))
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(view_stats.report(), [])
+
+    def test_repeated_queries_are_counted(self):
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            for pk in (self.ride.pk, self.ride.pk, self.ride.pk + 1):
+                Rides.objects.filter(pk=pk).exists()
+        finally:
+            _current.reset(token)
+        self.assertEqual((profile.query_count, profile.duplicates), (3, 1))
+
+    def test_report_is_staff_only(self):
+        for _ in range(3):
+            self.client.get(reverse('ride_detail', args=[self.ride.pk]))
+        self.client.force_login(self.driver)
+        self.assertEqual(self.client.get(reverse('profile_report')).status_code, 302)
+        self.client.force_login(User.objects.create(username='staff', is_staff=True))
+        rows = {row['view']: row for row in self.client.get(reverse('profile_report')).context['rows']}
+        self.assertEqual(rows['ride_detail']['samples'], 3)
+        self.client.post(reverse('profile_report'))
+        self.assertEqual(list(view_stats.samples), ['profile_report'])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, pct) for pct in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+class DashboardTests(RidesTestCase):
+    """My Rides and My Ride Requests are cached per user until a booking or ride change."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver', first_name='Dee', last_name='Driver')
+        cls.passenger = User.objects.create(username='passenger')
+        cls.upcoming, cls.past = [make_ride(cls.driver, days=days, seats_offered=3) for days in (1, -1)]
+        RideRequest.objects.create(passenger=cls.passenger, ride=cls.past, status='4')
+
+    def get(self, user, name, **params):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(name), params)
+        listing_queries = [q for q in queries if 'rides_rides' in q['sql'] or 'rides_riderequest' in q['sql']]
+        return response, len(listing_queries)
+
+    def ride_ids(self, response, key):
+        return [row.get('ride_id', row['id']) for row in response.context[key]]
+
+    def test_sections(self):
+        response, queries = self.get(self.driver, 'my_rides')
+        self.assertEqual(self.ride_ids(response, 'rides'), [self.upcoming.pk])
+        self.assertEqual(queries, 1)  # one indexed query, no count for a single page
+        response, _ = self.get(self.driver, 'my_rides', section='past')
+        self.assertEqual(self.ride_ids(response, 'rides'), [self.past.pk])
+        response, _ = self.get(self.passenger, 'my_ride_requests', section='past')
+        row = response.context['ride_requests'][0]
+        self.assertEqual((row['driver_name'], row['status_display']), ('Dee Driver', 'Completed'))
+        self.assertContains(response, 'Dee Driver')
+
+    def test_pages_are_cached_until_a_booking(self):
+        self.get(self.passenger, 'my_ride_requests')
+        self.get(self.driver, 'my_rides')
+        response, queries = self.get(self.passenger, 'my_ride_requests')
+        self.assertEqual((response.context['ride_requests'], queries), ([], 0))
+        with self.captureOnCommitCallbacks(execute=True):
+            book(self.upcoming, self.passenger, 2)
+        response, _ = self.get(self.passenger, 'my_ride_requests')
+        self.assertEqual(self.ride_ids(response, 'ride_requests'), [self.upcoming.pk])
+        response, _ = self.get(self.driver, 'my_rides')
+        self.assertEqual(response.context['rides'][0]['seats_available'], 1)
+
+    def test_ride_edit_reaches_its_passengers(self):
+        RideRequest.objects.create(passenger=self.passenger, ride=self.upcoming)
+        self.get(self.passenger, 'my_ride_requests')
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_ride', args=[self.upcoming.pk]), {
+                'origin': 'Truro', 'destination': 'Penzance',
+                'date': timezone.localtime(self.upcoming.date).strftime('%Y-%m-%dT%H:%M'),
+                'seats_offered': 3, 'pickup_notes': 'Car park',
+            })
+        response, _ = self.get(self.passenger, 'my_ride_requests')
+        self.assertEqual(response.context['ride_requests'][0]['destination'], 'Penzance')
+
+    def test_departed_rides_leave_cached_upcoming_pages(self):
+        self.get(self.driver, 'my_rides')
+        later = self.upcoming.date + timedelta(minutes=1)
+        with self.assertNumQueries(0):
+            page = async_to_sync(aget_dashboard_page)('rides', self.driver.pk, 'upcoming', now=later)
+        self.assertEqual(page.items, [])
+
+
+class PlaceSuggestionTests(RidesTestCase):
+    """Place suggestions come from the in-process index, not a query per keystroke."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        now = timezone.now()
+        Rides.objects.bulk_create([
+            Rides(driver=cls.driver, origin=origin, destination=destination,
+                  date=now + timedelta(days=days), pickup_notes='', status='1')
+            for origin, destination, days in [
+                ('Truro', 'Falmouth', 1), ('truro ', 'Penzance', 2), ('Trispen', 'Truro', 3),
+                ('Tregony', 'Falmouth', -3),  # departed
+            ]
+        ])
+
+    def setUp(self):
+        super().setUp()
+        place_index.data, place_index.built = ([], {}), None
+
+    def suggest(self, query):
+        response = self.client.get(reverse('suggest_places'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['suggestions']
+
+    def test_prefix_lookup(self):
+        index = PlaceIndex()
+        index.add('Truro', 'Trispen', 'truro', 'St Austell', 'Truro')
+        self.assertEqual(index.suggest('TR'), ['Truro', 'Trispen'])  # most rides first
+        self.assertEqual(index.suggest('  st  aus'), ['St Austell'])
+        self.assertEqual(index.suggest('tr', limit=1), ['Truro'])
+        self.assertEqual(index.suggest('x'), [])
+        self.assertEqual(index.suggest(' '), [])
+
+    def test_endpoint_builds_index_once(self):
+        self.assertEqual(self.suggest('tr'), ['Truro', 'Trispen'])  # Tregony's ride has left
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('f'), ['Falmouth'])
+
+    def test_new_and_edited_rides_are_added(self):
+        self.suggest('p')
+        with self.captureOnCommitCallbacks(execute=True):
+            create_rides([Rides(
+                driver=self.driver, origin='Perranporth', destination='Newquay',
+                date=timezone.now() + timedelta(days=1), pickup_notes='', status='1',
+            )])
+        ride = Rides.objects.get(origin='Truro')
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_ride', args=[ride.pk]), {
+                'origin': 'Truro', 'destination': 'Padstow',
+                'date': timezone.localtime(ride.date).strftime('%Y-%m-%dT%H:%M'),
+                'seats_offered': 1, 'pickup_notes': 'Car park',
+            })
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('p'), ['Padstow', 'Penzance', 'Perranporth'])
+
+
+class RideEventTests(RidesTestCase):
+    """Seat and status changes reach the pages subscribed to their rides once committed."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver')
+        cls.passenger = User.objects.create(username='passenger')
+        cls.ride = make_ride(cls.driver, seats_offered=3)
+
+    def commit_booking(self, seats):
+        with self.captureOnCommitCallbacks(execute=True):
+            book(self.ride, self.passenger, seats)
+
+    async def next_event(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), 1)
+        event, data = chunk.strip().split('\n')
+        self.assertEqual(event, 'event: ride')
+        return json.loads(data.removeprefix('data: '))
+
+    async def test_stream_sends_state_then_changes(self):
+        stream = ride_event_stream({self.ride.pk, 0})
+        self.assertEqual(await anext(stream), 'retry: 5000\n\n')
+        self.assertEqual(await self.next_event(stream), {'id': 0, 'deleted': True})
+        self.assertEqual(await self.next_event(stream), {
+            'id': self.ride.pk, 'seats_available': 3, 'status': '1', 'status_display': 'Published',
+        })
+        await sync_to_async(self.commit_booking)(2)
+        self.assertEqual((await self.next_event(stream))['seats_available'], 1)
+        await stream.aclose()
+        self.assertNotIn(self.ride.pk, get_broker().subscribers)
+
+    async def test_deleted_ride(self):
+        stream = ride_event_stream({self.ride.pk})
+        await anext(stream)
+        await self.next_event(stream)
+        await self.client_delete_ride()
+        self.assertEqual(await self.next_event(stream), {'id': self.ride.pk, 'deleted': True})
+        await stream.aclose()
+
+    @sync_to_async
+    def client_delete_ride(self):
+        self.client.force_login(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('delete_ride', args=[self.ride.pk]))
+
+    def test_unwatched_rides_are_not_published(self):
+        with self.assertNumQueries(0):
+            publish_rides(self.ride.pk)
+
+    def test_endpoint(self):
+        url = reverse('ride_events')
+        # Sync workers can't hold streams open
+        self.assertEqual(self.client.get(url, {'ids': self.ride.pk}).status_code, 204)
+        with self.settings(SERVER_MODE='asgi', RIDES_EVENTS_MAX_RIDES=2):
+            self.assertEqual(self.client.get(url, {'ids': 'x'}).status_code, 204)
+            self.assertEqual(self.client.get(url, {'ids': '1,2,3'}).status_code, 400)
+
+    @override_settings(SERVER_MODE='asgi')
+    async def test_asgi_endpoint_streams(self):
+        response = await self.async_client.get(reverse('ride_events'), {'ids': '999999,x'})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        stream = aiter(response)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+        self.assertEqual(await anext(stream), b'event: ride\ndata: {"id": 999999, "deleted": true}\n\n')
+        await stream.aclose()
+
+
+class ExportTests(RidesTestCase):
+    """Exports stream rows a chunk at a time with related users joined in."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.drivers, cls.passengers = seed_rides(drivers=3, rides_per_driver=20, passengers=5)
+        cls.driver = cls.drivers[0]
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.driver)
+
+    def download(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_driver_exports_own_rides_as_csv(self):
+        rows = list(csv.DictReader(StringIO(self.download('export_my_rides'))))
+        rides = Rides.objects.filter(driver=self.driver).order_by('pk')
+        self.assertEqual([int(row['id']) for row in rows], [ride.pk for ride in rides])
+        self.assertEqual({row['driver'] for row in rows}, {self.driver.username})
+        self.assertEqual(datetime.fromisoformat(rows[0]['date']), rides[0].date)
+
+    def test_driver_exports_bookings_as_ndjson(self):
+        lines = self.download('export_my_ride_bookings', format='ndjson').splitlines()
+        bookings = RideRequest.objects.filter(ride__driver=self.driver)
+        self.assertEqual(len(lines), bookings.count())
+        row = json.loads(lines[0])
+        self.assertEqual(row['driver'], self.driver.username)
+        self.assertNotIn('passenger_email', row)
+        self.assertIn(row['passenger'], {passenger.username for passenger in self.passengers})
+
+    def test_unknown_format(self):
+        self.assertEqual(self.client.get(reverse('export_my_rides'), {'format': 'xml'}).status_code, 404)
+
+    def test_rows_are_read_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            chunks = list(export_lines(Rides.objects.all(), RIDE_COLUMNS, chunk_size=25))
+        self.assertEqual(len(queries), 1)  # drivers joined, not looked up per row
+        self.assertEqual(len(chunks), 1 + math.ceil(Rides.objects.count() / 25))
+        self.assertEqual(chunks[0].strip(), ','.join(name for name, _ in RIDE_COLUMNS))
+
+    @override_settings(SERVER_MODE='asgi')
+    async def test_asgi_streams_asynchronously(self):
+        await self.async_client.aforce_login(self.driver)
+        response = await self.async_client.get(reverse('export_my_rides'), {'format': 'ndjson'})
+        self.assertTrue(response.is_async)
+        lines = [line async for chunk in response.streaming_content for line in chunk.decode().splitlines()]
+        self.assertEqual(len(lines), await Rides.objects.filter(driver=self.driver).acount())
+
+    def test_admin_export_action(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(admin)
+        selected = RideRequest.objects.order_by('pk')[:3]
+        response = self.client.post(reverse('admin:rides_riderequest_changelist'), {
+            'action': 'export_csv', '_selected_action': [request.pk for request in selected],
+        })
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row['id']) for row in rows], [request.pk for request in selected])
+        self.assertEqual(rows[0]['passenger_email'], selected[0].passenger.email)
+
+
+class StaticAssetTests(RidesTestCase):
+    """Templates link static files by content-hashed names, pre-compressed and cached for good."""
+
+    def test_static_references_are_hashed(self):
+        names = set()
+        for template in Path(settings.BASE_DIR).glob('**/templates/**/*.html'):
+            # The allauth template overrides include ones for allauth.mfa, which isn't installed
+            if 'mfa' in template.parts and not apps.is_installed('allauth.mfa'):
+                continue
+            names.update(re.findall(r"{%\s*static\s+['\"]([^'\"]+)['\"]", template.read_text()))
+        self.assertIn('css/style.css', names)
+        # The project's storage, rather than the test runner's
+        storages = import_module(os.environ['DJANGO_SETTINGS_MODULE']).STORAGES
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root, STORAGES=storages):
+            # Leave out the admin's files, which take a while to compress
+            call_command('collectstatic', interactive=False, verbosity=0,
+                         ignore_patterns=['admin', 'cloudinary'])
+            for name in sorted(names):
+                url = static(name)
+                self.assertRegex(url, r'\.[0-9a-f]{12}\.\w+$', name)
+                path = Path(root, url.removeprefix(settings.STATIC_URL))
+                self.assertTrue(path.exists(), name)
+                if path.suffix in ('.css', '.js'):
+                    self.assertTrue(path.with_name(path.name + '.gz').exists(), name)
+                    self.assertTrue(path.with_name(path.name + '.br').exists(), name)
+
+            response = self.client.get(static('css/style.css'), HTTP_ACCEPT_ENCODING='gzip, br')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertIn('immutable', response['Cache-Control'])
+
+
+class CountingImages:
+    calls = 0
+
+    def url(self, public_id, version, fmt, width):
+        CountingImages.calls += 1
+        return f'https://images.example/{width}/{public_id}.{fmt}'
+
+
+@override_settings(RIDES_IMAGE_BACKEND='rides.tests.CountingImages')
+class AvatarTests(RidesTestCase):
+    """Avatars use small memoized variants of profile pictures, or a static placeholder."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver', first_name='Kit')
+        UserProfile.objects.create(user=cls.driver, profile_picture='image/upload/v1712/drivers/kit.png')
+        cls.ride = make_ride(cls.driver)
+
+    def setUp(self):
+        super().setUp()
+        variants.cache_clear()
+        CountingImages.calls = 0
+
+    def test_variant_urls_are_built_once_per_upload(self):
+        picture = UserProfile.objects.get(user=self.driver).profile_picture
+        sources = avatar_sources(picture, 40)
+        self.assertEqual(sources['src'], 'https://images.example/64/drivers/kit.png')
+        self.assertEqual(sources['srcset'].count('w, '), 2)
+        for size in (32, 96, 200):
+            avatar_sources(picture, size)
+        self.assertEqual(CountingImages.calls, 3)
+        picture.version = '1713'  # a new upload
+        avatar_sources(picture, 32)
+        self.assertEqual(CountingImages.calls, 6)
+
+    def test_placeholder(self):
+        for picture in (None, 'placeholder', UserProfile(user=self.driver).profile_picture):
+            self.assertEqual(avatar_sources(picture, 32), {'src': '/static/images/avatar-placeholder.svg', 'srcset': ''})
+        self.assertEqual(CountingImages.calls, 0)
+
+    def test_search_results_show_lazy_avatars(self):
+        response = self.client.get(reverse('search_rides'))
+        self.assertContains(response, 'srcset="https://images.example/32/drivers/kit.png 32w,')
+        self.assertContains(response, 'loading="lazy"')
+
+    def test_new_picture_or_name_refreshes_cached_cards(self):
+        # Logged in, so the search page itself isn't served from the page cache
+        self.client.force_login(User.objects.create(username='passenger'))
+        detail_url = reverse('ride_detail', args=[self.ride.id])
+        self.client.get(reverse('search_rides'))
+        etag = self.client.get(detail_url)['ETag']
+        UserProfile.objects.filter(user=self.driver).update(profile_picture='image/upload/v1713/drivers/kit-new.png')
+        User.objects.filter(pk=self.driver.pk).update(first_name='Kitto')
+        for response in (
+            self.client.get(reverse('search_rides')),
+            self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag),
+        ):
+            self.assertContains(response, 'https://images.example/32/drivers/kit-new.png')
+            self.assertContains(response, 'Kitto')
+
+    @override_settings(RIDES_IMAGE_BACKEND='rides.images.LocalImages')
+    def test_local_images_show_the_placeholder(self):
+        picture = UserProfile.objects.get(user=self.driver).profile_picture
+        sources = avatar_sources(picture, 32)
+        self.assertEqual(sources['srcset'], '')
+        self.assertTrue(finders.find(sources['src'].removeprefix(settings.STATIC_URL)))
+
+
+class SmallBatchSessionStore(SessionStore):
+    clear_batch_size = 2
+
+
+class SessionAuthTests(RidesTestCase):
+    """The signed-in user comes with their profile, and expired sessions go in batches."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('rider', password='pw')
+        UserProfile.objects.create(user=cls.user, location='Truro')
+
+    def test_user_and_profile_in_one_query(self):
+        with self.assertNumQueries(1):
+            user = ModelBackend().get_user(self.user.pk)
+            self.assertEqual(user.profile.location, 'Truro')
+        user = async_to_sync(ModelBackend().aget_user)(self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.profile.location, 'Truro')
+        self.assertIsNone(ModelBackend().get_user(0))
+
+    def test_sessions_of_replaced_backends_stay_signed_in(self):
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('search_rides'))
+        self.assertEqual(response.context['user'], self.user)
+        self.assertEqual(self.client.session['_auth_user_backend'], 'rides.auth.ModelBackend')
+
+    def test_clearsessions_deletes_in_batches(self):
+        now = timezone.now()
+        for days in (-3, -2, -2, -1, -1, 1):
+            store = SessionStore()
+            store.set_expiry(now + timedelta(days=days))
+            store.create()
+        with CaptureQueriesContext(connection) as queries:
+            SmallBatchSessionStore.clear_expired()
+        deletes = [query for query in queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(SessionStore.get_model_class().objects.count(), 1)
+
+
+class SearchFormTests(RidesTestCase):
+    """The search form renders through its own template, in crispy's Bootstrap markup."""
+
+    def test_markup(self):
+        response = self.client.get(reverse('search_rides'))
+        self.assertContains(response, '<option value="5" selected>Within 5 km</option>', count=2, html=True)
+        self.assertContains(response, 'data-suggest-url="/places/suggest/"', count=2)
+
+        response = self.client.get(reverse('search_rides'), {'origin': 'Truro', 'min_passengers': 9})
+        self.assertContains(response, 'value="Truro"')
+        self.assertContains(response, 'class="numberinput form-control is-invalid"')
+        self.assertContains(response, 'aria-describedby="id_min_passengers_error"')
+        self.assertContains(response, 'Ensure this value is less than or equal to 5.')
+
+
+class RideDetailConditionalGetTests(RidesTestCase):
+    """Unchanged rides answer conditional GETs with 304 Not Modified."""
+
+    @classmethod
+    def setUpTestData(cls):
+        driver = User.objects.create(username='driver')
+        cls.passenger = User.objects.create(username='passenger')
+        cls.ride = make_ride(driver)
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('ride_detail', args=[self.ride.id])
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since_is_not_modified(self):
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_booking_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        book(self.ride, self.passenger, 2)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['ride'].seats_available, 2)
+
+    def test_deploy_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.settings(RELEASE='next'):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_differs_per_viewer(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(self.passenger)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class BenchmarkSuiteTests(TransactionTestCase):
+    """seed_data and benchmark, which guard the hot paths before a deploy."""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_generated_data_is_reproducible_and_consistent(self):
+        _, rides, ride_requests = generate_data(30, 200, 300, seed=1)
+        _, same_seed_rides, _ = generate_data(30, 200, 300, seed=1)
+        self.assertEqual(
+            [(r.origin, r.destination, r.date) for r in rides],
+            [(r.origin, r.destination, r.date) for r in same_seed_rides],
+        )
+        self.assertEqual(len(ride_requests), 300)
+        self.assertFalse(Rides.objects.filter(seats_booked__gt=F('seats_offered')).exists())
+        self.assertFalse(Rides.objects.filter(origin=F('destination')).exists())
+        self.assertFalse(RideRequest.objects.filter(passenger=F('ride__driver')).exists())
+
+    def test_compare_flags_regressions_beyond_threshold(self):
+        baseline = {'scenarios': {'search_rides': {'p50_ms': 20, 'p99_ms': 40, 'peak_kb': 400, 'queries': 2}}}
+        current = {'scenarios': {'search_rides': {'p50_ms': 23, 'p99_ms': 60, 'peak_kb': 410, 'queries': 3}}}
+        regressions = compare_results(baseline, current, threshold=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('search_rides p99_ms: 40 -> 60'))
+        self.assertTrue(regressions[1].startswith('search_rides queries: 2 -> 3'))
+
+    def test_benchmark_saves_and_compares_baseline(self):
+        generate_data(20, 100, 100)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'baseline.json'
+            options = {'requests': 3, 'warmup': 1, 'memory_samples': 1, 'stdout': StringIO()}
+            call_command('benchmark', save=str(path), **options)
+            baseline = json.loads(path.read_text())
+            self.assertEqual(
+                set(baseline['scenarios']),
+                {'apply_search_filters', 'search_rides', 'request_ride', 'my_ride_requests',
+                 'render_search_form', 'render_search_page'},
+            )
+            # Bookings are rolled back, so benchmarking leaves the data alone
+            self.assertEqual(baseline['meta']['ride_requests'], RideRequest.objects.count())
+
+            call_command('benchmark', compare=str(path), threshold=100, **options)
+            baseline['scenarios']['search_rides']['queries'] = 0
+            path.write_text(json.dumps(baseline))
+            with self.assertRaises(CommandError):
+                call_command('benchmark', 'search_rides', compare=str(path), threshold=100,
+                             stderr=StringIO(), **options)
@@ -3,6 +3,8 @@ from . import views # import views.py from the current directory
 
 urlpatterns = [
     path('', views.search_rides, name='search_rides'),
+    path('rides/events/', views.ride_events, name='ride_events'),
+    path('places/suggest/', views.suggest_places, name='suggest_places'),
     path('create-ride/', views.create_ride, name='create_ride'),
     path('rides/<int:ride_id>/', views.ride_detail, name='ride_detail'),
     path('rides/<int:ride_id>/edit/', views.edit_ride, name='edit_ride'),
@@ -10,5 +12,8 @@ urlpatterns = [
     path('rides/<int:ride_id>/request/', views.request_ride, name='request_ride'),
     path('booking/<int:request_id>/confirmation/', views.ride_request_confirmation, name='ride_request_confirmation'),
     path('my-rides/', views.my_rides, name='my_rides'),
+    path('my-rides/export/', views.export_my_rides, name='export_my_rides'),
+    path('my-rides/bookings/export/', views.export_my_ride_bookings, name='export_my_ride_bookings'),
     path('my-ride-requests/', views.my_ride_requests, name='my_ride_requests'),
+    path('staff/profile/', views.profile_report, name='profile_report'),
 ]
\ No newline at end of file
@@ -1,54 +1,165 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import os
+
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.db import transaction
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils.html import mark_safe
 from django.urls import reverse
-from .models import Rides, RideRequest, UserProfile
+from django.views.decorators.cache import cache_control
+from .models import Place, Rides, RideRequest, UserProfile, driver_version
 from .forms import RideSearchForm, RideCreateForm
+from .pagination import apaginate_keyset
+from .dashboard import (
+    SECTIONS, aget_dashboard_page, invalidate_dashboards_on_commit, ride_dashboard_users,
+)
+from .services import create_rides, lock_seat_counts, reserve_seats, SeatsUnavailable
+from .cache import aget_or_set_search, search_params
+from .profiling import view_stats
+from .events import publish_rides_on_commit, ride_event_stream
+from .exports import DRIVER_REQUEST_COLUMNS, FORMATS, RIDE_COLUMNS, export_response
+from .suggest import add_ride_places_on_commit, place_index, refresh_place_index
+from .tasks import queue_search_invalidation, queue_ride_search_invalidation
+
+async def resolve_user(request):
+    """
+    Load the user with the async auth API and pin it on the request, so
+    templates (navbar, context processors) don't trigger a sync DB lookup
+    inside the async view.
+    """
+    request.user = await request.auser()
+    return request.user
 
-def search_rides(request):
+
+async def search_rides(request):
     """Render the home page with ride search form"""
-    form = RideSearchForm(request.GET or None)
+    user = await resolve_user(request)
     
-    # Start with all published, available rides
-    rides = Rides.objects.filter(
-        date__gt=timezone.now(),
-        seats_available__gt=0,
-        status='1'  # Only published rides
-    )
+    # The pagination cursor isn't a search field, keep it out of the form
+    form_data = request.GET.copy()
+    form_data.pop('cursor', None)
+    form = RideSearchForm(form_data or None)
     
-    # Apply search filters from form (must be called on manager)
-    rides = rides.apply_search_filters(form)
+    cursor = request.GET.get('cursor')
     
-    # Exclude rides created by the logged-in user
-    if request.user.is_authenticated:
-        rides = rides.exclude(driver=request.user)
+    async def find_rides():
+        # Start with all published, available rides
+        rides = Rides.objects.with_driver().filter(
+            date__gt=timezone.now(),
+            status='1'  # Only published rides
+        ).with_seats_left()
+        
+        # Apply search filters from form (must be called on manager).
+        # Places in the gazetteer are searched by distance.
+        places = {}
+        if form.is_valid():
+            places = await Place.objects.aresolve(form.cleaned_data['origin'], form.cleaned_data['destination'])
+        rides = rides.apply_search_filters(form, places)
+        
+        # Exclude rides created by the logged-in user
+        if user.is_authenticated:
+            rides = rides.exclude(driver=user)
+        
+        # Shortest detour or best place match first (when searching), then soonest departure
+        return await apaginate_keyset(rides, rides.search_order_keys(), cursor)
     
-    # Order by date
-    rides = rides.order_by('date')
+    # Anonymous results are the same for everyone, so they're cached
+    if user.is_authenticated:
+        page = await find_rides()
+    else:
+        page = await aget_or_set_search(search_params(form, cursor), find_rides)
     
     # Add user's existing requests to each ride for template logic
-    if request.user.is_authenticated:
+    if user.is_authenticated:
         user_requests = RideRequest.objects.filter(
-            passenger=request.user,
-            ride__in=rides
+            passenger=user,
+            ride__in=[ride.id for ride in page]
         ).values_list('ride_id', flat=True)
-        user_request_ids = set(user_requests)
+        user_request_ids = {ride_id async for ride_id in user_requests}
     else:
         user_request_ids = set()
     
     context = {
         'form': form,
-        'rides': rides,
+        'rides': page.items,
+        'page': page,
         'user_request_ids': user_request_ids
     }
     return render(request, 'rides/search_rides.html', context)
 
-def ride_detail(request, ride_id):
-    """Display full details for a single ride."""
-    ride = get_object_or_404(Rides, id=ride_id)
-    return render(request, 'rides/ride_detail.html', {'ride': ride})
+@cache_control(max_age=60)
+async def suggest_places(request):
+    """
+    JSON suggestions of origins and destinations starting with ``?q=``,
+    looked up in the in-process place index (see suggest.py), so a
+    keystroke costs no query. Browsers may reuse an answer for a minute.
+    """
+    if place_index.is_stale():
+        await sync_to_async(refresh_place_index)()
+    query = request.GET.get('q', '')[:100]
+    return JsonResponse({'q': query, 'suggestions': place_index.suggest(query)})
+
+async def ride_events(request):
+    """
+    Server-Sent Events with the seats and status of the rides in
+    ``?ids=1,2,3`` and their changes (see events.py), for pages to keep
+    their seat counts current.
+
+    Only served under ASGI: a sync worker would hold the stream's whole
+    body, and a thread, for as long as the page is open. Otherwise, and
+    for no valid IDs, answers 204, which tells EventSource not to reconnect.
+    """
+    ride_ids = set()
+    for ride_id in request.GET.get('ids', '').split(','):
+        if ride_id.strip().isdigit():
+            ride_ids.add(int(ride_id))
+    if settings.SERVER_MODE != 'asgi' or not ride_ids:
+        return HttpResponse(status=204)
+    if len(ride_ids) > settings.RIDES_EVENTS_MAX_RIDES:
+        return HttpResponseBadRequest(f'At most {settings.RIDES_EVENTS_MAX_RIDES} rides per stream.')
+    response = StreamingHttpResponse(ride_event_stream(ride_ids), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # tell nginx not to buffer the stream
+    return response
+
+@cache_control(private=True, no_cache=True)
+async def ride_detail(request, ride_id):
+    """
+    Display full details for a single ride.
+    
+    Sends an ETag (ride and driver version plus viewer, since the navbar
+    differs, and the release, since the page links static files by their
+    hashed names) and Last-Modified, and answers conditional requests for
+    an unchanged ride with a 304 without loading or rendering it.
+    """
+    user = await resolve_user(request)
+    version = await Rides.objects.filter(pk=ride_id).values_list(
+        'updated_on', 'seats_booked', 'seats_offered', *Rides.DRIVER_VERSION_FIELDS
+    ).afirst()
+    if version is None:
+        raise Http404('No ride matches the given query.')
+    updated_on, seats_booked, seats_offered, *driver = version
+    etag = quote_etag(
+        f'{ride_id}-{updated_on.timestamp()}-{seats_booked}-{seats_offered}-{driver_version(*driver)}'
+        f'-{user.pk or 0}-{settings.RELEASE}'
+    )
+    last_modified = int(updated_on.timestamp())
+    
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        ride = await aget_object_or_404(Rides.objects.with_driver(), id=ride_id)
+        response = render(request, 'rides/ride_detail.html', {'ride': ride})
+    response.headers.setdefault('ETag', etag)
+    response.headers.setdefault('Last-Modified', http_date(last_modified))
+    return response
 
 def request_ride(request, ride_id):
     """
@@ -61,39 +172,42 @@ def request_ride(request, ride_id):
         messages.warning(request, mark_safe(message))
         return redirect('account_signup')
     
-    ride = get_object_or_404(Rides, id=ride_id)
-    
-    # Check if ride has available seats
-    if ride.seats_available <= 0:
-        messages.error(request, 'This ride has no available seats.')
-        return redirect('search_rides')
+    ride = get_object_or_404(Rides.objects.with_driver(), id=ride_id)
     
     if request.method == 'POST':
         seats_requested = int(request.POST.get('seats_requested', 1))
         
-        # Validate seats requested
-        if seats_requested < 1 or seats_requested > ride.seats_available:
+        # Create the ride request and take the seats in one transaction.
+        # Availability is checked by the reservation itself, so a repeated
+        # submit still lands on the confirmation even if the ride is now full.
+        try:
+            if seats_requested < 1:
+                raise SeatsUnavailable()
+            ride_request, created = reserve_seats(RideRequest(
+                passenger=request.user,
+                ride=ride,
+                seats_requested=seats_requested,
+                status='0'  # Pending status
+            ))
+        except SeatsUnavailable:
+            ride.refresh_from_db(fields=['seats_booked', 'seats_offered'])
+            if ride.seats_available <= 0:
+                messages.error(request, 'This ride has no available seats.')
+                return redirect('search_rides')
             context = {
                 'ride': ride,
                 'error': f'Please select between 1 and {ride.seats_available} seats'
             }
             return render(request, 'rides/request_ride.html', context)
         
-        # Create the ride request
-        ride_request = RideRequest.objects.create(
-            passenger=request.user,
-            ride=ride,
-            seats_requested=seats_requested,
-            status='0'  # Pending status
-        )
-        
-        # Decrement available seats
-        ride.seats_available -= seats_requested
-        ride.save()
-        
-        # Redirect to confirmation page
+        # Redirect to confirmation page (also for a repeated submit)
         return redirect('ride_request_confirmation', request_id=ride_request.id)
     
+    # Check if ride has available seats
+    if ride.seats_available <= 0:
+        messages.error(request, 'This ride has no available seats.')
+        return redirect('search_rides')
+    
     context = {
         'ride': ride,
     }
@@ -105,7 +219,9 @@ def ride_request_confirmation(request, request_id):
     """
     Display booking confirmation page after successful booking.
     """
-    ride_request = get_object_or_404(RideRequest, id=request_id, passenger=request.user)
+    ride_request = get_object_or_404(
+        RideRequest.objects.with_ride(), id=request_id, passenger=request.user
+    )
     
     context = {
         'ride_request': ride_request,
@@ -119,12 +235,20 @@ def create_ride(request):
     if request.method == 'POST':
         form = RideCreateForm(request.POST)
         if form.is_valid():
-            ride = form.save(commit=False)
-            ride.driver = request.user
-            ride.status = '1'  # Published
-            ride.save()
-            messages.success(request, 'Your ride has been created successfully!')
-            return redirect('my_rides')
+            # One ride, or every ride of a repeat schedule in one insert
+            try:
+                with transaction.atomic():
+                    rides = create_rides(form.build_rides(request.user))
+                    if rides:
+                        queue_ride_search_invalidation(rides[0])  # a series shares its places
+            except ValidationError as error:
+                form.add_error(None, error)
+            else:
+                if len(rides) == 1:
+                    messages.success(request, 'Your ride has been created successfully!')
+                else:
+                    messages.success(request, f'{len(rides)} rides have been created successfully!')
+                return redirect('my_rides')
     else:
         form = RideCreateForm()
     
@@ -135,11 +259,24 @@ def edit_ride(request, ride_id):
     """Allow ride creator to edit their ride listing."""
     ride = get_object_or_404(Rides, id=ride_id)
     if ride.driver == request.user:
+        # The form updates the instance in place, remember where it was first
+        old_places = (ride.origin, ride.destination)
         form = RideCreateForm(request.POST or None, instance=ride)
-        if request.method == 'POST' and form.is_valid():
-            form.save()
-            messages.add_message(request, messages.SUCCESS, 'Ride updated successfully!')
-            return redirect('my_rides')
+        if request.method == 'POST':
+            with transaction.atomic():
+                # No booking can take the seats between validating and saving
+                lock_seat_counts(ride)
+                saved = form.is_valid()
+                if saved:
+                    form.save()
+                    queue_search_invalidation(old_places, (ride.origin, ride.destination))
+                    invalidate_dashboards_on_commit(*ride_dashboard_users(ride.id))
+                    publish_rides_on_commit(ride.id)
+                    if (ride.origin, ride.destination) != old_places:
+                        add_ride_places_on_commit(ride)
+            if saved:
+                messages.add_message(request, messages.SUCCESS, 'Ride updated successfully!')
+                return redirect('my_rides')
         return render(request, 'rides/edit_ride.html', {'form': form, 'ride': ride})
     else:
         messages.add_message(request, messages.ERROR, 'You can only edit your own rides!')
@@ -150,34 +287,90 @@ def delete_ride(request, ride_id):
     """Allow ride creator to delete their ride listing."""
     ride = get_object_or_404(Rides, id=ride_id)
     if ride.driver == request.user:
-        ride.delete()
+        with transaction.atomic():
+            invalidate_dashboards_on_commit(*ride_dashboard_users(ride.id))
+            ride_id = ride.id
+            ride.delete()
+            queue_ride_search_invalidation(ride)
+            publish_rides_on_commit(ride_id)
         messages.add_message(request, messages.SUCCESS, 'Ride deleted successfully!')
     else:
         messages.add_message(request, messages.ERROR, 'You can only delete your own rides!')
     return redirect('my_rides')
 
+def dashboard_section(request):
+    """The dashboard section asked for with ``?section=`` (upcoming by default)."""
+    section = request.GET.get('section')
+    return section if section in SECTIONS else 'upcoming'
+
+
 @login_required(login_url='account_signup')
-def my_rides(request):
-    """Display all rides created by the logged-in user."""
-    rides = Rides.objects.filter(driver=request.user).order_by('-date')
+async def my_rides(request):
+    """Display the logged-in user's upcoming or past rides."""
+    user = await resolve_user(request)
+    section = dashboard_section(request)
+    page = await aget_dashboard_page('rides', user.pk, section, request.GET.get('cursor'))
     
-    return render(request, 'rides/my_rides.html', {'rides': rides})
+    return render(request, 'rides/my_rides.html', {'rides': page.items, 'page': page, 'section': section})
+
+
+def export_format(request):
+    """The export format asked for with ``?format=`` (CSV by default)."""
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in FORMATS:
+        raise Http404('Unknown export format.')
+    return fmt
+
+
+@login_required(login_url='account_signup')
+def export_my_rides(request):
+    """Download all the logged-in user's rides as CSV or NDJSON."""
+    rides = Rides.objects.filter(driver=request.user)
+    return export_response(rides, RIDE_COLUMNS, export_format(request), 'my-rides')
+
+
+@login_required(login_url='account_signup')
+def export_my_ride_bookings(request):
+    """Download the requests made on the logged-in user's rides as CSV or NDJSON."""
+    ride_requests = RideRequest.objects.filter(ride__driver=request.user)
+    return export_response(ride_requests, DRIVER_REQUEST_COLUMNS, export_format(request), 'my-ride-bookings')
 
 
 @login_required(login_url='account_signup')
-def my_ride_requests(request):
+async def my_ride_requests(request):
     """
-    Display all ride requests (bookings) for the logged-in user.
+    Display the logged-in user's ride requests (bookings) for upcoming or
+    past rides.
     """
-    ride_requests = RideRequest.objects.filter(
-        passenger=request.user
-    ).select_related('ride').order_by('-ride__date')
+    user = await resolve_user(request)
+    section = dashboard_section(request)
+    page = await aget_dashboard_page('requests', user.pk, section, request.GET.get('cursor'))
     
     context = {
-        'ride_requests': ride_requests,
+        'ride_requests': page.items,
+        'page': page,
+        'section': section,
     }
     return render(request, 'rides/my_ride_requests.html', context)
 
+@staff_member_required
+def profile_report(request):
+    """
+    Percentiles of the requests sampled by ProfileMiddleware in this
+    process, slowest views first. POST resets them.
+    """
+    if request.method == 'POST':
+        view_stats.reset()
+        return redirect('profile_report')
+    context = {
+        'rows': view_stats.report(),
+        'since': view_stats.since,
+        'sample_rate': settings.RIDES_PROFILE_SAMPLE_RATE,
+        'window': settings.RIDES_PROFILE_WINDOW,
+        'pid': os.getpid(),
+    }
+    return render(request, 'rides/profile_report.html', context)
+
 # Create your views here.
 # class PostList(generic.ListView):
 #     """
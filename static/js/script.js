@@ -1,6 +1,8 @@
 // JavaScript to handle the delete confirmation modal
 document.addEventListener("DOMContentLoaded", function () {
     handleDeleteModal();
+    handlePlaceSuggestions();
+    handleRideEvents();
 });
 
 function handleDeleteModal() {
@@ -13,3 +15,54 @@ function handleDeleteModal() {
         form.action = deleteUrl;
     });
 }
+
+// Fill the origin/destination datalists with suggestions as the user types
+function handlePlaceSuggestions() {
+    document.querySelectorAll("input[data-suggest-url]").forEach(function (input) {
+        const datalist = document.getElementById(input.getAttribute("list"));
+        if (!datalist) return;
+        let timer;
+        input.addEventListener("input", function () {
+            clearTimeout(timer);
+            const query = input.value.trim();
+            if (!query) return;
+            timer = setTimeout(function () {
+                const url = input.dataset.suggestUrl + "?q=" + encodeURIComponent(query);
+                fetch(url)
+                    .then(function (response) { return response.ok ? response.json() : { suggestions: [] }; })
+                    .then(function (data) {
+                        datalist.replaceChildren(...data.suggestions.map(function (name) {
+                            const option = document.createElement("option");
+                            option.value = name;
+                            return option;
+                        }));
+                    })
+                    .catch(function () {});
+            }, 150);
+        });
+    });
+}
+
+// Keep the seats and status of the rides on the page current
+function handleRideEvents() {
+    const container = document.querySelector("[data-events-url]");
+    if (!container || !window.EventSource) return;
+    const cards = container.matches("[data-ride-id]") ? [container] : container.querySelectorAll("[data-ride-id]");
+    const ids = Array.from(cards, function (card) { return card.dataset.rideId; });
+    if (!ids.length) return;
+    const source = new EventSource(container.dataset.eventsUrl + "?ids=" + ids.join(","));
+    source.addEventListener("ride", function (event) {
+        const ride = JSON.parse(event.data);
+        Array.from(cards).filter(function (card) { return card.dataset.rideId === String(ride.id); }).forEach(function (card) {
+            const seats = card.querySelector("[data-ride-seats]");
+            const status = card.querySelector("[data-ride-status]");
+            const button = card.querySelector("a.ride-btn");
+            if (seats) seats.textContent = ride.deleted ? "No longer available" : ride.seats_available;
+            if (status && !ride.deleted) status.textContent = ride.status_display;
+            if (button && (ride.deleted || ride.seats_available <= 0 || ride.status !== "1")) {
+                button.classList.add("disabled");
+                button.setAttribute("aria-disabled", "true");
+            }
+        });
+    });
+}